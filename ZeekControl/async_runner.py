@@ -0,0 +1,378 @@
+# An asyncio-based implementation of the MultiMasterManager from ssh_runner.
+#
+# Instead of one thread (with its own queue) per host, the connections to all
+# hosts are driven by a single event loop that runs in a background thread and
+# uses non-blocking pipes.  The command muxer and the frames it sends are the
+# same as for the thread-based implementation.
+#
+# This module requires Python 3, and it is only imported when the
+# "ExecutorBackend" option is set to "asyncio".
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from ZeekControl import muxer as muxer_mod
+from ZeekControl import ssh_runner
+from ZeekControl.ssh_runner import FrameParser, ResultCollector, FRAME_ERROR
+
+# Number of seconds that a connection can be idle before it is checked (if
+# the manager was created with "heartbeat" set).
+HEARTBEAT = 30
+
+class AsyncSSHMaster(ssh_runner.SSHMaster):
+    def __init__(self, loop, host, localaddrs, limits=None):
+        ssh_runner.SSHMaster.__init__(self, host, localaddrs, limits)
+        self.loop = loop
+
+    def connect(self):
+        need_connect = self.need_connect
+        ssh_runner.SSHMaster.connect(self)
+        if need_connect:
+            os.set_blocking(self.master.stdin.fileno(), False)
+            os.set_blocking(self.master.stdout.fileno(), False)
+
+    # Closing the connection waits for the ssh process to terminate, so this
+    # is done in a thread in order to not hold up the other hosts.
+    async def aclose(self):
+        await self.loop.run_in_executor(None, self.close)
+
+    # Wait until the file descriptor is readable (or writable, if "write" is
+    # True).
+    async def wait_fd(self, fd, write=False):
+        if write:
+            add, remove = self.loop.add_writer, self.loop.remove_writer
+        else:
+            add, remove = self.loop.add_reader, self.loop.remove_reader
+
+        fut = self.loop.create_future()
+        add(fd, lambda: fut.done() or fut.set_result(None))
+        try:
+            await fut
+        finally:
+            remove(fd)
+
+    async def write(self, data):
+        fd = self.master.stdin.fileno()
+        data = memoryview(data)
+        while data:
+            try:
+                n = os.write(fd, data)
+            except BlockingIOError:
+                await self.wait_fd(fd, write=True)
+                continue
+            data = data[n:]
+
+    # Read whatever data is available from the muxer into the frame parser.
+    # Returns False if the connection was closed.
+    async def read(self):
+        fd = self.master.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd, muxer_mod.READ_SIZE)
+                break
+            except BlockingIOError:
+                await self.wait_fd(fd)
+
+        if not data:
+            return False
+        self.parser.feed(data)
+        return True
+
+    async def read_with_timeout(self, timeout):
+        try:
+            return await asyncio.wait_for(self.read(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def start_muxer(self, timeout):
+        self.connect()
+        if self.muxer_running:
+            return
+
+        self.parser = FrameParser()
+        await self.write(self.run_mux)
+
+        # Wait until we receive the "ready" message from muxer script
+        while not self.parser.skip_to_ready():
+            if not await self.read_with_timeout(timeout):
+                await self.aclose()
+                raise Exception("Failed to start command muxer on host %s" % self.host)
+
+        self.muxer_running = True
+
+    async def send_commands(self, cmds, timeout, shell=False):
+        await self.start_muxer(timeout)
+
+        self.request_id += 1
+        req = {"id": self.request_id, "shell": shell, "cmds": cmds, "timeout": timeout}
+        if self.limits:
+            req["max"], req["limits"] = self.limits
+        await self.write(("%s\n" % json.dumps(req)).encode())
+        self.sent_commands = len(cmds)
+
+    async def cancel(self):
+        if not self.muxer_running:
+            return
+        try:
+            await self.write(("%s\n" % json.dumps({"cancel": self.request_id})).encode())
+        except (OSError, AttributeError):
+            # The connection is gone.
+            pass
+
+    # Returns the next frame of the current request as a tuple (type, idx,
+    # payload).  If no frame is received within the timeout (plus
+    # READ_GRACE), then the connection is closed and None is returned.
+    async def next_frame(self, timeout):
+        while True:
+            frame = self.parser.next_frame()
+            if not frame:
+                if await self.read_with_timeout(timeout + ssh_runner.READ_GRACE):
+                    continue
+                logging.debug("Command timeout on host %s", self.host)
+                await self.aclose()
+                return None
+
+            ftype, rid, idx, payload = frame
+            if rid == self.request_id:
+                return ftype, idx, payload
+
+    async def exec_command(self, cmd, shell=False, timeout=60):
+        return (await self.exec_commands([cmd], shell, timeout))[0]
+
+    async def exec_commands(self, cmds, shell=False, timeout=60):
+        await self.send_commands(cmds, timeout, shell)
+
+        results = ResultCollector(self.host, self.sent_commands)
+        while not results.done:
+            frame = await self.next_frame(timeout)
+            if not frame:
+                break
+            results.add(*frame)
+
+        return results.outputs
+
+
+# Runs the commands for one host.  This provides the same interface to the
+# MultiMasterManager as the HostHandler thread in ssh_runner, but all work
+# is done by coroutines running in the manager's event loop.
+#
+# If "heartbeat" is True, then the connection is checked whenever it has been
+# idle for HEARTBEAT seconds.  This is only useful for long-running processes
+# (zeekctld), because a single zeekctl command is over long before that.
+class AsyncHostHandler:
+    def __init__(self, loop, host, localaddrs, timeout, livenessttl=0, limits=None, heartbeat=False):
+        self.loop = loop
+        self.host = host
+        self.localaddrs = localaddrs
+        self.timeout = timeout
+        self.livenessttl = livenessttl
+        self.limits = limits
+        self.alive = False
+        self.last_alive = 0
+        self.master = None
+        self.lock = None
+        self.last_active = time.time()
+        self.watcher = None
+        if heartbeat:
+            self.watcher = self.submit(self.watch())
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    # The following methods are called from the controller's thread.
+
+    def send_commands(self, commands, shell, rq, stream=False):
+        self.submit(self.run_commands(commands, shell, rq, stream))
+
+    def shutdown(self):
+        if self.watcher:
+            self.watcher.cancel()
+        return self.submit(self.close())
+
+    # Cancel the request that is currently running.
+    def cancel(self):
+        if self.master:
+            self.submit(self.master.cancel())
+
+    # Requests for the same host are handled one at a time.
+    def get_lock(self):
+        if not self.lock:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+    async def close(self):
+        async with self.get_lock():
+            if self.master:
+                await self.master.aclose()
+
+    async def connect(self):
+        if self.master:
+            await self.master.aclose()
+        self.master = AsyncSSHMaster(self.loop, self.host, self.localaddrs, self.limits)
+
+    async def ping(self):
+        # Error message should indicate whether or not ssh is being used.
+        msgstr = "" if self.host in self.localaddrs else "ssh "
+
+        # Error message shows if a connection was previously established.
+        if self.alive:
+            msg = "Lost %sconnection to host %s" % (msgstr, self.host)
+        else:
+            msg = "Failed to establish %sconnection to host %s" % (msgstr, self.host)
+
+        # This will be set to True below only if the "ping" is received.
+        self.alive = False
+
+        try:
+            resp = await self.master.exec_command(["/bin/echo", "ping"], timeout=10)
+        except Exception as e:
+            return "%s: %s" % (msg, e)
+
+        try:
+            ping_recvd = resp.stdout.strip() == "ping"
+        except Exception:
+            return msg
+
+        if ping_recvd:
+            self.mark_alive()
+            return ""
+
+        # This should probably never happen.
+        return "Communication failure with host %s when checking connection" % self.host
+
+    async def connect_and_ping(self):
+        if not self.alive:
+            await self.connect()
+        return await self.ping()
+
+    def mark_alive(self):
+        self.alive = True
+        self.last_alive = time.time()
+
+    # Return an error message if the host is not reachable, or an empty
+    # string otherwise.  The host is only pinged if it is not known to be
+    # alive, or if the last sign of life is older than the liveness TTL
+    # (the idle-timeout heartbeat refreshes it on otherwise unused
+    # connections).
+    async def check_alive(self):
+        if self.alive and time.time() - self.last_alive < self.livenessttl:
+            return ""
+        return await self.connect_and_ping()
+
+    # Update the liveness of the host after a request.  If the request timed
+    # out, the connection was closed and the host is no longer considered
+    # alive.
+    def request_done(self):
+        if self.master.need_connect:
+            self.alive = False
+        else:
+            self.mark_alive()
+
+    # Check the connection whenever it has been idle for HEARTBEAT seconds.
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.last_active + HEARTBEAT - time.time())
+            if time.time() - self.last_active < HEARTBEAT:
+                continue
+
+            async with self.get_lock():
+                await self.connect_and_ping()
+                self.last_active = time.time()
+
+    async def run_commands(self, item, shell, rq, stream):
+        async with self.get_lock():
+            try:
+                if stream:
+                    await self.stream_commands(item, shell, rq)
+                else:
+                    await self.exec_commands(item, shell, rq)
+            finally:
+                self.last_active = time.time()
+
+    async def exec_commands(self, item, shell, rq):
+        msg = await self.check_alive()
+        if not self.alive:
+            logging.debug(msg)
+            rq.put([Exception(msg)] * len(item))
+            return
+
+        try:
+            resp = await self.master.exec_commands(item, shell, self.timeout)
+            self.request_done()
+        except Exception as e:
+            msg = await self.lost_connection(e)
+            resp = [Exception(msg)] * len(item)
+        rq.put(resp)
+
+    async def lost_connection(self, e):
+        self.alive = False
+        msgstr = "" if self.host in self.localaddrs else "ssh "
+        msg = "Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e)
+        logging.debug(msg)
+        await asyncio.sleep(2)
+        return msg
+
+    # See HostHandler.stream_commands.
+    async def stream_commands(self, item, shell, rq):
+        pending = set(range(len(item)))
+
+        msg = await self.check_alive()
+        if self.alive:
+            msg = "Command timeout on host %s" % self.host
+            try:
+                await self.master.send_commands(item, self.timeout, shell)
+                while True:
+                    frame = await self.master.next_frame(self.timeout)
+                    if not frame or frame[0] == muxer_mod.FRAME_DONE:
+                        break
+                    ftype, idx, payload = frame
+                    if ftype == muxer_mod.FRAME_TIMEOUT:
+                        # Report this like a command without result.
+                        ftype, payload = FRAME_ERROR, Exception("Command timeout on host %s" % self.host)
+                    if ftype in (muxer_mod.FRAME_EXIT, muxer_mod.FRAME_SKIPPED, FRAME_ERROR):
+                        pending.discard(idx)
+                    rq.put((self.host, idx, ftype, payload))
+                self.request_done()
+            except Exception as e:
+                msg = await self.lost_connection(e)
+        else:
+            logging.debug(msg)
+
+        for idx in sorted(pending):
+            rq.put((self.host, idx, FRAME_ERROR, Exception(msg)))
+
+        rq.put((self.host, -1, muxer_mod.FRAME_DONE, None))
+
+
+class AsyncMasterManager(ssh_runner.MultiMasterManager):
+    def __init__(self, localaddrs=[], livenessttl=0, breaker=None, localworkers=0, limits=None, heartbeat=False):
+        ssh_runner.MultiMasterManager.__init__(self, localaddrs, livenessttl, breaker, localworkers, limits)
+        self.heartbeat = heartbeat
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+    def create_handler(self, host, timeout):
+        return AsyncHostHandler(self.loop, host, self.localaddrs, timeout, self.livenessttl, self.limits, self.heartbeat)
+
+    def shutdown_all(self):
+        closing = [handler.shutdown() for handler in self.masters.values()]
+        self.masters = {}
+
+        # Wait for the connections to be closed, because the event loop
+        # thread does not keep the process alive.
+        for fut in closing:
+            if not fut:
+                # Not an AsyncHostHandler.
+                continue
+            try:
+                fut.result(timeout=5)
+            except Exception:
+                pass
+
+    __del__ = shutdown_all
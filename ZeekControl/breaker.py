@@ -0,0 +1,132 @@
+# A circuit breaker for unreachable hosts.
+#
+# Whenever none of the commands sent to a remote host could be run (because
+# the host could not be reached, or the connection failed or timed out), a
+# failure is counted for that host in the state database.  After
+# HostFailureThreshold consecutive failures the circuit "opens": for the next
+# HostDownBackoff seconds, commands for that host fail immediately instead of
+# waiting for ssh or the command timeout.  Once the backoff period is over, a
+# single ssh login to the host decides whether commands are tried again (if
+# not, the backoff period starts over).  The circuit closes as soon as
+# commands can be run on the host again.
+
+import logging
+import os
+import subprocess
+import time
+
+# Error message for commands that were not run because the circuit is open.
+HOST_DOWN = "host down (cached)"
+
+# Number of seconds to wait for the ssh connection of a probe.
+PROBE_TIMEOUT = 3
+
+class CircuitBreaker:
+    def __init__(self, config):
+        self.config = config
+
+    def _key(self, host):
+        return "hostbreaker-%s" % host
+
+    def _get(self, host):
+        # Return a copy, because set_state ignores unchanged values.
+        return dict(self.config.get_state(self._key(host)) or {"failures": 0, "opened": 0})
+
+    def _enabled(self, host):
+        return self.config.hostfailurethreshold > 0 and host not in self.config.localaddrs
+
+    # Returns True if the circuit for the host is open (i.e., the host is
+    # considered down).
+    def is_open(self, host):
+        return self._enabled(host) and self._get(host)["opened"] > 0
+
+    # Returns True if commands should be sent to the host.
+    def allow(self, host):
+        return host in self.allowed([host])
+
+    # Returns the set of hosts (among "hosts") that commands should be sent
+    # to.  The hosts whose backoff period is over are probed in parallel.
+    def allowed(self, hosts):
+        result = set()
+        due = []
+
+        for host in hosts:
+            if not self.is_open(host):
+                result.add(host)
+            elif time.time() - self._get(host)["opened"] >= self.config.hostdownbackoff:
+                due.append(host)
+
+        reachable = probe_hosts(due) if due else set()
+
+        for host in due:
+            if host in reachable:
+                logging.debug("host %s accepts connections again, trying to run commands", host)
+                result.add(host)
+                continue
+
+            state = self._get(host)
+            state["opened"] = time.time()
+            self.config.set_state(self._key(host), state)
+
+        return result
+
+    # Record whether commands could be run on the host.
+    def record(self, host, success):
+        if not self._enabled(host):
+            return
+
+        if success:
+            self.config.del_state(self._key(host))
+            return
+
+        state = self._get(host)
+        state["failures"] += 1
+        if state["failures"] >= self.config.hostfailurethreshold:
+            if not state["opened"]:
+                logging.debug("host %s failed %d times, considering it down", host, state["failures"])
+            state["opened"] = time.time()
+
+        self.config.set_state(self._key(host), state)
+
+    # Returns a list of all hosts whose circuit is open.
+    def down_hosts(self):
+        return [n.addr for n in self.config.hosts() if self.is_open(n.addr)]
+
+
+# Returns True if a command can be run on the host with ssh.  This uses the
+# same ssh options as the connections for commands (and the user's ssh
+# configuration, e.g. for the port).
+def probe(host):
+    return host in probe_hosts([host])
+
+# Same as probe, but for several hosts at the same time.  Returns the set of
+# hosts on which a command could be run.
+def probe_hosts(hosts):
+    procs = {}
+    with open(os.devnull, "w") as devnull:
+        for host in hosts:
+            cmd = ["ssh", "-o", "BatchMode=yes", "-o", "LogLevel=error", "-o", "ConnectTimeout=%d" % PROBE_TIMEOUT, host, "true"]
+            try:
+                procs[host] = subprocess.Popen(cmd, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+            except OSError as err:
+                logging.debug("probe of host %s failed: %s", host, err)
+
+    # The ConnectTimeout doesn't cover the login itself.
+    deadline = time.time() + 2 * PROBE_TIMEOUT
+    while any(proc.poll() is None for proc in procs.values()):
+        if time.time() > deadline:
+            break
+        time.sleep(0.1)
+
+    reachable = set()
+    for host, proc in procs.items():
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+            logging.debug("probe of host %s timed out", host)
+        elif proc.returncode != 0:
+            logging.debug("probe of host %s failed: ssh exit status %d", host, proc.returncode)
+        else:
+            reachable.add(host)
+
+    return reachable
@@ -1,5 +1,6 @@
 # Functions to read and access the zeekctl configuration.
 
+import contextlib
 import hashlib
 import os
 import socket
@@ -178,6 +179,17 @@ class Configuration:
             if not os.path.isfile(v):
                 raise ConfigurationError('zeekctl option "%s" file not found: %s' % (f, v))
 
+        self.get_command_limits()
+
+        if self.config["executorbackend"] not in ("threads", "asyncio"):
+            raise ConfigurationError('zeekctl option "executorbackend" has invalid value (must be "threads" or "asyncio"): %s' % self.config["executorbackend"])
+
+        if self.config["executorbackend"] == "asyncio" and not py3zeek.using_py3:
+            raise ConfigurationError('zeekctl option "executorbackend" value "asyncio" requires Python 3')
+
+        if self.config["nicstats"] not in ("auto", "capstats", "kernel"):
+            raise ConfigurationError('zeekctl option "nicstats" has invalid value (must be "auto", "capstats", or "kernel"): %s' % self.config["nicstats"])
+
         # Verify that logs don't expire more quickly than the rotation interval
         logexpireseconds = 60 * self.config["logexpireminutes"]
         if 0 < logexpireseconds < self.config["logrotationinterval"]:
@@ -376,6 +388,24 @@ class Configuration:
 
         return env_vars
 
+    # Convert the value of the "maxhostcommandsbyname" option (a
+    # comma-separated list such as "crash-diag=2, df=4") to a dictionary that
+    # maps command names to the maximum number of such commands running at
+    # the same time on one host.
+    def get_command_limits(self):
+        limits = {}
+
+        text = self.config["maxhostcommandsbyname"]
+        if text:
+            for keyval in text.split(","):
+                try:
+                    key, val = keyval.split("=", 1)
+                    limits[key.strip()] = int(val)
+                except ValueError:
+                    raise ConfigurationError("zeekctl option maxhostcommandsbyname has invalid entry (must be name=number): %s" % keyval.strip())
+
+        return limits
+
     # Parse node.cfg.
     def _read_nodes(self):
         config = py3zeek.configparser.SafeConfigParser()
@@ -652,14 +682,44 @@ class Configuration:
         self.state[key] = val
         self.state_store.set(key, val)
 
+    # Remove a dynamic state variable.
+    def del_state(self, key):
+        key = key.lower()
+        if key not in self.state:
+            return
+
+        del self.state[key]
+        self.state_store.delete(key)
+
+    # Groups all state changes made in the "with" block into a single write to
+    # the state database (e.g. those of one command).  Changes that must not
+    # be lost if zeekctl is killed before the end of the block are written
+    # right away with flush_state.
+    @contextlib.contextmanager
+    def state_batch(self):
+        self.state_store.begin_batch()
+        try:
+            yield
+        finally:
+            self.state_store.end_batch()
+
+    # Write all state changes that are pending (also inside a state_batch).
+    def flush_state(self):
+        self.state_store.flush()
+
     # Returns value of state variable, or the specified default value if the
     # state variable is not defined.
     def get_state(self, key, default=None):
         return self.state.get(key.lower(), default)
 
-    # Read dynamic state variables.
+    # Read dynamic state variables (only those that have changed since the
+    # last call, if possible).
     def read_state(self):
-        self.state = dict(self.state_store.items())
+        full, items = self.state_store.changes()
+        if full:
+            self.state = dict(items)
+        else:
+            self.state.update(items)
 
     # Use the ifconfig command to find local IP addrs.
     def _get_local_addrs_ifconfig(self):
@@ -9,6 +9,7 @@ import logging
 
 from ZeekControl import execute
 from ZeekControl import events
+from ZeekControl import muxer
 from ZeekControl import util
 from ZeekControl import config
 from ZeekControl import install
@@ -16,6 +17,9 @@ from ZeekControl import cron
 from ZeekControl import node as node_mod
 from ZeekControl import cmdresult
 
+# Number of seconds after which Controller.top_stream stops sampling (the
+# caller can simply start it again).
+TOP_STREAM_DURATION = 600
 
 # Waits for the nodes' Zeek processes to reach the given status.
 # Build the Zeek parameters for the given node. Include
@@ -103,6 +107,9 @@ class Controller:
         self.ui = ui
         self.executor = executor
         self.pluginregistry = pluginregistry
+        # A persistent Broker session (events.ControlSession) to use for
+        # sending events to the nodes, if any.
+        self.control_session = None
 
         # Create zeekctl-config.sh file so that shell script helpers have
         # current config values.
@@ -165,18 +172,9 @@ class Controller:
             self.ui.info("creating crash report for previously crashed nodes: %s" % ", ".join([n.name for n in crashed]))
             self._make_crash_reports(crashed)
 
-        # Make working directories.
-        dirs = [(node, node.cwd()) for node in nodes]
-        nodes = []
-        for (node, success, output) in self.executor.mkdirs(dirs):
-            if success:
-                nodes += [node]
-            else:
-                self.ui.error("cannot create working directory for %s" % node.name)
-                results.set_node_fail(node)
-
-        # Start Zeek process.
-        cmds = []
+        # Make working directories and start Zeek processes (in one request
+        # per host).
+        plans = []
         for node in nodes:
             envs = []
             pin_cpu = node.pin_cpus
@@ -186,12 +184,20 @@ class Controller:
                 pin_cpu = -1
 
             envs = _make_env_params(node, True)
-            cmds += [(node, "start", envs + [node.cwd(), str(pin_cpu)] + _make_zeek_params(node, True))]
+            args = envs + [node.cwd(), str(pin_cpu)] + _make_zeek_params(node, True)
+
+            # Note: the shell is used to interpret the command because
+            # zeekargs might contain quoted arguments.
+            plans += [(node, [execute.mkdir_step(node.cwd()),
+                              execute.PlanStep("start", args, shell=True, helper=True)])]
 
         nodes = []
-        # Note: the shell is used to interpret the command because zeekargs
-        # might contain quoted arguments.
-        for (node, success, output) in self.executor.run_helper(cmds, shell=True):
+        for (node, ((mkdir_success, mkdir_output), (success, output))) in self.executor.run_plans(plans):
+            if not mkdir_success:
+                self.ui.error("cannot create working directory for %s" % node.name)
+                results.set_node_fail(node)
+                continue
+
             if success:
                 if not output:
                     self.ui.error("failed to get PID of %s" % node.name)
@@ -245,28 +251,32 @@ class Controller:
         return results
 
     def _isrunning(self, nodes, setcrashed=True):
+        return [(node, isrunning) for (node, isrunning, info) in self._probe_running(nodes, setcrashed)]
+
+    # Same as _isrunning, but returns tuples (node, isrunning, info), where
+    # "info" is the result of the node's probe (see _probe), or None if the
+    # node has no PID.
+    def _probe_running(self, nodes, setcrashed=True):
 
         results = []
-        cmds = []
+
+        probed = dict((node.name, info) for (node, info) in self._probe([node for node in nodes if node.getPID()]))
 
         for node in nodes:
-            pid = node.getPID()
-            if not pid:
-                results += [(node, False)]
+            if not node.getPID():
+                results += [(node, False, None)]
                 continue
 
-            cmds += [(node, "check-pid", [str(pid)])]
+            info = probed[node.name]
 
-        for (node, success, output) in self.executor.run_helper(cmds):
-            # If we cannot run the helper script, then we ignore this node
-            # because the process might actually be running but we can't tell.
-            if not success:
-                self.ui.error("failed to run check-pid on node %s" % node.name)
+            # If we cannot probe the node, then we ignore it because the
+            # process might actually be running but we can't tell.
+            if not info:
                 continue
 
-            running = output.strip() == "running"
+            running = info["zeek"]
 
-            results += [(node, running)]
+            results += [(node, running, info)]
 
             if not running:
                 if setcrashed:
@@ -276,6 +286,65 @@ class Controller:
 
         return results
 
+    # Get the state of the nodes' processes with one call per host (see the
+    # "probe-nodes" operation of the muxer).
+    #
+    # Returns a list of tuples (node, info), where "info" is a dict with the
+    # keys "alive", "zeek" (the process' command line contains "zeek"),
+    # "cmd", "rss", "vsize", "cputicks", "clktck", "status" and "startup" (the
+    # first lines of the .status and .startup files), or None if the node
+    # could not be probed.
+    def _probe(self, nodes):
+        if not self.config.nativehelpers:
+            return self._probe_helpers(nodes)
+
+        hosts = {}
+        for node in nodes:
+            hosts.setdefault(node.addr, []).append(node)
+
+        cmds = []
+        for hostnodes in hosts.values():
+            args = [[node.cwd(), int(node.getPID())] for node in hostnodes]
+            cmds += [(hostnodes[0], "probe-nodes", [args])]
+
+        probed = {}
+        for (node, success, output) in self.executor.run_builtins(cmds):
+            hostnodes = hosts[node.addr]
+            if not success or len(output) != len(hostnodes):
+                self.ui.error("failed to probe nodes on host %s: %s" % (node.host, output))
+                continue
+
+            for (n, info) in zip(hostnodes, output):
+                probed[n.name] = info
+
+        return [(node, probed.get(node.name)) for node in nodes]
+
+    # Same as _probe, but uses the check-pid and first-line helper scripts.
+    # Only "zeek", "status" and "startup" are set in the returned dicts
+    # ("alive" is the same as "zeek").
+    def _probe_helpers(self, nodes):
+        plans = []
+        for node in nodes:
+            plans += [(node, [execute.PlanStep("check-pid", [str(node.getPID())], helper=True, abort=False),
+                              execute.PlanStep("first-line", ["%s/.status" % node.cwd(), "%s/.startup" % node.cwd()], helper=True)])]
+
+        probed = {}
+        for (node, ((pidsuccess, pidoutput), (success, output))) in self.executor.run_plans(plans):
+            if not pidsuccess:
+                self.ui.error("failed to run check-pid on node %s" % node.name)
+                continue
+
+            lines = output.splitlines() if success else []
+            lines += ["", ""]
+
+            info = muxer.process_info(None)
+            info["alive"] = info["zeek"] = pidoutput.strip() == "running"
+            info["status"] = lines[0]
+            info["startup"] = lines[1]
+            probed[node.name] = info
+
+        return [(node, probed.get(node.name)) for node in nodes]
+
     def _waitforzeeks(self, nodes, status, timeout, ensurerunning):
         # If ensurerunning is true, process must still be running.
         if ensurerunning:
@@ -286,17 +355,75 @@ class Controller:
         results = []
 
         # Determine set of nodes still to check.
-        todo = {}
+        todo = []
         for (node, isrunning) in running:
-            if isrunning:
-                todo[node.name] = node
+            if isrunning and node.getPID():
+                todo += [node]
             else:
                 results += [(node, False)]
 
+        # The waiting is done on the hosts (see the "wait-status" operation
+        # of the muxer), with one call per host for all of its nodes.  As each
+        # call has to finish within the command timeout, a longer wait is
+        # split into several calls.
+        deadline = time.time() + timeout
+        maxwait = max(self.config.commandtimeout // 2, 1)
+        unknown = []
+
+        while todo:
+            hosts = {}
+            for node in sorted(todo, key=node_mod.sortnode):
+                hosts.setdefault(node.addr, []).append(node)
+
+            wait = min(max(deadline - time.time(), 0), maxwait)
+            cmds = []
+            for hostnodes in hosts.values():
+                args = [[node.cwd(), int(node.getPID()), status] for node in hostnodes]
+                cmds += [(hostnodes[0], "wait-status", [args, wait])]
+
+            todo = []
+            for (node, success, output) in self.executor.run_builtins(cmds):
+                hostnodes = hosts[node.addr]
+                if not success:
+                    # We don't know the status of these nodes, so check them
+                    # one by one instead.
+                    logging.debug("wait-status failed on host %s: %s", node.host, output)
+                    unknown += hostnodes
+                    continue
+
+                for (n, res) in zip(hostnodes, output):
+                    if res == "timeout":
+                        todo += [n]
+                    else:
+                        results += [(n, res == "reached")]
+
+            if time.time() >= deadline:
+                break
+
+            logging.debug("Waiting for %d node(s)...", len(todo))
+
+        if unknown:
+            results += self._pollzeeks(unknown, status, max(deadline - time.time(), 0))
+
+        for node in todo:
+            # These did time-out.
+            results += [(node, False)]
+
+        if todo:
+            logging.debug("Timeout while waiting for %d node(s)", len(todo))
+
+        return results
+
+    # Wait for the given nodes to reach the given status by checking their
+    # .status files once per second (used when the "wait-status" operation
+    # cannot be run on a host).
+    def _pollzeeks(self, nodes, status, timeout):
+        results = []
+        todo = dict((node.name, node) for node in nodes)
+
         while True:
             # Determine whether process is still running. We need to do this
             # before we get the state to avoid a race condition.
-
             nodelist = sorted(todo.values(), key=node_mod.sortnode)
             running = self._isrunning(nodelist, setcrashed=False)
 
@@ -326,17 +453,12 @@ class Controller:
                     del todo[node.name]
                     results += [(node, False)]
 
-            if not todo:
-                # All done.
+            if not todo or timeout <= 0:
                 break
 
             # Wait a bit before we start over.
             time.sleep(1)
-
-            # Timeout reached?
             timeout -= 1
-            if timeout <= 0:
-                break
 
             logging.debug("Waiting for %d node(s)...", len(todo))
 
@@ -344,9 +466,6 @@ class Controller:
             # These did time-out.
             results += [(node, False)]
 
-        if todo:
-            logging.debug("Timeout while waiting for %d node(s)", len(todo))
-
         return results
 
     def _log_action(self, node, action):
@@ -457,6 +576,12 @@ class Controller:
         # Helper function to stop nodes with given signal.
         def stop(nodes, signal):
             cmds = []
+            if self.config.nativehelpers:
+                for node in nodes:
+                    cmds += [(node, "stop", [int(node.getPID()), signal])]
+
+                return self.executor.run_builtins(cmds)
+
             for node in nodes:
                 cmds += [(node, "stop", [str(node.getPID()), str(signal)])]
 
@@ -471,9 +596,6 @@ class Controller:
                 results.set_node_fail(node)
                 running.remove(node)
 
-        if running:
-            time.sleep(1)
-
         # Check whether they terminated.
         terminated = []
         kill = []
@@ -562,38 +684,36 @@ class Controller:
         if showall:
             self.ui.info("Getting process status ...")
 
-        nodestatus = self._isrunning(nodes)
+        nodestatus = self._probe_running(nodes)
         running = []
 
-        cmds = []
-        for (node, isrunning) in nodestatus:
-            if isrunning:
-                running += [node]
-                cmds += [(node, "first-line", ["%s/.status" % node.cwd(), "%s/.startup" % node.cwd()])]
-
         statuses = {}
         startups = {}
-        for (n, success, output) in self.executor.run_helper(cmds):
-            out = output.splitlines()
+        for (node, isrunning, info) in nodestatus:
+            if not isrunning:
+                continue
+
+            running += [node]
+
             try:
-                val = out[0].split()[0].lower() if (success and out[0]) else "???"
+                val = info["status"].split()[0].lower() if info["status"] else "???"
             except IndexError:
                 val = "???"
 
-            statuses[n.name] = val
+            statuses[node.name] = val
 
             try:
-                val = fmttime(out[1]) if (success and out[1]) else "???"
-            except (IndexError, ValueError):
+                val = fmttime(info["startup"]) if info["startup"] else "???"
+            except ValueError:
                 val = "???"
 
-            startups[n.name] = val
+            startups[node.name] = val
 
         if showall:
             self.ui.info("Getting peer status ...")
             peers = {}
             nodes = [n for n in running if statuses[n.name] == "running"]
-            for (node, success, args) in self._query_peerstatus(nodes):
+            for (node, success, args) in self._query_peerstatus(nodes, False):
                 if success and args:
                     peers[node.name] = []
                     for f in args[0].split():
@@ -604,7 +724,7 @@ class Controller:
                         if val:
                             peers[node.name] += [val]
 
-        for (node, isrunning) in nodestatus:
+        for (node, isrunning, info) in nodestatus:
             node_info = {
                 "name": node.name,
                 "type": node.type,
@@ -704,20 +824,40 @@ class Controller:
 
         return results
 
-    def _query_peerstatus(self, nodes):
-        running = self._isrunning(nodes)
+    # Send events to the nodes (see events.send_events_parallel).
+    def _send_events(self, eventlist):
+        if self.control_session:
+            return self.control_session.send_events(eventlist)
+
+        return events.send_events_parallel(eventlist, config.Config.controltopic)
+
+    # If checkrunning is false, then the nodes are known to be running.
+    def _query_peerstatus(self, nodes, checkrunning=True):
+        if checkrunning:
+            running = self._isrunning(nodes)
+        else:
+            running = [(node, True) for node in nodes]
 
         eventlist = []
         for (node, isrunning) in running:
             if isrunning:
                 eventlist += [(node, "Control::peer_status_request", [], "Control::peer_status_response")]
 
-        return events.send_events_parallel(eventlist, config.Config.controltopic)
+        return self._send_events(eventlist)
 
-    def execute_cmd(self, nodes, cmd):
+    # If "callback" is given, it is called with (node, success, output) for
+    # each node as soon as the output of that node (and of all nodes preceding
+    # it) is available, and the output is not stored in the results.
+    def execute_cmd(self, nodes, cmd, callback=None):
         results = cmdresult.CmdResult()
 
-        for node, success, out in self.executor.run_shell_cmds([(n, cmd) for n in nodes]):
+        # With a callback, report each host as soon as it has finished, so
+        # that fast hosts don't wait for the slowest one.
+        cmds = [(n, cmd, []) for n in nodes]
+        for node, success, out in self.executor.iter_cmds(cmds, shell=True, ordered=not callback):
+            if callback:
+                callback(node, success, out)
+                out = ""
             results.set_node_output(node, success, out)
 
         return results
@@ -726,17 +866,6 @@ class Controller:
     # If cleantmp is true, also wipes ${tmpdir}; this is done
     # even when the node is still running.
     def cleanup(self, nodes, cleantmp=False):
-        # Given a set of node names "orig" and command results "res", add
-        # all node names to "orig" that have a failed result in "res".
-        def addfailed(orig, res):
-            for (node, status, output) in res:
-                # if status is Fail, then add the node name
-                if not status:
-                    orig.add(node.name)
-
-            return orig
-
-
         results = cmdresult.CmdResult()
 
         result = self._isrunning(nodes)
@@ -746,22 +875,47 @@ class Controller:
         for node in running:
             self.ui.info("   %s is still running, not cleaning work directory" % node)
 
-        results1 = self.executor.rmdirs([(n, n.cwd()) for n in notrunning])
-        results2 = self.executor.mkdirs([(n, n.cwd()) for n in notrunning])
+        if cleantmp:
+            self.ui.info("cleaning %s ..." % self.config.tmpdir)
+
+        # Each node's work directory and (once per host) the tmpdir are
+        # cleaned in a single request per host.
+        plans = []
+        # Maps each host to the node whose plan cleans the tmpdir, and the
+        # index of the first tmpdir step in that plan.
+        tmphosts = {}
+        for node in notrunning + running:
+            steps = []
+            if node in notrunning:
+                steps += [execute.rmdir_step(node.cwd(), False), execute.mkdir_step(node.cwd(), False)]
+
+            if cleantmp and node.host not in tmphosts:
+                tmphosts[node.host] = (node, len(steps))
+                steps += [execute.rmdir_step(self.config.tmpdir, False), execute.mkdir_step(self.config.tmpdir, False)]
+
+            if steps:
+                plans.append((node, steps))
+
         failed = set()
-        failed = addfailed(failed, results1)
-        failed = addfailed(failed, results2)
+        tmpfailed = set()
+        for (node, stepresults) in self.executor.run_plans(plans):
+            tmpnode, tmpidx = tmphosts.get(node.host, (None, len(stepresults)))
+            if tmpnode is not node:
+                tmpidx = len(stepresults)
+
+            if not all(success for (success, output) in stepresults[:tmpidx]):
+                failed.add(node.name)
+            if not all(success for (success, output) in stepresults[tmpidx:]):
+                tmpfailed.add(node.host)
+
+        # A failure to clean the tmpdir affects all nodes on that host.
+        for node in running + notrunning:
+            if node.host in tmpfailed:
+                failed.add(node.name)
 
         for node in notrunning:
             node.clearCrashed()
 
-        if cleantmp:
-            self.ui.info("cleaning %s ..." % self.config.tmpdir)
-            results3 = self.executor.rmdirs([(n, self.config.tmpdir) for n in running + notrunning])
-            results4 = self.executor.mkdirs([(n, self.config.tmpdir) for n in running + notrunning])
-            failed = addfailed(failed, results3)
-            failed = addfailed(failed, results4)
-
         for node in nodes:
             if node.name in failed:
                 results.set_node_fail(node)
@@ -770,28 +924,32 @@ class Controller:
 
         return results
 
-    # Report diagnostics for nodes (e.g., stderr output).
-    def diag(self, nodes):
+    # Report diagnostics for nodes (e.g., stderr output).  The "callback" is
+    # used in the same way as for execute_cmd.
+    def diag(self, nodes, callback=None):
         results = cmdresult.CmdResult()
 
         crashdiag = os.path.join(self.config.scriptsdir, "crash-diag")
         cmds = [(node, crashdiag, [node.cwd()]) for node in nodes]
 
-        for (node, success, output) in self.executor.run_cmds(cmds):
+        for (node, success, output) in self.executor.iter_cmds(cmds, ordered=not callback):
             if not success:
                 errmsgs = "error running crash-diag for %s\n" % node.name
                 errmsgs += output
-                results.set_node_output(node, False, errmsgs)
-                continue
+                output = errmsgs
 
-            results.set_node_output(node, True, output)
+            if callback:
+                callback(node, success, output)
+                output = ""
+
+            results.set_node_output(node, success, output)
 
         return results
 
     def capstats(self, nodes, interval):
         results = cmdresult.CmdResult()
 
-        if not self.config.capstatspath:
+        if not self.config.capstatspath and self._nic_stats_mode() == "capstats":
             results.set_node_data(nodes[0], False, {"output": 'Error: cannot run capstats because zeekctl option "capstatspath" is not defined'})
             return results
 
@@ -818,31 +976,67 @@ class Controller:
     # If there is more than one node, then the results will also contain
     # one "pseudo-node" of the name "$total" with the sum of all individual
     # values.
-    def get_capstats_output(self, nodes, interval):
+    #
+    # If CapstatsCollect is enabled, then the values are the averages over
+    # the samples taken by the capstats collectors on the hosts during the
+    # last "collected" seconds (by default, "interval"), and for each tag
+    # "<tag>-min" and "<tag>-max" are the minimum and maximum.  For
+    # interfaces for which there are no samples yet (because the collector
+    # was just started), capstats is run for the interval, unless
+    # "collected" is given (by the cron command, which then reports an
+    # error for them instead of capturing twice).
+    #
+    # For interfaces whose kernel counters are used instead of capstats (see
+    # NICStats), the tags are those of the muxer's "nic-stats" operation.
+    def get_capstats_output(self, nodes, interval, collected=None):
         results = []
 
+        capstats = self.config.capstatspath
+        mode = self._nic_stats_mode()
+
         # Construct a list of (node, interface) tuples, one tuple for each
-        # unique (host, interface) pair.
+        # unique (host, interface) pair (separately for capstats and for
+        # the kernel counters).
         nodenetifs = []
+        nicnetifs = []
         hosts = {}
         for node in nodes:
             if not node.interface:
                 continue
 
             netif = self._capstats_interface(node)
+            netifs = nodenetifs
+
+            if mode == "kernel" or (mode == "auto" and not netif):
+                netif = self._nic_interface(node)
+                netifs = nicnetifs
+
             if not netif:
                 continue
 
             if hosts.setdefault((node.addr, netif), node) == node:
-                nodenetifs.append((node, netif))
+                netifs.append((node, netif))
+
+        if nicnetifs:
+            results += self._nic_stats(nicnetifs, interval)
+
+        if not capstats:
+            nodenetifs = []
+
+        if nodenetifs and self.config.capstatscollect and self.config.nativehelpers:
+            samples, nodenetifs = self._collected_capstats(nodenetifs, collected or interval)
+            results += samples
+
+            if nodenetifs and collected:
+                results += [(node, netif, False, "%s: no capstats samples yet (collector just started)" % node.name) for (node, netif) in nodenetifs]
+                nodenetifs = []
+            elif nodenetifs:
+                self.ui.info("no capstats samples yet for %s, measuring for %d seconds ..." % (", ".join(node.name for (node, netif) in nodenetifs), interval))
 
-        capstats = self.config.capstatspath
         cmds = [(node, capstats, ["-I", str(interval), "-n", "1", "-i", interface]) for (node, interface) in nodenetifs]
 
         outputs = self.executor.run_cmds(cmds)
 
-        totals = {}
-
         for (node, success, output) in outputs:
             netif = self._capstats_interface(node)
 
@@ -873,13 +1067,7 @@ class Controller:
             try:
                 for field in fields:
                     key, val = field.split("=")
-                    val = float(val)
-                    vals[key] = val
-
-                    if key in totals:
-                        totals[key] += val
-                    else:
-                        totals[key] = val
+                    vals[key] = float(val)
 
             except ValueError:
                 results += [(node, netif, False, "%s: unexpected capstats output: %s" % (node.name, outputline))]
@@ -889,10 +1077,101 @@ class Controller:
 
         # Add pseudo-node for totals when there is more than one result
         if len(results) > 1:
+            totals = {}
+            for (node, netif, success, vals) in results:
+                if not success:
+                    continue
+                for (key, val) in vals.items():
+                    # The sum of minimums or maximums doesn't mean much.
+                    if not key.endswith("-min") and not key.endswith("-max"):
+                        totals[key] = totals.get(key, 0.0) + val
+
             results += [(node_mod.Node(self.config, "$total"), None, True, totals)]
 
         return results
 
+    # Returns how interface statistics are obtained (see NICStats), taking
+    # into account that the kernel counters require the NativeHelpers.
+    def _nic_stats_mode(self):
+        if not self.config.nativehelpers:
+            return "capstats"
+        return self.config.nicstats
+
+    # Measure the traffic on the given interfaces (a list of (node, netif)
+    # tuples) with the kernel counters (once per host).  Returns results as
+    # get_capstats_output (without totals).
+    def _nic_stats(self, nodenetifs, interval):
+        results = []
+
+        hosts = {}
+        for (node, netif) in nodenetifs:
+            hosts.setdefault(node.addr, []).append((node, netif))
+
+        cmds = []
+        for hostnetifs in hosts.values():
+            cmds += [(hostnetifs[0][0], "nic-stats", [[netif for (node, netif) in hostnetifs], interval, self.config.nicstatsethtool])]
+
+        for (node, success, output) in self.executor.run_builtins(cmds):
+            hostnetifs = hosts[node.addr]
+
+            if not success:
+                errmsg = output.splitlines()[0] if output else ""
+                results += [(n, netif, False, "%s: cannot get interface statistics (%s)" % (n.name, errmsg)) for (n, netif) in hostnetifs]
+                continue
+
+            for ((n, netif), vals) in zip(hostnetifs, output):
+                if "error" in vals:
+                    results += [(n, netif, False, "%s: %s" % (n.name, vals["error"]))]
+                else:
+                    results += [(n, netif, True, vals)]
+
+        return results
+
+    # Get the statistics of the last "interval" seconds from the capstats
+    # collectors (see get_capstats_output).  Returns a tuple (results,
+    # remaining), where "results" has the same form as the result of
+    # get_capstats_output (without totals), and "remaining" is the list of
+    # (node, netif) tuples for which there are no samples yet.
+    def _collected_capstats(self, nodenetifs, interval):
+        results = []
+        remaining = []
+
+        netifs = dict((node.name, netif) for (node, netif) in nodenetifs)
+        args = [self.config.capstatspath, self.config.tmpdir, self.config.capstatshistory, interval]
+        cmds = [(node, "capstats", args[:1] + [netif] + args[1:]) for (node, netif) in nodenetifs]
+
+        for (node, success, output) in self.executor.run_builtins(cmds):
+            netif = netifs[node.name]
+
+            if not success:
+                results += [(node, netif, False, "%s: capstats failed (%s)" % (node.name, output.strip()))]
+            elif "error" in output:
+                results += [(node, netif, False, "%s: capstats failed (%s)" % (node.name, output["error"]))]
+            elif not output["samples"]:
+                remaining += [(node, netif)]
+            else:
+                vals = dict(output["avg"])
+                for (key, val) in output["min"].items():
+                    vals["%s-min" % key] = val
+                for (key, val) in output["max"].items():
+                    vals["%s-max" % key] = val
+                results += [(node, netif, True, vals)]
+
+        return results, remaining
+
+
+    # Convert a Zeek network interface name to the name of the network
+    # device whose kernel counters can be used.
+    def _nic_interface(self, node):
+        netif = node.interface
+
+        if "::" in netif:
+            # Remove the packet source prefix (e.g. "pf_ring::") and any
+            # device prefix like "zc:".
+            netif = netif.split("::", 1)[1].split(":")[-1]
+
+        # Remove a cluster or queue suffix (e.g. "eth0@1").
+        return netif.split("@", 1)[0]
 
     # Convert a Zeek network interface name to one that capstats can use.
     def _capstats_interface(self, node):
@@ -945,32 +1224,20 @@ class Controller:
                     if not os.path.exists(path):
                         continue
 
-                cmds += [(node, "df", [path])]
-
-        for (node, success, output) in self.executor.run_helper(cmds):
-            if success:
-                fields = output.split()
-                if len(fields) != 4:
-                    df[node.name]["FAIL"] = "wrong number of fields from df helper"
-                    continue
+                cmds += [(node, path)]
 
-                fs = fields[0]
-                # Ignore NFS mounted volumes.
-                if not fs.startswith("/") and ":" in fs:
-                    continue
+        for (node, error, fields) in self._disk_usage(cmds):
+            if error:
+                df[node.name]["FAIL"] = error
+                continue
 
-                try:
-                    total = float(fields[1])
-                    used = float(fields[2])
-                    avail = float(fields[3])
-                except ValueError as err:
-                    df[node.name]["FAIL"] = "bad output from df helper: %s" % err
-                    continue
+            fs, total, used, avail = fields
+            # Ignore NFS mounted volumes.
+            if not fs.startswith("/") and ":" in fs:
+                continue
 
-                perc = used * 100.0 / (used + avail)
-                df[node.name][fs] = DiskInfo(fs, total, used, avail, perc)
-            else:
-                df[node.name]["FAIL"] = output if output else "no output"
+            perc = used * 100.0 / (used + avail)
+            df[node.name][fs] = DiskInfo(fs, total, used, avail, perc)
 
         for node in nodes:
             success = "FAIL" not in df[node.name]
@@ -978,10 +1245,62 @@ class Controller:
 
         return results
 
+    # Gets the disk usage of the file systems that contain the given paths.
+    # nodepaths:  a list of the form [ (node, path), ... ]
+    #
+    # Returns a list of the form [ (node, error, fields), ... ] where "error"
+    # is an error message (or None) and "fields" is a tuple (fs, total,
+    # used, avail) with the sizes in bytes.
+    def _disk_usage(self, nodepaths):
+        results = []
+
+        if self.config.nativehelpers:
+            # One call per node for all of its paths.
+            paths = {}
+            for (node, path) in nodepaths:
+                paths.setdefault(node.name, (node, []))[1].append(path)
+
+            cmds = [(node, "df", [nodedirs]) for (node, nodedirs) in paths.values()]
+
+            for (node, success, output) in self.executor.run_builtins(cmds):
+                if not success:
+                    results += [(node, output if output else "no output", None)]
+                    continue
+
+                for du in output:
+                    if "error" in du:
+                        results += [(node, du["error"], None)]
+                    else:
+                        results += [(node, None, (du["fs"], float(du["total"]), float(du["used"]), float(du["available"])))]
+
+            return results
+
+        cmds = [(node, "df", [path]) for (node, path) in nodepaths]
+
+        for (node, success, output) in self.executor.run_helper(cmds):
+            if not success:
+                results += [(node, output if output else "no output", None)]
+                continue
+
+            fields = output.split()
+            if len(fields) != 4:
+                results += [(node, "wrong number of fields from df helper", None)]
+                continue
+
+            try:
+                results += [(node, None, (fields[0], float(fields[1]), float(fields[2]), float(fields[3])))]
+            except ValueError as err:
+                results += [(node, "bad output from df helper: %s" % err, None)]
+
+        return results
+
     # Returns a list of tuples of the form (node, error, vals) where 'error' is
     # an error message string, or None if there was no error.  'vals' is a
     # dict which maps tags to their values.  Tags are "pid", "vsize",
-    # "rss", "cpu", and "cmd".
+    # "rss", "cpu", and "cmd".  If the NativeHelpers option is enabled, then
+    # the tags can also include "ctxsw" and "majflt" (context switches and
+    # major page faults per second), and "threads" (a list of dicts with the
+    # tags "tid", "cmd", "cpu", "ctxsw", and "majflt" for each thread).
     def get_top_output(self, nodes):
 
         results = []
@@ -1002,6 +1321,9 @@ class Controller:
         if not pids:
             return results
 
+        if self.config.nativehelpers:
+            return results + self._native_top(nodes, pids)
+
         cmds = []
         hosts = {}
 
@@ -1076,11 +1398,138 @@ class Controller:
 
         return results
 
+    # Same as the second part of get_top_output (after getting the PIDs), but
+    # using the "top" operation of the muxer (once per host).
+    def _native_top(self, nodes, pids):
+        results = []
+
+        hosts = {}
+        for node in nodes:
+            if node.name in pids:
+                hosts.setdefault(node.host, []).append(node)
+
+        cmds = []
+        for hostnodes in hosts.values():
+            cmds += [(hostnodes[0], "top", [[int(pids[n.name]) for n in hostnodes], self.config.topinterval])]
+
+        res = {}
+        for (node, success, output) in self.executor.run_builtins(cmds):
+            hostnodes = hosts[node.host]
+
+            if not success:
+                errmsg = output.splitlines()[0] if output else ""
+                for n in hostnodes:
+                    res[n.name] = ("top failed: %s" % errmsg, {})
+                continue
+
+            for (n, proc) in zip(hostnodes, output):
+                res[n.name] = self._top_vals(proc)
+
+        for node in nodes:
+            if node.name in res:
+                results += [(node,) + res[node.name]]
+
+        return results
+
+    # Convert the result of the muxer's "top" operation for one process into
+    # a tuple (error, vals) as in get_top_output.
+    def _top_vals(self, proc):
+        if not proc:
+            # It's possible that the process is no longer there.
+            return ("not running", {})
+
+        vals = {}
+        vals["pid"] = proc["pid"]
+        vals["vsize"] = proc["vsize"] or 0
+        vals["rss"] = proc["rss"] or 0
+        vals["cpu"] = "%d" % (proc["cpu"] or 0)
+        vals["cmd"] = proc["name"]
+
+        for key in ("ctxsw", "majflt"):
+            if proc[key] is not None:
+                vals[key] = int(proc[key])
+
+        vals["threads"] = []
+        for thread in proc["threads"]:
+            tvals = {"tid": thread["tid"], "cmd": thread["name"]}
+            tvals["cpu"] = "%d" % (thread["cpu"] or 0)
+            for key in ("ctxsw", "majflt"):
+                if thread[key] is not None:
+                    tvals[key] = int(thread[key])
+            vals["threads"] += [tvals]
+
+        return (None, vals)
+
+    # Same as top, but keeps sampling the nodes' processes with the
+    # "top-stream" operation of the muxer (once per host), and calls
+    # "callback" with an updated CmdResult whenever a host sends a new
+    # sample.  This stops when the callback returns False (in which case
+    # True is returned), or when all the samplers have finished (e.g.,
+    # because the processes have terminated, or after TOP_STREAM_DURATION
+    # seconds), in which case False is returned.
+    #
+    # The node state is not modified, so this doesn't need the lock.
+    def top_stream(self, nodes, callback):
+        toplist = {}
+        pids = {}
+
+        for (node, isrunning) in self._isrunning(nodes, setcrashed=False):
+            if isrunning:
+                pids[node.name] = node.getPID()
+            else:
+                toplist[node.name] = ("not running", {})
+
+        hosts = {}
+        for node in nodes:
+            if node.name in pids:
+                hosts.setdefault(node.host, []).append(node)
+
+        cmds = []
+        for hostnodes in hosts.values():
+            args = [[int(pids[n.name]) for n in hostnodes], self.config.topinterval, TOP_STREAM_DURATION]
+            cmds += [(hostnodes[0], "top-stream", args)]
+
+        def update():
+            toplist2 = [(node,) + toplist[node.name] for node in nodes if node.name in toplist]
+            return callback(self._top_results(toplist2))
+
+        if not cmds:
+            update()
+            return False
+
+        active = set(hosts)
+
+        for (node, success, output) in self.executor.stream_builtins(cmds, TOP_STREAM_DURATION + self.config.commandtimeout):
+            hostnodes = hosts[node.host]
+
+            if success is None:
+                for (n, proc) in zip(hostnodes, output):
+                    toplist[n.name] = self._top_vals(proc)
+            elif success:
+                active.discard(node.host)
+                continue
+            else:
+                active.discard(node.host)
+                errmsg = output.splitlines()[0] if output else ""
+                for n in hostnodes:
+                    toplist[n.name] = ("top failed: %s" % errmsg, {})
+
+            if not update():
+                self.executor.cancel([hosts[host][0] for host in active])
+                return True
+
+        return False
+
     # Produce a top-like output for node's processes.
     def top(self, nodes):
+        return self._top_results(self.get_top_output(nodes))
+
+    # Convert a list of tuples (node, error, vals) as returned by
+    # get_top_output into a CmdResult.
+    def _top_results(self, toplist):
         results = cmdresult.CmdResult()
 
-        for (node, error, vals) in self.get_top_output(nodes):
+        for (node, error, vals) in toplist:
             top_info = {"name": node.name, "type": node.type,
                         "host": node.host, "pid": None,
                         "vsize": None, "rss": None, "cpu": None,
@@ -1110,7 +1559,7 @@ class Controller:
             results.set_node_output(nodes[0], False, "no running instances of Zeek")
             return results
 
-        for (node, success, args) in events.send_events_parallel(eventlist, config.Config.controltopic):
+        for (node, success, args) in self._send_events(eventlist):
             if success:
                 out = "\n".join(args)
             else:
@@ -1128,7 +1577,7 @@ class Controller:
             if isrunning:
                 eventlist += [(node, "Control::net_stats_request", [], "Control::net_stats_response")]
 
-        return events.send_events_parallel(eventlist, config.Config.controltopic)
+        return self._send_events(eventlist)
 
     def peerstatus(self, nodes):
         results = cmdresult.CmdResult()
@@ -1164,6 +1613,39 @@ class Controller:
 
         return results
 
+    # Get the packet counters of the nodes (see netstats).
+    #
+    # Returns a list of tuples of the form (node, success, vals), where
+    # "vals" is a dictionary that maps "recvd", "dropped", and "link" to the
+    # numbers of packets received, dropped, and seen on the link, or an
+    # error message if "success" is False.  Nodes that are not running are
+    # not included.
+    def get_netstats_output(self, nodes):
+        results = []
+
+        for (node, success, args) in self._query_netstats(nodes):
+            if not success:
+                results += [(node, False, args)]
+                continue
+
+            out = args[0].strip() if args else ""
+            vals = {}
+            try:
+                # The first field is a timestamp.
+                for field in out.split()[1:]:
+                    key, val = field.split("=")
+                    vals[key] = int(val)
+            except ValueError:
+                vals = {}
+
+            if not all(key in vals for key in ("recvd", "dropped", "link")):
+                results += [(node, False, "unexpected netstats output: %s" % out)]
+                continue
+
+            results += [(node, True, vals)]
+
+        return results
+
     def process(self, trace, zeek_options, zeek_scripts):
         results = cmdresult.CmdResult()
 
@@ -45,11 +45,22 @@ class CronTasks:
         nodes = self.config.nodes()
         top = self.controller.get_top_output(nodes)
 
-        have_capstats = self.config.capstatspath
-        capstats = []
-
-        if have_capstats:
-            capstats = self.controller.get_capstats_output(nodes, interval)
+        collected = None
+        if self.config.capstatscollect and self.config.nativehelpers:
+            # Report the statistics since the previous cron run.
+            now = time.time()
+            last = self.config.get_state("capstats-lastcron", default=0)
+            collected = int(min(max(now - last, interval), self.config.capstatshistory))
+            self.config.set_state("capstats-lastcron", now)
+
+        capstats = self.controller.get_capstats_output(nodes, interval, collected)
+
+        netstats = []
+        if self.config.statslognetstats:
+            if self.config.standalone:
+                netstats = self.controller.get_netstats_output(nodes)
+            else:
+                netstats = self.controller.get_netstats_output(self.config.workers())
 
         t = time.time()
 
@@ -57,8 +68,16 @@ class CronTasks:
             with open(self.config.statslog, "a") as out:
                 for (node, error, vals) in top:
                     if not error:
+                        threads = vals.pop("threads", [])
                         for (val, key) in sorted(vals.items()):
                             out.write("%s %s parent %s %s\n" % (t, node, val, key))
+
+                        # Only log the threads of multi-threaded processes.
+                        if len(threads) > 1:
+                            for thread in threads:
+                                tid = thread.pop("tid")
+                                for (val, key) in sorted(thread.items()):
+                                    out.write("%s %s thread-%s %s %s\n" % (t, node, tid, val, key))
                     else:
                         out.write("%s %s error error %s\n" % (t, node, error))
 
@@ -85,10 +104,61 @@ class CronTasks:
 
                             self.config.set_state(tag, val)
 
+                for (node, success, vals) in netstats:
+                    if not success:
+                        out.write("%s %s error error %s\n" % (t, node, vals))
+                        continue
+
+                    for (key, val) in sorted(vals.items()):
+                        out.write("%s %s netstats %s %s\n" % (t, node, key, val))
+
+                    # The counters since the last time.
+                    tag = "netstats-%s" % node.name
+                    last = self.config.get_state(tag)
+                    self.config.set_state(tag, vals)
+
+                    if not last:
+                        continue
+
+                    deltas = {}
+                    for (key, val) in vals.items():
+                        deltas[key] = val - last.get(key, 0)
+                        if deltas[key] < 0:
+                            # The node was restarted.
+                            deltas[key] = val
+
+                    for (key, val) in sorted(deltas.items()):
+                        out.write("%s %s netstats %s-delta %s\n" % (t, node, key, val))
+
+                    # Not all packet sources count the packets on the link.
+                    total = deltas["link"] or deltas["recvd"] + deltas["dropped"]
+                    perc = 100.0 * deltas["dropped"] / total if total else 0.0
+                    out.write("%s %s netstats drop-percent %.2f\n" % (t, node, perc))
+
+                    self.check_drops(node, perc)
+
         except IOError as err:
             self.ui.error("failed to append to file: %s" % err)
             return
 
+    # Report if the percentage of packets that a node has dropped since the
+    # last cron run rises above MaxDropPercent (or falls below it again).
+    def check_drops(self, node, perc):
+        maxperc = self.config.maxdroppercent
+        if maxperc == 0:
+            return
+
+        tag = "dropping-%s" % node.name
+        dropping = self.config.get_state(tag, default=False)
+
+        if perc > maxperc and not dropping:
+            self.ui.info("%s dropped %.1f%% of its packets since the last check" % (node.name, perc))
+
+        if perc <= maxperc and dropping:
+            self.ui.info("%s is no longer dropping more than %d%% of its packets" % (node.name, maxperc))
+
+        self.config.set_state(tag, perc > maxperc)
+
     def check_disk_space(self):
         minspace = self.config.mindiskspace
         if minspace == 0:
@@ -1,4 +1,6 @@
 import logging
+import select
+import time
 
 from ZeekControl import config
 
@@ -31,77 +33,197 @@ except ImportError as e:
 
 def send_events_parallel(events, topic):
 
-    results = []
-    sent = []
-
-    for (node, event, args, result_event) in events:
-
+    if not broker:
+        return _no_broker(events)
+
+    # Each node gets its own endpoint (the reply events don't tell which node
+    # sent them), and all of them start peering right away.
+    peerings = [_Peering(node, topic) for (node, event, args, result_event) in events]
+
+    try:
+        return _send_events(peerings, events)
+    finally:
+        for p in peerings:
+            p.shutdown()
+
+def _no_broker(events):
+    return [(node, False, "Python bindings for Broker: %s" % errmsg) for (node, event, args, result_event) in events]
+
+# A persistent Broker session with the nodes, for a long-running process
+# (such as zeekctld) that sends events frequently.  The peering with a node
+# is established when an event is first sent to it (or when "connect" is
+# called), and it is kept afterwards (Broker reestablishes it when the node
+# is restarted), so that sending an event to a node that is peered already
+# costs only the round trip.
+class ControlSession:
+    def __init__(self, topic):
+        self.topic = topic
+        self.peerings = {}
+
+    # Start peering with the given nodes (if not done yet).
+    def connect(self, nodes):
         if not broker:
-            results += [(node, False, "Python bindings for Broker: %s" % errmsg)]
-            continue
+            return
 
-        success, endpoint, sub = _send_event_init(node, event, args, result_event, topic)
+        for node in nodes:
+            self._peering(node)
 
-        if success and result_event:
-            sent += [(node, result_event, endpoint, sub)]
-        else:
-            results += [(node, success, endpoint, sub)]
+    def _peering(self, node):
+        p = self.peerings.get(node.name)
 
-    for (node, result_event, endpoint, sub) in sent:
-        success, result_args = _send_event_wait(node, result_event, endpoint, sub)
-        endpoint.shutdown()
-        results += [(node, success, result_args)]
+        if p and (p.addr, p.port) != (node.addr, node.getPort()):
+            # The node's configuration has changed.
+            p.shutdown()
+            p = None
 
-    return results
+        if not p:
+            p = _Peering(node, self.topic)
+            self.peerings[node.name] = p
 
-def _send_event_init(node, event, args, result_event, topic):
+        p.node = node
+        return p
 
-    host = node.addr
-    endpoint = broker.Endpoint()
-    subscriber = endpoint.make_subscriber(topic)
-    status_subscriber = endpoint.make_status_subscriber(True)
-    endpoint.peer(host, node.getPort(), 1)
+    # Same as send_events_parallel, but using the peerings of the session.
+    def send_events(self, events):
+        if not broker:
+            return _no_broker(events)
 
-    tries = 0
+        return _send_events([self._peering(node) for (node, event, args, result_event) in events], events)
 
-    while True:
-        msgs = status_subscriber.get(1, 1)
-
-        for msg in msgs:
-            if isinstance(msg, broker.Status):
-                if msg.code() == broker.SC.PeerAdded:
-                    ev = broker.zeek.Event(event, *args)
-                    endpoint.publish(topic + "/" + repr(msg.context()), ev)
-                    logging.debug("broker: %s(%s) to node %s", event,
-                                  ", ".join(args), node.name)
-                    return (True, endpoint, subscriber)
+    def close(self):
+        for p in self.peerings.values():
+            p.shutdown()
 
-        tries += 1
+        self.peerings = {}
 
-        if tries > config.Config.commtimeout:
-            return (False, "time-out", None)
+# Sends the events (see send_events_parallel) using the given peerings (one
+# for each event).  Each event is published as soon as its peering is
+# established.
+def _send_events(peerings, events):
+    requests = [_Request(p, event, args, result_event) for (p, (node, event, args, result_event)) in zip(peerings, events)]
 
-def _send_event_wait(node, result_event, bc, sub):
-    if not result_event:
-        return (True, [])
+    # A node that doesn't peer within the CommTimeout, or doesn't reply
+    # within another CommTimeout, has timed out (regardless of how many
+    # other nodes there are).
+    peer_deadline = time.time() + config.Config.commtimeout
+    deadline = peer_deadline + config.Config.commtimeout
 
-    # Wait for reply event.
-    tries = 0
+    # Send to the nodes that are peered already.
+    for r in requests:
+        r.process()
 
     while True:
-        msgs = sub.get(1, 1)
-
-        for msg in msgs:
-            (topic, event) = msg
-            ev = broker.zeek.Event(event)
-            args = ev.args()
-            logging.debug("broker: %s(%s) from node %s", result_event,
-                          ", ".join(args), node.name)
-            return (True, args)
-
-        tries += 1
-
-        if tries > config.Config.commtimeout:
-            logging.debug("broker: timeout during receive from node %s", node.name)
-            return (False, "time-out")
-
+        now = time.time()
+        for r in requests:
+            if not r.done and not r.sent and now >= peer_deadline:
+                r.finish(False, "time-out")
+
+        active = [r for r in requests if not r.done]
+        if not active or now >= deadline:
+            break
+
+        timeout = deadline - now
+        if not all(r.sent for r in active):
+            timeout = min(timeout, peer_deadline - now)
+
+        fds = dict((r.fd(), r) for r in active)
+        for fd in select.select(list(fds), [], [], timeout)[0]:
+            fds[fd].process()
+
+    for r in active:
+        logging.debug("broker: timeout during receive from node %s", r.peering.node.name)
+        r.finish(False, "time-out")
+
+    return [(r.peering.node, r.success, r.result) for r in requests]
+
+# A Broker endpoint that is peered with one node.
+class _Peering:
+    def __init__(self, node, topic):
+        self.node = node
+        self.addr = node.addr
+        self.port = node.getPort()
+        self.topic = topic
+        # The peer's endpoint info while the peering is established.
+        self.peer = None
+
+        self.endpoint = broker.Endpoint()
+        self.subscriber = self.endpoint.make_subscriber(topic)
+        self.status_subscriber = self.endpoint.make_status_subscriber(True)
+        self.endpoint.peer_nosync(self.addr, self.port, 1)
+
+    # Process the status messages that have arrived.  Returns True if the
+    # peering is established.
+    def update_status(self):
+        for msg in self.status_subscriber.poll():
+            if isinstance(msg, broker.Status):
+                if msg.code() == broker.SC.PeerAdded:
+                    self.peer = msg.context()
+                elif msg.code() in (broker.SC.PeerLost, broker.SC.PeerRemoved):
+                    self.peer = None
+
+        return self.peer is not None
+
+    def publish(self, event, args):
+        # Discard any late replies to earlier events.
+        self.subscriber.poll()
+
+        ev = broker.zeek.Event(event, *args)
+        self.endpoint.publish(self.topic + "/" + repr(self.peer), ev)
+        logging.debug("broker: %s(%s) to node %s", event,
+                      ", ".join(args), self.node.name)
+
+    # Returns the args of the first event with the given name that has
+    # arrived, or None if there is none.
+    def receive(self, name):
+        for (topic, data) in self.subscriber.poll():
+            ev = broker.zeek.Event(data)
+            if ev.name() == name:
+                return ev.args()
+
+        return None
+
+    def shutdown(self):
+        self.endpoint.shutdown()
+
+# The state of sending one event (see _send_events).
+class _Request:
+    def __init__(self, peering, event, args, result_event):
+        self.peering = peering
+        self.event = event
+        self.args = args
+        self.result_event = result_event
+        self.sent = False
+        self.done = False
+        self.success = False
+        self.result = None
+
+    # The file descriptor that becomes readable when there is something to
+    # process.
+    def fd(self):
+        if self.sent:
+            return self.peering.subscriber.fd()
+        return self.peering.status_subscriber.fd()
+
+    def process(self):
+        if not self.sent:
+            if self.peering.update_status():
+                self.send()
+            return
+
+        args = self.peering.receive(self.result_event)
+        if args is not None:
+            logging.debug("broker: %s(%s) from node %s", self.result_event,
+                          ", ".join(args), self.peering.node.name)
+            self.finish(True, args)
+
+    def send(self):
+        self.peering.publish(self.event, self.args)
+        self.sent = True
+
+        if not self.result_event:
+            self.finish(True, [])
+
+    def finish(self, success, result):
+        self.done = True
+        self.success = success
+        self.result = result
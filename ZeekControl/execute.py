@@ -1,11 +1,16 @@
 # These modules provides a set of functions to execute actions on a host.
 # If the host is local, it's done direcly; if it's remote we log in via SSH.
 
+import codecs
+import collections
+import json
 import os
 import shutil
 import subprocess
 import logging
 
+from ZeekControl import breaker
+from ZeekControl import muxer
 from ZeekControl import py3zeek
 from ZeekControl import ssh_runner
 from ZeekControl import util
@@ -137,10 +142,40 @@ subprocess.Popen.__del__ = _emptyDel
 
 
 
+# One step of a plan (see Executor.run_plans).  The "cmd", "args", "shell",
+# and "helper" are the same as for Executor.run_cmds.  If "abort" is True and
+# the step fails, then the remaining steps of the plan are skipped.
+class PlanStep:
+    def __init__(self, cmd, args=[], shell=False, helper=False, abort=True):
+        self.cmd = cmd
+        self.args = args
+        self.shell = shell
+        self.helper = helper
+        self.abort = abort
+
+# Returns a PlanStep that creates a directory (see Executor.mkdirs).
+def mkdir_step(dir, abort=True):
+    return PlanStep("mkdir", ["-p", dir], abort=abort)
+
+# Returns a PlanStep that removes a directory (see Executor.rmdirs).
+def rmdir_step(dir, abort=True):
+    return PlanStep("if [ -d %s ]; then rm -rf %s ; fi" % (dir, dir), shell=True, abort=abort)
+
+
 class Executor:
-    def __init__(self, config):
+    # If "heartbeat" is True, then idle connections to the hosts are checked
+    # periodically (for long-running processes like zeekctld).  The
+    # thread-based backend always does this.
+    def __init__(self, config, heartbeat=False):
         self.config = config
-        self.sshrunner = ssh_runner.MultiMasterManager(config.localaddrs)
+        self.breaker = breaker.CircuitBreaker(config)
+        limits = (config.maxhostcommands, config.get_command_limits())
+        args = (config.localaddrs, config.hostlivenessttl, self.breaker, config.localworkers, limits)
+        if config.executorbackend == "asyncio":
+            from ZeekControl import async_runner
+            self.sshrunner = async_runner.AsyncMasterManager(*args, heartbeat=heartbeat)
+        else:
+            self.sshrunner = ssh_runner.MultiMasterManager(*args)
 
     def finish(self):
         self.sshrunner.shutdown_all()
@@ -178,19 +213,7 @@ class Executor:
         nodecmdlist = []
         for host in hostlist:
             for zeeknode, cmd, args in dd[host]:
-                if helper:
-                    cmdargs = [os.path.join(self.config.helperdir, cmd)]
-                else:
-                    cmdargs = [cmd]
-
-                if shell:
-                    if args:
-                        cmdargs = ["%s %s" % (cmdargs[0], " ".join(args))]
-                else:
-                    cmdargs += args
-
-                nodecmdlist.append((zeeknode.addr, cmdargs))
-                logging.debug("%s: %s", zeeknode.host, " ".join(cmdargs))
+                nodecmdlist.append((zeeknode.addr, self._make_cmdargs(zeeknode, cmd, args, shell, helper)))
 
         for host, result in self.sshrunner.exec_multihost_commands(nodecmdlist, shell, self.config.commandtimeout):
             nodecmd = dd[host].pop(0)
@@ -206,6 +229,193 @@ class Executor:
 
         return results
 
+    # Build the argument list for one command of run_cmds.
+    def _make_cmdargs(self, zeeknode, cmd, args, shell, helper):
+        if helper:
+            cmdargs = [os.path.join(self.config.helperdir, cmd)]
+        else:
+            cmdargs = [cmd]
+
+        if shell:
+            if args:
+                cmdargs = ["%s %s" % (cmdargs[0], " ".join(args))]
+        else:
+            cmdargs += args
+
+        logging.debug("%s: %s", zeeknode.host, " ".join(cmdargs))
+        return cmdargs
+
+    # Run a plan (a list of dependent steps) for each node.  The steps of one
+    # plan run one after another, and all plans for the same host are sent to
+    # that host in a single request (the plans themselves run in parallel).
+    #
+    # plans:  a list of the form: [ (node, [step, ...]), ... ]
+    #   where each step is a PlanStep.
+    #
+    # Returns a list of the form: [ (node, [(success, output), ...]), ... ]
+    #   with one tuple per step, where "success" and "output" are the same as
+    #   for run_cmds.  If a step was not run because an earlier step of the
+    #   plan failed (see PlanStep), then "success" is None and "output" is an
+    #   empty string.
+    def run_plans(self, plans):
+        results = []
+
+        if not plans:
+            return results
+
+        dd = {}
+        hostlist = []
+        for node, steps in plans:
+            host = node.addr
+            if host not in dd:
+                dd[host] = []
+                hostlist.append(host)
+            dd[host].append((node, steps))
+
+        nodecmdlist = []
+        for host in hostlist:
+            idx = 0
+            for zeeknode, steps in dd[host]:
+                for i, step in enumerate(steps):
+                    cmd = {"cmd": self._make_cmdargs(zeeknode, step.cmd, step.args, step.shell, step.helper),
+                           "shell": step.shell}
+                    if i > 0:
+                        # Index of the previous step in the host's request.
+                        cmd["after"] = idx - 1
+                        cmd["needok"] = steps[i - 1].abort
+                    nodecmdlist.append((host, cmd))
+                    idx += 1
+
+        hostresults = collections.defaultdict(list)
+        for host, result in self.sshrunner.exec_multihost_commands(nodecmdlist, False, self.config.commandtimeout):
+            if result is None:
+                hostresults[host].append((None, ""))
+            elif isinstance(result, Exception):
+                hostresults[host].append((False, str(result)))
+            else:
+                hostresults[host].append((result.status == 0, result.stdout + result.stderr))
+                logging.debug("%s: exit code %d", host, result.status)
+
+        for host in hostlist:
+            res = hostresults[host]
+            for zeeknode, steps in dd[host]:
+                results.append((zeeknode, res[:len(steps)]))
+                del res[:len(steps)]
+
+        return results
+
+    # Run commands in parallel on one or more hosts, and report their output
+    # as it arrives.
+    #
+    # The arguments are the same as for run_cmds.
+    #
+    # Returns a generator that yields tuples (idx, node, type, data) across
+    # all hosts in the order in which the events occur, where "idx" is the
+    # index of the command in "cmds" and "type" is the frame type.  For
+    # stdout and stderr frames, "data" is the decoded output chunk; for exit
+    # frames it is the exit status, and for error frames it is an error
+    # message.  Commands that were skipped (see run_plans) get an error frame.
+    def _stream_cmds(self, cmds, shell, helper):
+        if not cmds:
+            return
+
+        nodecmdlist = []
+        for zeeknode, cmd, args in cmds:
+            nodecmdlist.append((zeeknode.addr, self._make_cmdargs(zeeknode, cmd, args, shell, helper)))
+
+        decoders = {}
+
+        for idx, ftype, payload in self.sshrunner.stream_multihost_commands(nodecmdlist, shell, self.config.commandtimeout):
+            zeeknode = cmds[idx][0]
+
+            if ftype in (muxer.FRAME_STDOUT, muxer.FRAME_STDERR):
+                if py3zeek.using_py3:
+                    # A chunk might end in the middle of a multibyte character.
+                    key = (idx, ftype)
+                    if key not in decoders:
+                        decoders[key] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                    payload = decoders[key].decode(payload)
+
+                if payload:
+                    yield (idx, zeeknode, ftype, payload)
+                continue
+
+            # The command has finished, so output any incomplete character
+            # left in the decoders.
+            for outtype in (muxer.FRAME_STDOUT, muxer.FRAME_STDERR):
+                decoder = decoders.pop((idx, outtype), None)
+                if decoder:
+                    rest = decoder.decode(b"", True)
+                    if rest:
+                        yield (idx, zeeknode, outtype, rest)
+
+            if ftype == muxer.FRAME_EXIT:
+                status, = muxer.FRAME_STATUS.unpack(payload)
+                logging.debug("%s: exit code %d", zeeknode.host, status)
+                yield (idx, zeeknode, ftype, status)
+
+            elif ftype == muxer.FRAME_SKIPPED:
+                yield (idx, zeeknode, ssh_runner.FRAME_ERROR, "skipped because a previous command failed")
+
+            else:
+                yield (idx, zeeknode, ftype, str(payload))
+
+    # Run commands in parallel on one or more hosts, and return each
+    # command's result as soon as it is available.
+    #
+    # The arguments are the same as for run_cmds.  If "ordered" is True, then
+    # results are returned in the order of "cmds" (each one as soon as it and
+    # all preceding ones have finished); otherwise, in the order in which the
+    # commands finish.
+    #
+    # Returns a generator that yields the same tuples (node, success, output)
+    # as run_cmds returns in a list.
+    def iter_cmds(self, cmds, shell=False, helper=False, ordered=True):
+        stdout = {}
+        stderr = {}
+        finished = {}
+        nextidx = 0
+
+        for (idx, zeeknode, ftype, data) in self._stream_cmds(cmds, shell, helper):
+            if ftype == muxer.FRAME_STDOUT:
+                stdout.setdefault(idx, []).append(data)
+                continue
+            if ftype == muxer.FRAME_STDERR:
+                stderr.setdefault(idx, []).append(data)
+                continue
+
+            output = "".join(stdout.pop(idx, []) + stderr.pop(idx, []))
+            if ftype == muxer.FRAME_EXIT:
+                result = (zeeknode, data == 0, output)
+            else:
+                result = (zeeknode, False, data)
+
+            if not ordered:
+                yield result
+                continue
+
+            finished[idx] = result
+            while nextidx in finished:
+                yield finished.pop(nextidx)
+                nextidx += 1
+
+    # Run commands in parallel on one or more hosts, and pass on their output
+    # as it arrives, without collecting it.
+    #
+    # The arguments are the same as for run_cmds.
+    #
+    # Returns a generator that yields tuples (node, chunk) for each piece of
+    # a command's stdout or stderr (a string, in the order in which the
+    # output arrives), and then one tuple (node, status) once the command has
+    # finished, where "status" is its exit status (an int), or None if it
+    # did not run to completion (e.g. on a timeout; the error message is the
+    # last chunk then).  The events of different commands are interleaved.
+    def stream_cmds(self, cmds, shell=False, helper=False):
+        for (idx, zeeknode, ftype, data) in self._stream_cmds(cmds, shell, helper):
+            yield (zeeknode, data)
+            if ftype == ssh_runner.FRAME_ERROR:
+                yield (zeeknode, None)
+
     # Run shell commands in parallel on one or more hosts.
     # cmdlines:  a list of the form [ (node, cmdline), ... ]
     #   where "cmdline" is a string to be interpreted by the shell
@@ -220,6 +430,115 @@ class Executor:
     def run_helper(self, cmds, shell=False):
         return self.run_cmds(cmds, shell, True)
 
+    # Run built-in operations of the muxer (see muxer.BUILTINS) in parallel
+    # on one or more hosts.
+    #
+    # cmds:  a list of the form: [ (node, name, args), ... ]
+    #   where "name" is the name of the operation and "args" is a list of
+    #   arguments for it (any values that can be represented in JSON).
+    #
+    # Returns a list of results: [(node, success, result), ...]
+    #   where "result" is the value returned by the operation if "success"
+    #   is True, or an error message otherwise.
+    def run_builtins(self, cmds):
+        results = []
+
+        if not cmds:
+            return results
+
+        dd = {}
+        hostlist = []
+        for nodecmd in cmds:
+            host = nodecmd[0].addr
+            if host not in dd:
+                dd[host] = []
+                hostlist.append(host)
+            dd[host].append(nodecmd)
+
+        nodecmdlist = []
+        for host in hostlist:
+            for zeeknode, name, args in dd[host]:
+                logging.debug("%s: builtin %s", zeeknode.host, name)
+                nodecmdlist.append((host, {"builtin": name, "args": args}))
+
+        for host, result in self.sshrunner.exec_multihost_commands(nodecmdlist, False, self.config.commandtimeout):
+            zeeknode = dd[host].pop(0)[0]
+            if isinstance(result, Exception):
+                results.append((zeeknode, False, str(result)))
+            elif result.status != 0:
+                results.append((zeeknode, False, result.stderr))
+            else:
+                try:
+                    results.append((zeeknode, True, json.loads(result.stdout)))
+                except ValueError as e:
+                    results.append((zeeknode, False, "invalid result: %s" % e))
+
+        return results
+
+    # Run streaming built-in operations of the muxer (see
+    # muxer.STREAMING_BUILTINS) in parallel on one or more hosts.
+    #
+    # cmds:  a list of the form: [ (node, name, args), ... ]
+    #   (see run_builtins).
+    # timeout:  the number of seconds after which the operations are stopped
+    #   (instead of the CommandTimeout).
+    #
+    # Returns a generator that yields tuples (node, success, result) in the
+    # order in which the events occur.  For each result that an operation
+    # produces, "success" is None and "result" is its value.  Once an
+    # operation has finished, a final tuple is yielded for it with "success"
+    # being a boolean and "result" being None or an error message.
+    def stream_builtins(self, cmds, timeout):
+        if not cmds:
+            return
+
+        nodecmdlist = []
+        for zeeknode, name, args in cmds:
+            logging.debug("%s: builtin %s", zeeknode.host, name)
+            nodecmdlist.append((zeeknode.addr, {"builtin": name, "args": args, "timeout": timeout}))
+
+        buffers = {}
+        stderr = {}
+
+        for idx, ftype, payload in self.sshrunner.stream_multihost_commands(nodecmdlist, False, self.config.commandtimeout):
+            zeeknode = cmds[idx][0]
+
+            if ftype == muxer.FRAME_STDOUT:
+                # Each result is a line of JSON, which might be split across
+                # several frames.
+                if py3zeek.using_py3:
+                    payload = payload.decode("utf-8", "replace")
+                lines = (buffers.pop(idx, "") + payload).split("\n")
+                buffers[idx] = lines.pop()
+                for line in lines:
+                    try:
+                        yield (zeeknode, None, json.loads(line))
+                    except ValueError as e:
+                        yield (zeeknode, False, "invalid result: %s" % e)
+                        break
+
+            elif ftype == muxer.FRAME_EXIT:
+                status, = muxer.FRAME_STATUS.unpack(payload)
+                if status == 0:
+                    yield (zeeknode, True, None)
+                else:
+                    err = b"".join(stderr.pop(idx, [])).decode("utf-8", "replace")
+                    yield (zeeknode, False, err.strip() or "%s failed" % cmds[idx][1])
+
+            elif ftype == muxer.FRAME_STDERR:
+                stderr.setdefault(idx, []).append(payload)
+
+            elif ftype == muxer.FRAME_SKIPPED:
+                yield (zeeknode, False, "%s skipped" % cmds[idx][1])
+
+            else:
+                yield (zeeknode, False, str(payload))
+
+    # Stop the streaming operations (see stream_builtins) that are currently
+    # running for the given nodes.
+    def cancel(self, nodes):
+        self.sshrunner.cancel(set(node.addr for node in nodes))
+
     # A convenience function that calls run_cmds.
     # dirs:  a list of the form [ (node, dir), ... ]
     #
@@ -257,6 +576,13 @@ class Executor:
 
         return results
 
+    # Returns a list of tuples (host, alive) for all remote hosts that
+    # commands were sent to, or that are considered down by the circuit
+    # breaker.
     def host_status(self):
-        return self.sshrunner.host_status()
+        status = dict(self.sshrunner.host_status())
+        for host in self.breaker.down_hosts():
+            status[host] = False
+
+        return list(status.items())
 
@@ -1,134 +1,228 @@
+import errno
+import fcntl
 import os
+import signal
 import time
 
 from ZeekControl import config
 
-lockCount = 0
+# Number of seconds to wait for the lock before giving up.
+LOCK_TIMEOUT = 30
+
+class _LockTimeout(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise _LockTimeout()
+
+# A lock file that can be locked in shared or exclusive mode (a shared lock
+# can be held by several processes at the same time, an exclusive one only by
+# a single process).  The lock is released by the kernel when the process
+# terminates.
+class _Lock:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.shared = False
+        self.file = None
+
+    # Open (and create, if needed) the lock file.  Return: True on success,
+    # or False on error
+    def open(self, cmdout):
+        lockdir = os.path.dirname(self.path)
+        if not os.path.exists(lockdir):
+            cmdout.info("creating directory for lock file: %s" % lockdir)
+            os.makedirs(lockdir)
 
-# Return: 0 if no lock, >0 for PID of lock, or -1 on error
-def _break_lock(cmdout):
-    from ZeekControl import execute
+        try:
+            self.file = open(self.path, "a+")
+        except IOError as e:
+            cmdout.error("cannot open lock file: %s" % e)
+            return False
 
-    try:
-        # Check whether lock is stale.
-        with open(config.Config.lockfile, "r") as f:
-            pid = f.readline().strip()
+        return True
 
-    except (OSError, IOError) as err:
-        cmdout.error("failed to read lock file: %s" % err)
-        return -1
+    def close(self):
+        self.file.close()
+        self.file = None
 
-    success, output = execute.run_localcmd("%s %s" % (os.path.join(config.Config.helperdir, "check-pid"), pid))
-    if success and output.strip() == "running":
-        # Process still exists.
-        try:
-            return int(pid)
-        except ValueError:
-            return -1
+    # Lock the lock file.  If "block" is True, wait until any conflicting
+    # lock is released.
+    # Return: 1 if lock is acquired, 0 if another process holds a
+    # conflicting lock, or -1 on error
+    def acquire(self, cmdout, shared, block=False):
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not block:
+            mode |= fcntl.LOCK_NB
 
-    cmdout.info("removing stale lock")
-    try:
-        # Break lock.
-        os.unlink(config.Config.lockfile)
-    except (OSError, IOError) as err:
-        cmdout.error("failed to remove lock file: %s" % err)
-        return -1
-
-    return 0
-
-# Return: 0 if lock is acquired, or if failed to acquire lock return >0 for
-# PID of lock, or -1 on error
-def _acquire_lock(cmdout):
-    lockpid = -1
-    pid = str(os.getpid())
-    tmpfile = config.Config.lockfile + "." + pid
-
-    lockdir = os.path.dirname(config.Config.lockfile)
-    if not os.path.exists(lockdir):
-        cmdout.info("creating directory for lock file: %s" % lockdir)
-        os.makedirs(lockdir)
-
-    try:
         try:
-            # This should be NFS-safe.
-            with open(tmpfile, "w") as f:
-                f.write("%s\n" % pid)
-
-            n = os.stat(tmpfile)[3]
-            os.link(tmpfile, config.Config.lockfile)
-            m = os.stat(tmpfile)[3]
-
-            if n == m-1:
+            fcntl.flock(self.file, mode)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
                 return 0
+            cmdout.error("cannot acquire lock: %s" % e)
+            return -1
 
-            # File is locked.
-            lockpid = _break_lock(cmdout)
-            if lockpid == 0:
-                return _acquire_lock(cmdout)
+        if not shared:
+            # Record who holds the lock (for "waiting for lock" messages).
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write("%s\n" % os.getpid())
+            self.file.flush()
 
-        except OSError:
-            # File is already locked.
-            lockpid = _break_lock(cmdout)
-            if lockpid == 0:
-                return _acquire_lock(cmdout)
+        return 1
 
+    def release(self, cmdout):
+        try:
+            if not self.shared:
+                self.file.truncate(0)
+            fcntl.flock(self.file, fcntl.LOCK_UN)
         except IOError as e:
-            cmdout.error("cannot acquire lock: %s" % e)
-            return lockpid
+            cmdout.error("cannot release lock: %s" % e)
 
-    finally:
+    # Returns a description of the process that holds the exclusive lock (if
+    # any) for "waiting for lock" messages.
+    def owner(self):
         try:
-            os.unlink(tmpfile)
-        except (OSError, IOError):
-            pass
-
-    return lockpid
-
-def _release_lock(cmdout):
-    try:
-        os.unlink(config.Config.lockfile)
-    except OSError as e:
-        cmdout.error("cannot remove lock file: %s" % e)
+            with open(self.path, "r") as f:
+                return " (owned by PID %d)" % int(f.readline())
+        except (IOError, ValueError):
+            return ""
+
+    # Wait in the kernel until the lock is released by its holder (or until
+    # the timeout expires), so that we get it as soon as it is free.
+    # Return: 1 if lock is acquired, 0 on timeout, or -1 on error
+    def block(self, cmdout, shared, timeout):
+        try:
+            oldhandler = signal.signal(signal.SIGALRM, _alarm)
+        except ValueError:
+            # Not in the main thread (zeekctld), where signals are delivered,
+            # so there is no way to interrupt a blocking flock.  Poll instead.
+            return self.poll(cmdout, shared, timeout)
 
-def lock(cmdout, showwait=True):
-    global lockCount
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return self.acquire(cmdout, shared, block=True)
+        except _LockTimeout:
+            return 0
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, oldhandler or signal.SIG_DFL)
+
+    def poll(self, cmdout, shared, timeout):
+        for i in range(int(timeout * 10)):
+            time.sleep(0.1)
+            status = self.acquire(cmdout, shared)
+            if status != 0:
+                return status
+
+        return 0
+
+    # Return: True if lock is acquired, or False on error or timeout
+    def wait(self, cmdout, showwait, shared):
+        status = self.acquire(cmdout, shared)
+        if status != 0:
+            return status == 1
 
-    if lockCount > 0:
-        # Already locked.
-        lockCount += 1
+        if showwait:
+            cmdout.info("waiting for lock%s ..." % self.owner())
+
+        return self.block(cmdout, shared, LOCK_TIMEOUT) == 1
+
+    def lock(self, cmdout, showwait, shared):
+        if self.count > 0:
+            # Already locked.
+            if self.shared and not shared:
+                # Need to upgrade to an exclusive lock.  Note that flock
+                # releases the shared lock first, so if that fails, we have to
+                # get it back.
+                if not self.wait(cmdout, showwait, False):
+                    if not self.wait(cmdout, False, True):
+                        cmdout.error("lost the shared lock on %s" % self.path)
+                    return False
+                self.shared = False
+
+            self.count += 1
+            return True
+
+        if not self.open(cmdout):
+            return False
+
+        if not self.wait(cmdout, showwait, shared):
+            self.close()
+            return False
+
+        self.count = 1
+        self.shared = shared
         return True
 
-    lockpid = _acquire_lock(cmdout)
-    if lockpid < 0:
+    def unlock(self, cmdout):
+        if self.count == 0:
+            cmdout.error("mismatched lock/unlock")
+            return
+
+        if self.count > 1:
+            # Still locked.
+            self.count -= 1
+            return
+
+        self.release(cmdout)
+        self.close()
+
+        self.count = 0
+
+# The global lock, and the locks for individual nodes (indexed by node
+# name).
+globalLock = None
+nodeLocks = {}
+
+def _global_lock():
+    global globalLock
+
+    if not globalLock or globalLock.path != config.Config.lockfile:
+        globalLock = _Lock(config.Config.lockfile)
+    return globalLock
+
+def _node_lock(name):
+    path = "%s.%s" % (config.Config.lockfile, name)
+    if name not in nodeLocks or nodeLocks[name].path != path:
+        nodeLocks[name] = _Lock(path)
+    return nodeLocks[name]
+
+# Read-only commands take a shared lock, so that they can run at the same
+# time, and all others an exclusive one.  The global lock can't be upgraded
+# to an exclusive one while nodes are locked, because that could deadlock
+# with another process waiting for the same nodes.
+def lock(cmdout, showwait=True, shared=False):
+    lck = _global_lock()
+    if lck.count > 0 and lck.shared and not shared and any(n.count for n in nodeLocks.values()):
+        cmdout.error("cannot get exclusive lock while nodes are locked")
         return False
 
-    if lockpid:
-        if showwait:
-            cmdout.info("waiting for lock (owned by PID %d) ..." % lockpid)
-
-        count = 0
-        while _acquire_lock(cmdout) != 0:
-            time.sleep(1)
-
-            count += 1
-            if count > 30:
-                return False
-
-    lockCount = 1
-    return True
+    return lck.lock(cmdout, showwait, shared)
 
 def unlock(cmdout):
-    global lockCount
+    _global_lock().unlock(cmdout)
 
-    if lockCount == 0:
-        cmdout.error("mismatched lock/unlock")
-        return
+# Lock the given nodes (in addition to a shared global lock), so that
+# commands for different nodes can run at the same time.  The nodes are
+# always locked in the same order to avoid deadlocks.
+def lock_nodes(cmdout, nodes, showwait=True, shared=False):
+    if not lock(cmdout, showwait, shared=True):
+        return False
+
+    names = sorted(set(node.name for node in nodes))
+    for i, name in enumerate(names):
+        if not _node_lock(name).lock(cmdout, showwait, shared):
+            for prev in names[:i]:
+                _node_lock(prev).unlock(cmdout)
+            unlock(cmdout)
+            return False
 
-    if lockCount > 1:
-        # Still locked.
-        lockCount -= 1
-        return
+    return True
 
-    _release_lock(cmdout)
+def unlock_nodes(cmdout, nodes):
+    for name in sorted(set(node.name for node in nodes), reverse=True):
+        _node_lock(name).unlock(cmdout)
 
-    lockCount = 0
+    unlock(cmdout)
@@ -0,0 +1,1060 @@
+# The command muxer.
+#
+# ZeekControl starts this program once per host connection (through "sh" for
+# the local host, or through "ssh" for a remote host) and keeps it running for
+# as long as the connection stays open.  The muxer reads requests from stdin
+# (one JSON object per line), runs the commands of each request in parallel,
+# and writes the results to stdout tagged with the ID of the request.
+#
+# Results are sent as binary frames.  Each frame consists of a fixed-size
+# header (frame type, request ID, command index, payload length) followed by
+# the payload, so that command output is passed on as raw bytes without any
+# escaping.  The frame types are:
+#
+#   O   a chunk of a command's stdout (payload: the bytes)
+#   E   a chunk of a command's stderr (payload: the bytes)
+#   X   a command has terminated (payload: exit status as a signed int)
+#   S   a command was skipped (no payload, see run_request)
+#   T   a command was killed because it ran for too long (no payload)
+#   D   all commands of a request are done (no payload)
+#
+# While a request is being served, zeekctl can cancel it by sending
+# {"cancel": <request ID>}.  Then the commands that are still running are
+# killed (as if they timed out), and the ones that have not started yet are
+# skipped.
+#
+# Besides running programs, the muxer provides a few built-in operations (see
+# BUILTINS) that are implemented here in Python.  Their result is sent as JSON
+# on stdout.
+#
+# The source code of this file is sent to the host and executed there, so it
+# must be self-contained (no ZeekControl imports) and must work with all
+# Python versions supported by zeekctl.
+
+import os, sys, subprocess, signal, select, json, struct, time, errno, threading
+
+# Default number of seconds that a command is allowed to run (a request can
+# specify a different value in "timeout").  When a command runs for too long,
+# its process group is killed.
+TIMEOUT = 120
+
+# Number of bytes to read from a command's stdout or stderr at once.
+READ_SIZE = 65536
+
+# Line that is sent (before any frames) once the muxer is ready to serve
+# requests.  Anything that the shell outputs before it is ignored by zeekctl.
+READY = b"zeekctl-muxer-ready\n"
+
+FRAME_HEADER = struct.Struct("!cIiI")
+FRAME_STATUS = struct.Struct("!i")
+
+FRAME_STDOUT = b"O"
+FRAME_STDERR = b"E"
+FRAME_EXIT = b"X"
+FRAME_DONE = b"D"
+FRAME_SKIPPED = b"S"
+FRAME_TIMEOUT = b"T"
+
+_out = getattr(sys.stdout, "buffer", sys.stdout)
+
+# Return a frame as a byte string.
+def frame(ftype, rid, idx, payload=b""):
+    return FRAME_HEADER.pack(ftype, rid, idx, len(payload)) + payload
+
+def send(data):
+    _out.write(data)
+    _out.flush()
+
+# Returns the frames for the exit status (and error message, if any) of a
+# command.
+def result_frames(rid, idx, status, err=b""):
+    data = b""
+    if err:
+        data += frame(FRAME_STDERR, rid, idx, err)
+    data += frame(FRAME_EXIT, rid, idx, FRAME_STATUS.pack(status))
+    return data
+
+# Poll interval (in seconds) of built-in operations that wait for something.
+POLL_INTERVAL = 0.1
+
+# Raised by pause when a built-in operation has been killed.
+class Interrupted(Exception):
+    pass
+
+# When zeekctl runs a built-in operation in a thread (for the local host),
+# the thread's "killed" is an Event that is set when the operation is killed
+# (see set_killed_event).  Otherwise, the operation runs in a process of its
+# own, which is killed instead.
+_builtin_thread = threading.local()
+
+def set_killed_event(event):
+    _builtin_thread.killed = event
+
+# Sleep for the given number of seconds in a built-in operation.  Raises
+# Interrupted if the operation is killed in the meantime (or before).
+def pause(seconds):
+    killed = getattr(_builtin_thread, "killed", None)
+    if killed is None:
+        time.sleep(seconds)
+    elif killed.wait(seconds) or killed.is_set():
+        raise Interrupted("killed")
+
+# Returns the first line of a file (without the newline), or an empty string
+# if the file cannot be read.
+def first_line(fname):
+    try:
+        f = open(fname)
+        try:
+            return f.readline().rstrip("\n")
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return ""
+
+def read_file(fname):
+    f = open(fname, "rb")
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+# Returns the counters of a process or thread from its stat and status files
+# in /proc (the "path" is /proc/<pid> or /proc/<pid>/task/<tid>) as a
+# dictionary with the keys "name", "cputicks", "majflt", "ctxsw", "vsize",
+# and "rss" (see process_info), or None if the files cannot be read.
+def proc_stats(path):
+    try:
+        stat = read_file(os.path.join(path, "stat"))
+        status = read_file(os.path.join(path, "status"))
+    except (IOError, OSError):
+        return None
+
+    # The command name is in parentheses and can contain spaces, see proc(5).
+    end = stat.rindex(b")")
+    stats = {"name": stat[stat.index(b"(") + 1:end].decode("utf-8", "replace"),
+             "cputicks": None, "majflt": None, "ctxsw": None, "vsize": None, "rss": None}
+
+    fields = stat[end + 2:].split()
+    try:
+        stats["majflt"] = int(fields[9])
+        stats["cputicks"] = int(fields[11]) + int(fields[12])
+        stats["vsize"] = int(fields[20])
+        stats["rss"] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    except (IndexError, ValueError, OSError):
+        pass
+
+    for line in status.splitlines():
+        if line.startswith(b"voluntary_ctxt_switches:") or line.startswith(b"nonvoluntary_ctxt_switches:"):
+            try:
+                stats["ctxsw"] = (stats["ctxsw"] or 0) + int(line.split()[1])
+            except (IndexError, ValueError):
+                pass
+
+    return stats
+
+# Returns a list of tuples (tid, stats) for the threads of the process with
+# the given PID, where "stats" is the result of proc_stats.  The list is
+# empty if there is no /proc.
+def thread_stats(pid):
+    taskdir = "/proc/%d/task" % pid
+
+    try:
+        tids = os.listdir(taskdir)
+    except OSError:
+        return []
+
+    results = []
+    for tid in tids:
+        stats = proc_stats(os.path.join(taskdir, tid))
+        if stats:
+            results.append((int(tid), stats))
+
+    return sorted(results)
+
+# Returns information about the process with the given PID as a dictionary:
+# "alive" (True if the process exists), "zeek" (True if its command line
+# contains "zeek", which is the same test as the check-pid helper), "name"
+# (the program name), "cmd" (the command line), "rss" and "vsize" (memory
+# usage in bytes), "cputicks" (user plus system CPU time in clock ticks, see
+# "clktck"), "majflt" (the number of major page faults), and "ctxsw" (the
+# number of voluntary and involuntary context switches; with /proc, only
+# those of the main thread).  Without /proc,
+# "cputicks" is not available but "cpu" is the CPU utilization in percent as
+# reported by ps.  The values that cannot be determined are None.
+def process_info(pid):
+    info = {"alive": False, "zeek": False, "name": None, "cmd": None, "rss": None, "vsize": None,
+            "cputicks": None, "clktck": None, "cpu": None, "majflt": None, "ctxsw": None}
+    if not pid:
+        return info
+
+    if os.path.isdir("/proc/self"):
+        try:
+            cmdline = read_file("/proc/%d/cmdline" % pid)
+        except (IOError, OSError):
+            return info
+
+        stats = proc_stats("/proc/%d" % pid)
+        if not stats:
+            return info
+
+        info.update(stats)
+        info["alive"] = True
+        info["zeek"] = b"zeek" in cmdline
+        info["cmd"] = cmdline.replace(b"\0", b" ").strip().decode("utf-8", "replace")
+
+        try:
+            info["clktck"] = os.sysconf("SC_CLK_TCK")
+        except (ValueError, OSError):
+            info["cputicks"] = None
+
+        return info
+
+    # No /proc, so ask ps.
+    try:
+        proc = subprocess.Popen(["ps", "-p", str(pid), "-o", "rss=,vsz=,pcpu=,majflt=,nvcsw=,nivcsw=,args="], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return info
+    out, _ = proc.communicate()
+    fields = out.split(None, 6)
+    if len(fields) < 7:
+        return info
+
+    info["alive"] = True
+    info["zeek"] = b"zeek" in fields[6]
+    info["cmd"] = fields[6].strip().decode("utf-8", "replace")
+    info["name"] = os.path.basename(info["cmd"].split()[0])
+    try:
+        info["rss"] = int(fields[0]) * 1024
+        info["vsize"] = int(fields[1]) * 1024
+        info["cpu"] = float(fields[2])
+        info["majflt"] = int(fields[3])
+        info["ctxsw"] = int(fields[4]) + int(fields[5])
+    except ValueError:
+        pass
+
+    return info
+
+# Returns True if the process with the given PID is running and its command
+# line contains "zeek".
+def zeek_running(pid):
+    return process_info(pid)["zeek"]
+
+# Built-in operation "probe-nodes": returns the state of each node.  The
+# "nodes" is a list of [dir, pid] lists, where "dir" is the node's working
+# directory and "pid" is the PID of its Zeek process (or None if there is
+# none).  Returns a list with one dictionary per node, which has the keys of
+# process_info, and "status" and "startup" (the first lines of the .status
+# and .startup files, or empty strings).
+def probe_nodes(nodes):
+    results = []
+
+    for dir, pid in nodes:
+        info = process_info(pid)
+
+        # Read the files after checking the process to avoid a race
+        # condition (see wait_status).
+        info["status"] = first_line(os.path.join(dir, ".status"))
+        info["startup"] = first_line(os.path.join(dir, ".startup"))
+        results.append(info)
+
+    return results
+
+# Built-in operation "wait-status": wait until each node has reached a
+# status or is not running anymore.  The "nodes" is a list of [dir, pid,
+# status] lists, where "dir" is the node's working directory and "status" is
+# the status (as written to the .status file by Zeek) that we wait for.
+# Returns a list with one entry per node: "reached", "dead", "failed" (the
+# .status file has unexpected content), or "timeout".
+def wait_status(nodes, timeout):
+    deadline = time.time() + timeout
+    results = [None] * len(nodes)
+
+    while True:
+        for i, (dir, pid, status) in enumerate(nodes):
+            if results[i]:
+                continue
+
+            # Check whether the process is running before reading the status
+            # to avoid a race condition.
+            running = zeek_running(pid)
+
+            line = first_line(os.path.join(dir, ".status"))
+            if line:
+                fields = line.split()
+                if len(fields) != 2:
+                    results[i] = "failed"
+                    continue
+                if status in fields[0]:
+                    results[i] = "reached"
+                    continue
+
+            if not running:
+                results[i] = "dead"
+
+        if all(results) or time.time() >= deadline:
+            break
+
+        pause(POLL_INTERVAL)
+
+    return [res or "timeout" for res in results]
+
+# Returns the name of the file system (the device, as shown by df) that
+# contains the given path.  If that cannot be determined, then the mount
+# point is returned instead.
+def file_system(path):
+    path = os.path.realpath(path)
+
+    try:
+        mounts = read_file("/proc/mounts").decode("utf-8", "replace")
+    except (IOError, OSError):
+        mounts = ""
+
+    fs = None
+    mountpoint = ""
+    for line in mounts.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+
+        # Spaces and other special characters are escaped in octal.
+        mnt = fields[1].replace("\\040", " ").replace("\\011", "\t").replace("\\134", "\\")
+        if path == mnt or path.startswith(mnt.rstrip("/") + "/"):
+            if len(mnt) >= len(mountpoint):
+                fs, mountpoint = fields[0], mnt
+
+    if fs:
+        return fs
+
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+# Built-in operation "df": returns the disk usage of the file systems that
+# contain the given directories, as a list with one dictionary per
+# directory.  The dictionary has the keys "fs" (see file_system), "total",
+# "used", and "available" (in bytes, the same values as "df -P" shows), or
+# just "error" if the disk usage cannot be determined.
+def disk_usage(paths):
+    results = []
+
+    for path in paths:
+        if not os.path.isdir(path):
+            results.append({"error": "not a directory: %s" % path})
+            continue
+
+        try:
+            st = os.statvfs(path)
+        except OSError as e:
+            results.append({"error": str(e)})
+            continue
+
+        results.append({
+            "fs": file_system(path),
+            "total": st.f_blocks * st.f_frsize,
+            "used": (st.f_blocks - st.f_bfree) * st.f_frsize,
+            "available": st.f_bavail * st.f_frsize,
+        })
+
+    return results
+
+# Returns the rate per second of a counter between two samples, or None if
+# the counter is not available.
+def rate(old, new, key, elapsed):
+    if old[key] is None or new[key] is None:
+        return None
+    return (new[key] - old[key]) / elapsed
+
+# Returns a sample of the counters of the processes with the given PIDs (see
+# top_usage).
+def top_sample(pids):
+    return ([(process_info(pid), dict(thread_stats(pid))) for pid in pids], time.time())
+
+# Returns the resource usage of the processes between two samples (see
+# top).
+def top_usage(pids, before, after):
+    elapsed = max(after[1] - before[1], 0.001)
+
+    results = []
+    for pid, (old, oldthreads), (new, newthreads) in zip(pids, before[0], after[0]):
+        if not new["alive"]:
+            results.append(None)
+            continue
+
+        clktck = new["clktck"]
+        cpu = new["cpu"]
+        if clktck:
+            cpu = rate(old, new, "cputicks", elapsed)
+            if cpu is not None:
+                cpu = 100.0 * cpu / clktck
+
+        threads = []
+        for tid, stats in sorted(newthreads.items()):
+            if tid not in oldthreads:
+                # Started during the interval.
+                continue
+
+            tcpu = rate(oldthreads[tid], stats, "cputicks", elapsed)
+            threads.append({"tid": tid, "name": stats["name"],
+                            "cpu": 100.0 * tcpu / clktck if tcpu is not None and clktck else None,
+                            "ctxsw": rate(oldthreads[tid], stats, "ctxsw", elapsed),
+                            "majflt": rate(oldthreads[tid], stats, "majflt", elapsed)})
+
+        # The context switches in /proc/<pid>/status are only those of the
+        # main thread.
+        ctxsw = rate(old, new, "ctxsw", elapsed)
+        if threads:
+            ctxsw = sum(thread["ctxsw"] or 0 for thread in threads)
+
+        results.append({"pid": pid, "name": new["name"], "vsize": new["vsize"], "rss": new["rss"], "cpu": cpu,
+                         "ctxsw": ctxsw, "majflt": rate(old, new, "majflt", elapsed), "threads": threads})
+
+    return results
+
+# Built-in operation "top": returns the resource usage of the processes with
+# the given PIDs, as a list with one dictionary per process (or None if the
+# process is not running).  The usage is measured by taking two samples that
+# are "interval" seconds apart.  The dictionary has the keys "pid", "name",
+# "vsize", "rss" (in bytes), "cpu" (the CPU utilization in percent), "ctxsw"
+# and "majflt" (context switches and major page faults per second), and
+# "threads" (a list with one dictionary for each thread, with the keys "tid",
+# "name", "cpu", "ctxsw", and "majflt").
+def top(pids, interval):
+    before = top_sample(pids)
+    pause(interval)
+    return top_usage(pids, before, top_sample(pids))
+
+# Streaming built-in operation "top-stream": the same as "top", but keeps
+# sampling the processes and emits the resource usage after every interval,
+# until none of the processes is running anymore or "duration" seconds have
+# passed.
+def top_stream(emit, pids, interval, duration):
+    deadline = time.time() + duration
+    before = top_sample(pids)
+
+    while time.time() < deadline:
+        pause(interval)
+        after = top_sample(pids)
+        usage = top_usage(pids, before, after)
+        if not emit(usage):
+            break
+        if not any(usage):
+            break
+        before = after
+
+# Built-in operation "stop": send a signal to a process.
+def stop(pid, sig):
+    pause(0)
+    os.kill(pid, sig)
+    return True
+
+# The capstats collector: a process that keeps running "capstats" on an
+# interface (with an interval of CAPSTATS_INTERVAL seconds), and appends its
+# output lines to the file <base>.cur (any other output, such as an error
+# message, goes to <base>.err).  When that file has "history" seconds worth
+# of samples, it is renamed to <base>.old and a new one is started, so that
+# at least the samples of the last "history" seconds are available (see
+# capstats).  The PID of the collector is in <base>.pid, and it terminates
+# when that file is removed or replaced, or when nobody has asked for the
+# statistics for twice the "history".
+#
+# The collector is a separate Python program (started by
+# start_capstats_collector with the arguments path, netif, base, history,
+# and interval), because the muxer's code also runs inside zeekctl's own
+# (multi-threaded) process for the local host, which must not fork.  It is
+# started by CAPSTATS_LAUNCHER in a new session, so that it isn't killed
+# along with the command that started it, and it's not a child of the muxer
+# or zeekctl (which would have to wait for it).
+CAPSTATS_INTERVAL = 1
+
+CAPSTATS_LAUNCHER = r"""
+import os, subprocess, sys
+null = open(os.devnull, "r+b")
+proc = subprocess.Popen([sys.executable, "-c"] + sys.argv[1:], stdin=null, stdout=null, stderr=null, close_fds=True, preexec_fn=os.setsid)
+sys.stdout.write("%d\n" % proc.pid)
+"""
+
+CAPSTATS_COLLECTOR = r"""
+import os, sys, subprocess, time
+
+path, netif, base = sys.argv[1:4]
+history, interval = int(sys.argv[4]), int(sys.argv[5])
+
+# Returns True if the PID file is ours (it's still empty while the one who
+# started us writes it).
+def ours(pidfile):
+    try:
+        f = open(pidfile)
+        try:
+            return f.readline().strip() in ("", str(os.getpid()))
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return False
+
+# Returns True as long as somebody has asked for the statistics recently.
+def wanted(pidfile):
+    try:
+        return ours(pidfile) and time.time() - os.stat(pidfile).st_mtime <= 2 * history
+    except OSError:
+        return False
+
+err = open(base + ".err", "wb")
+# Note that capstats writes its output to stderr.
+proc = subprocess.Popen([path, "-I", str(interval), "-i", netif], stdout=err, stderr=subprocess.PIPE)
+pidfile = base + ".pid"
+maxlines = max(history // interval, 1)
+lines = 0
+out = open(base + ".cur", "wb")
+
+try:
+    for line in iter(proc.stderr.readline, b""):
+        if not wanted(pidfile):
+            break
+
+        try:
+            float(line.split()[0])
+        except (IndexError, ValueError):
+            err.write(line)
+            err.flush()
+            continue
+
+        if lines >= maxlines:
+            out.close()
+            os.rename(base + ".cur", base + ".old")
+            out = open(base + ".cur", "wb")
+            lines = 0
+
+        out.write(line)
+        out.flush()
+        lines += 1
+finally:
+    out.close()
+    err.close()
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    if ours(pidfile):
+        os.unlink(pidfile)
+"""
+
+# Returns the PID of the capstats collector that wrote the given PID file if
+# it is still running, or None otherwise.
+def capstats_collector(pidfile):
+    try:
+        pid = int(first_line(pidfile))
+        os.kill(pid, 0)
+        return pid
+    except (ValueError, OSError):
+        return None
+
+# Returns True if the given PID file belongs to a process that no longer
+# exists.  An empty PID file is only stale if it is older than a few seconds
+# (otherwise a collector is just being started).
+def stale_pidfile(pidfile):
+    try:
+        pid = int(first_line(pidfile))
+    except ValueError:
+        try:
+            return time.time() - os.stat(pidfile).st_mtime > 10
+        except OSError:
+            return False
+
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+
+    return False
+
+# Start a capstats collector in the background (in its own session, so that
+# it keeps running when the connection to zeekctl is closed).  Nothing
+# happens if another one is running or just being started.
+def start_capstats_collector(path, netif, base, history):
+    pidfile = base + ".pid"
+    try:
+        fd = os.open(pidfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except OSError:
+        if not stale_pidfile(pidfile):
+            return
+        # The previous collector terminated without removing its PID file.
+        try:
+            os.unlink(pidfile)
+            fd = os.open(pidfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            return
+
+    pid = b""
+    try:
+        args = [CAPSTATS_COLLECTOR, path, netif, base, str(history), str(CAPSTATS_INTERVAL)]
+        proc = subprocess.Popen([sys.executable, "-c", CAPSTATS_LAUNCHER] + args, stdout=subprocess.PIPE, close_fds=True)
+        pid = proc.communicate()[0].strip()
+    except OSError:
+        pass
+
+    if pid:
+        writeall(fd, pid)
+    else:
+        os.unlink(pidfile)
+    os.close(fd)
+
+# Built-in operation "capstats": returns the statistics of the interface
+# "netif" over the last "period" seconds as a dictionary with the number of
+# "samples" and the "min", "avg", and "max" of each value that capstats
+# reports.  The samples are taken by a capstats collector (which is started
+# if it is not running, in which case there are no samples yet), and its
+# files are in "dir".  If capstats fails, returns a dictionary with the
+# "error".
+def capstats(path, netif, dir, history, period):
+    base = os.path.join(dir, "capstats-%s" % netif.replace("/", "_"))
+    pidfile = base + ".pid"
+
+    if capstats_collector(pidfile):
+        # Keep the collector running.
+        os.utime(pidfile, None)
+    else:
+        err = first_line(base + ".err")
+        start_capstats_collector(path, netif, base, history)
+        if err:
+            return {"error": err}
+
+    since = time.time() - period
+    samples = []
+
+    for fname in (base + ".old", base + ".cur"):
+        try:
+            data = read_file(fname).decode("utf-8", "replace")
+        except (IOError, OSError):
+            continue
+
+        for line in data.splitlines():
+            fields = line.split()
+            try:
+                if not fields or float(fields[0]) < since:
+                    continue
+                samples.append(dict((key, float(val)) for key, val in (field.split("=") for field in fields[1:])))
+            except ValueError:
+                return {"error": "unexpected capstats output: %s" % line}
+
+    result = {"samples": len(samples), "min": {}, "avg": {}, "max": {}}
+    for key in set(key for sample in samples for key in sample):
+        vals = [sample[key] for sample in samples if key in sample]
+        result["min"][key] = min(vals)
+        result["avg"][key] = sum(vals) / len(vals)
+        result["max"][key] = max(vals)
+
+    return result
+
+# Returns the kernel's counters of a network interface (from
+# /sys/class/net/<netif>/statistics) as a dictionary.  If "ethtool" is True,
+# then it also contains the drop counters that "ethtool -S" reports (e.g.,
+# per receive queue) with the prefix "ethtool-".  Raises OSError if there
+# are no counters for the interface.
+def nic_counters(netif, ethtool):
+    statsdir = os.path.join("/sys/class/net", netif, "statistics")
+    counters = {}
+
+    for name in os.listdir(statsdir):
+        try:
+            counters[name] = int(first_line(os.path.join(statsdir, name)))
+        except ValueError:
+            pass
+
+    if ethtool:
+        try:
+            devnull = open(os.devnull, "wb")
+            try:
+                proc = subprocess.Popen(["ethtool", "-S", netif], stdout=subprocess.PIPE, stderr=devnull)
+                out = proc.communicate()[0].decode("utf-8", "replace")
+            finally:
+                devnull.close()
+        except OSError:
+            # No ethtool.
+            out = ""
+
+        for line in out.splitlines():
+            key, sep, val = line.partition(":")
+            key = key.strip()
+            if sep and ("drop" in key or "miss" in key):
+                try:
+                    counters["ethtool-%s" % key] = int(val)
+                except ValueError:
+                    pass
+
+    return counters
+
+# Built-in operation "nic-stats": measure the traffic received on network
+# interfaces during "interval" seconds with the kernel's counters (so,
+# unlike capstats, without capturing packets).  Returns a list with a
+# dictionary for each interface with the number of packets ("pkts"),
+# kilobytes ("kbytes"), packets dropped by the kernel ("drops") or by the
+# NIC ("missed"), and receive errors ("errors") during the interval, the
+# rates "kpps" and "mbps", and the increase of the ethtool drop counters
+# (see nic_counters).  If there are no counters for an interface, its
+# dictionary has the "error".
+def nic_stats(netifs, interval, ethtool):
+    before = {}
+    for netif in netifs:
+        try:
+            before[netif] = nic_counters(netif, ethtool)
+        except OSError:
+            pass
+
+    start = time.time()
+    if before:
+        pause(interval)
+    elapsed = max(time.time() - start, 0.001)
+
+    results = []
+    for netif in netifs:
+        after = None
+        if netif in before:
+            try:
+                after = nic_counters(netif, ethtool)
+            except OSError:
+                pass
+
+        if after is None:
+            results.append({"error": "no kernel counters for interface %s" % netif})
+            continue
+
+        delta = dict((key, val - before[netif][key]) for key, val in after.items() if key in before[netif])
+        pkts = delta.get("rx_packets", 0)
+        nbytes = delta.get("rx_bytes", 0)
+
+        res = {"pkts": pkts, "kbytes": nbytes / 1024.0,
+               "kpps": pkts / elapsed / 1000.0, "mbps": nbytes * 8 / elapsed / 1000000.0,
+               "drops": delta.get("rx_dropped", 0), "missed": delta.get("rx_missed_errors", 0),
+               "errors": delta.get("rx_errors", 0)}
+
+        for key, val in delta.items():
+            if key.startswith("ethtool-"):
+                res[key] = val
+
+        results.append(res)
+
+    return results
+
+BUILTINS = {
+    "capstats": capstats,
+    "df": disk_usage,
+    "nic-stats": nic_stats,
+    "probe-nodes": probe_nodes,
+    "stop": stop,
+    "top": top,
+    "wait-status": wait_status,
+}
+
+# Built-in operations that produce a series of results.  They are called with
+# a function "emit" as the first argument, which sends one result (as a line
+# of JSON) and returns False if the operation should stop.
+STREAMING_BUILTINS = {
+    "top-stream": top_stream,
+}
+
+def check_builtin(name):
+    if name not in BUILTINS and name not in STREAMING_BUILTINS:
+        raise ValueError("unknown built-in operation: %s" % name)
+
+# Run a built-in operation and return its result as JSON.  For a streaming
+# operation, "output" is called with each result (as a line of JSON) and
+# must return False to stop the operation, and an empty string is returned.
+def call_builtin(name, args, output=None):
+    check_builtin(name)
+
+    if name in STREAMING_BUILTINS:
+        def emit(result):
+            return output(json.dumps(result) + "\n")
+
+        STREAMING_BUILTINS[name](emit, *args)
+        return ""
+
+    return json.dumps(BUILTINS[name](*args))
+
+# Runs a built-in operation in a child process of the muxer, so that it can
+# be handled in the same way as a command (see run_request).  Provides the
+# parts of the subprocess.Popen interface that run_request uses.
+class BuiltinProc:
+    def __init__(self, name, args):
+        check_builtin(name)
+
+        rout, wout = os.pipe()
+        rerr, werr = os.pipe()
+        self.pid = os.fork()
+
+        if self.pid == 0:
+            status = 1
+            try:
+                os.setpgrp()
+                os.close(rout)
+                os.close(rerr)
+                def output(data):
+                    writeall(wout, data.encode())
+                    return True
+
+                try:
+                    writeall(wout, call_builtin(name, args, output).encode())
+                    status = 0
+                except Exception as e:
+                    writeall(werr, str(e).encode())
+            finally:
+                os._exit(status)
+
+        os.close(wout)
+        os.close(werr)
+        self.stdout = os.fdopen(rout, "rb")
+        self.stderr = os.fdopen(rerr, "rb")
+
+    def wait(self):
+        _, status = os.waitpid(self.pid, 0)
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+def writeall(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+# Kill a command, including all processes that it started.
+def kill_group(proc):
+    if hasattr(proc, "kill_group"):
+        proc.kill_group()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+# Returns the class of a command, which is the name of the program that it
+# runs (or of the built-in operation).  The number of commands of the same
+# class that run at the same time can be limited.
+def cmd_class(cmd):
+    if "builtin" in cmd:
+        return cmd["builtin"]
+    args = cmd["cmd"]
+    if cmd["shell"]:
+        if isinstance(args, list):
+            args = args[0]
+        args = args.split()
+    if not args:
+        return ""
+    return os.path.basename(args[0])
+
+# Run all commands of one request and send back the results.  Output is sent
+# as soon as it is read, and the exit status once a command terminates; each
+# frame is tagged with the request ID and the index of the command in the
+# request.
+#
+# If the request specifies "max" (greater than zero), then at most that many
+# commands run at the same time, and "limits" can further limit the number
+# of running commands per command class.  Commands that have to wait are
+# started in the order of their index as soon as possible.
+#
+# A command is either a list of arguments, or a dictionary with the
+# arguments in "cmd" and optionally: "shell" (overrides the request's
+# "shell"), "after" (the index of an earlier command that must finish
+# before this one starts), and "needok" (if True, this command is skipped
+# if the command given by "after" failed).  A command is also skipped if
+# the command it waits for was skipped.  Skipped commands get an S frame
+# instead of an exit status.  A dictionary can also specify a "timeout" for
+# the command, which overrides the request's "timeout".
+#
+# If a LineReader for our stdin is given, then it is watched for a message
+# that cancels the request.
+#
+# The frames are passed to "send", and built-in operations are run by
+# instances of "builtin_proc" (zeekctl uses this to run the requests for the
+# local host itself).
+def run_request(req, reader=None, send=send, builtin_proc=BuiltinProc):
+    rid = req["id"]
+    maxrunning = req.get("max", 0)
+    limits = req.get("limits", {})
+
+    timeout = req.get("timeout", TIMEOUT)
+
+    cmds = []
+    for cmd in req["cmds"]:
+        if not isinstance(cmd, dict):
+            cmd = {"cmd": cmd}
+        cmd.setdefault("shell", req.get("shell", False))
+        cmds.append(cmd)
+
+    queued = list(range(len(cmds)))
+    # Maps the index of each finished command to True (success), False
+    # (failure), or None (skipped).
+    outcome = {}
+    running = {}
+    cmd_map = {}
+    fds = set()
+    # The commands that are currently running.
+    active = []
+
+    def can_start(cls):
+        if maxrunning > 0 and sum(running.values()) >= maxrunning:
+            return False
+        limit = limits.get(cls, 0)
+        return limit <= 0 or running.get(cls, 0) < limit
+
+    def finish(i, status, err=b""):
+        send(result_frames(rid, i, status, err))
+        outcome[i] = status == 0
+
+    def cmd_done(cmd):
+        active.remove(cmd)
+        running[cmd["class"]] -= 1
+        for fd in (cmd["proc"].stdout, cmd["proc"].stderr):
+            if fd in fds:
+                fds.remove(fd)
+                del cmd_map[fd]
+            fd.close()
+
+    # Kill a command that ran for too long, including all processes that it
+    # started.
+    def kill(cmd):
+        kill_group(cmd["proc"])
+        cmd_done(cmd)
+        cmd["proc"].wait()
+        send(frame(FRAME_TIMEOUT, rid, cmd["idx"]))
+        outcome[cmd["idx"]] = False
+
+    def start_cmds():
+        for i in list(queued):
+            cmd = cmds[i]
+            after = cmd.get("after", -1)
+            if after >= 0:
+                if after not in outcome:
+                    continue
+                if outcome[after] is None or (outcome[after] is False and cmd.get("needok")):
+                    queued.remove(i)
+                    outcome[i] = None
+                    send(frame(FRAME_SKIPPED, rid, i))
+                    continue
+
+            cls = cmd_class(cmd)
+            if not can_start(cls):
+                continue
+
+            queued.remove(i)
+            try:
+                if "builtin" in cmd:
+                    proc = builtin_proc(cmd["builtin"], cmd.get("args", []))
+                else:
+                    proc = subprocess.Popen(cmd["cmd"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=cmd["shell"], close_fds=True, preexec_fn=os.setpgrp)
+            except Exception as e:
+                finish(i, 1, str(e).encode())
+                continue
+
+            running[cls] = running.get(cls, 0) + 1
+            o = {"idx": i, "proc": proc, "class": cls, "waiting": 2, "deadline": time.time() + cmd.get("timeout", timeout)}
+            active.append(o)
+            cmd_map[proc.stdout] = (o, FRAME_STDOUT)
+            cmd_map[proc.stderr] = (o, FRAME_STDERR)
+            fds.update((proc.stdout, proc.stderr))
+
+    def cancel():
+        for i in list(queued):
+            queued.remove(i)
+            outcome[i] = None
+            send(frame(FRAME_SKIPPED, rid, i))
+        for cmd in list(active):
+            kill(cmd)
+
+    start_cmds()
+
+    while active:
+        wait = min(cmd["deadline"] for cmd in active) - time.time()
+        rfds = list(fds)
+        if reader and not reader.eof:
+            rfds.append(reader.fd)
+        r, _, _ = select.select(rfds, [], [], max(wait, 0))
+
+        if reader and reader.fd in r:
+            reader.fill()
+            # If zeekctl went away, then there is nobody to report to.
+            if reader.eof or reader.cancelled(rid):
+                cancel()
+                break
+            r.remove(reader.fd)
+
+        for fd in r:
+            cmd, ftype = cmd_map[fd]
+            output = os.read(fd.fileno(), READ_SIZE)
+            if output:
+                send(frame(ftype, rid, cmd["idx"], output))
+                continue
+
+            fds.remove(fd)
+            del cmd_map[fd]
+            cmd["waiting"] -= 1
+            if cmd["waiting"]:
+                continue
+
+            cmd_done(cmd)
+            finish(cmd["idx"], cmd["proc"].wait())
+
+        now = time.time()
+        for cmd in list(active):
+            if cmd["deadline"] <= now:
+                kill(cmd)
+
+        start_cmds()
+
+    send(frame(FRAME_DONE, rid, -1))
+
+# Reads the messages (one JSON object per line) that zeekctl sends to our
+# stdin.
+class LineReader:
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = b""
+        self.msgs = []
+        self.eof = False
+
+    # Read the available data (this blocks if there is none).
+    def fill(self):
+        data = os.read(self.fd, READ_SIZE)
+        if not data:
+            self.eof = True
+            return
+
+        self.buf += data
+        while b"\n" in self.buf:
+            line, self.buf = self.buf.split(b"\n", 1)
+            line = line.strip()
+            if line:
+                self.msgs.append(json.loads(line.decode()))
+
+    # Returns the next message, or None once stdin is closed.
+    def next(self):
+        while not self.msgs and not self.eof:
+            self.fill()
+        if not self.msgs:
+            return None
+        return self.msgs.pop(0)
+
+    # Remove all cancel messages that were received.  Returns True if one of
+    # them is for the given request ID.
+    def cancelled(self, rid):
+        found = False
+        for msg in list(self.msgs):
+            if "cancel" in msg:
+                self.msgs.remove(msg)
+                found = found or msg["cancel"] == rid
+        return found
+
+def main():
+    send(READY)
+
+    # Serve requests until zeekctl closes our stdin.
+    reader = LineReader(sys.stdin.fileno())
+    while True:
+        msg = reader.next()
+        if msg is None:
+            break
+        if "cancel" in msg:
+            # The request has finished already.
+            continue
+        run_request(msg, reader)
+
+if __name__ == "__main__":
+    main()
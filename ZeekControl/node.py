@@ -173,11 +173,14 @@ class Node:
         return os.path.join(self._config.spooldir, self.name)
 
     def setPID(self, pid):
-        """Stores the process ID of the node's Zeek process."""
+        """Stores the process ID of the node's Zeek process.  This is written
+        to the state database right away (also during a command), so that
+        the process can still be found if zeekctl is killed."""
         key = "%s-pid" % self.name
         self._config.set_state(key, pid)
         key = "%s-host" % self.name
         self._config.set_state(key, self.host)
+        self._config.flush_state()
 
     @doc.api
     def getPID(self):
@@ -191,17 +194,20 @@ class Node:
         that it is no longer running."""
         key = "%s-pid" % self.name
         self._config.set_state(key, None)
+        self._config.flush_state()
 
     def setCrashed(self):
         """Marks node's Zeek process as having terminated unexpectedly."""
         key = "%s-crashed" % self.name
         self._config.set_state(key, True)
+        self._config.flush_state()
 
     def clearCrashed(self):
         """Clears the mark for the node's Zeek process having terminated
         unexpectedly."""
         key = "%s-crashed" % self.name
         self._config.set_state(key, False)
+        self._config.flush_state()
 
     @doc.api
     def hasCrashed(self):
@@ -223,6 +229,7 @@ class Node:
     def setExpectRunning(self, val):
         key = "%s-expect-running" % self.name
         self._config.set_state(key, val)
+        self._config.flush_state()
 
     def setPort(self, port):
         """Set the Zeek port this node is using."""
@@ -42,6 +42,32 @@ options = [
            "The Broker topic name used for sending and receiving control messages to Zeek processes."),
     Option("CommandTimeout", 60, "int", Option.USER, False,
            "The number of seconds to wait for a command to return results."),
+    Option("HostFailureThreshold", 3, "int", Option.USER, False,
+           "The number of consecutive times that commands could not be run on a remote host (because it was unreachable or did not respond in time) before the host is considered down.  While a host is considered down, commands for it fail immediately with the error 'host down (cached)' instead of waiting for a timeout.  Set to 0 to always try to reach every host."),
+    Option("HostDownBackoff", 60, "int", Option.USER, False,
+           "The number of seconds that commands for a host which is considered down (see HostFailureThreshold) fail immediately.  After that, a single ssh login to the host is attempted, and only if that succeeds are commands sent to the host again."),
+    Option("HostLivenessTTL", 30, "int", Option.USER, False,
+           "The number of seconds that a host which has successfully run commands (or answered the heartbeat on an idle connection) is considered alive without being checked again before running more commands.  A failed command marks the host as down immediately.  Set to 0 to check each host before every batch of commands."),
+    Option("MaxHostCommands", 16, "int", Option.USER, False,
+           "The maximum number of commands that zeekctl runs at the same time on one host (additional commands wait until a running one has finished).  Set to 0 for no limit.  See also MaxHostCommandsByName and LocalWorkers."),
+    Option("MaxHostCommandsByName", "crash-diag=2", "string", Option.USER, False,
+           "A comma-separated list of command names with the maximum number of such commands that zeekctl runs at the same time on one host (e.g. 'crash-diag=2, df=4').  The name of a command is the name of the program it runs (for example, the name of a zeekctl helper script)."),
+    Option("LocalWorkers", 16, "int", Option.USER, False,
+           "The maximum number of commands that zeekctl runs at the same time on the local host (MaxHostCommands and MaxHostCommandsByName apply as well).  Commands for the local host are run directly by zeekctl.  Set to 0 to run them through a shell and the command muxer instead, like for remote hosts."),
+    Option("ExecutorBackend", "threads", "string", Option.USER, False,
+           "The implementation used to run commands on the cluster hosts.  With 'threads', each host is handled by its own thread.  With 'asyncio', the connections to all hosts are driven by a single event loop, which scales better to a large number of hosts (requires Python 3)."),
+    Option("NativeHelpers", 1, "bool", Option.USER, False,
+           "True to let zeekctl's command muxer on each host check processes, disk usage, and resource usage, and send signals to processes itself (using /proc where available).  Set to 0 to run the helper scripts instead."),
+    Option("CapstatsCollect", 0, "bool", Option.USER, False,
+           "True to keep a capstats collector running on each host for each interface monitored by a worker, which runs 'capstats -I 1' continuously (i.e., there is a permanent additional packet capture on each monitored interface).  Then the capstats command and the statistics written by the cron command report the average, minimum, and maximum over the recent samples without waiting for a new measurement.  A collector is started on first use, so the first cron run after enabling this option reports an error instead of interface statistics.  Only used when NativeHelpers is enabled."),
+    Option("CapstatsHistory", 600, "int", Option.USER, False,
+           "The number of seconds of samples that a capstats collector keeps (see CapstatsCollect).  This should be at least the interval at which the cron command runs.  A collector terminates when its statistics have not been requested for twice this time."),
+    Option("NICStats", "auto", "string", Option.USER, False,
+           "How the statistics of the network interfaces (for the capstats command and stats.log) are obtained.  With 'capstats', capstats is run.  With 'kernel', the kernel's counters of the interfaces are read (which doesn't capture any packets, but requires NativeHelpers).  With 'auto', capstats is used where it can be, and the kernel's counters are used for the other packet sources (such as PF_RING or Myricom)."),
+    Option("NICStatsEthtool", 0, "bool", Option.USER, False,
+           "True to also report the drop counters of 'ethtool -S' (e.g., per receive queue) when the kernel's counters of an interface are used (see NICStats)."),
+    Option("TopInterval", 1, "int", Option.USER, False,
+           "The number of seconds over which the CPU utilization (and the rate of context switches and page faults) of the Zeek processes is measured for the top command and the statistics written by the cron command.  Only used when NativeHelpers is enabled."),
     Option("ZeekPort", 47760, "int", Option.USER, False,
            "The TCP port number that Zeek will listen on. For a cluster configuration, each node in the cluster will automatically be assigned a subsequent port to listen on.", "BroPort"),
     Option("LogRotationInterval", 3600, "int", Option.USER, False,
@@ -85,10 +111,14 @@ options = [
     Option("MailReceivingPackets", 1, "bool", Option.USER, False,
            "True to enable sending mail when zeekctl cron notices that an interface is not receiving any packets (note that such mail is not sent when StatsLogEnable is 0)."),
 
+    Option("MaxDropPercent", 0, "int", Option.USER, False,
+           "Percentage of its packets that a worker may drop between two runs of zeekctl cron before zeekctl cron mails a warning.  This requires StatsLogNetstats to be enabled.  If this value is 0, then no warning will be sent."),
     Option("MinDiskSpace", 5, "int", Option.USER, False,
            "Minimum percentage of disk space available before zeekctl cron mails a warning.  If this value is 0, then no warning will be sent."),
     Option("StatsLogEnable", 1, "bool", Option.USER, False,
            "True to enable ZeekControl to write statistics to the stats.log file."),
+    Option("StatsLogNetstats", 0, "bool", Option.USER, False,
+           "True to let zeekctl cron also write the packet counters of the workers (as reported by the netstats command) and their increase since the previous run to the stats.log file (this requires the Broker Python bindings)."),
     Option("StatsLogExpireInterval", 0, "int", Option.USER, False,
            "Number of days entries in the stats.log file are kept (zero means never expire)."),
     Option("CrashExpireInterval", 0, "int", Option.USER, False,
@@ -205,6 +205,32 @@ class Plugin(object):
 
         return self.executor.run_shell_cmds(cmds)
 
+    @doc.api
+    def executeParallelIter(self, cmds, ordered=True):
+        """Same as `executeParallel`_, but returns an iterator instead of a
+        list. Each tuple ``(node, success, output)`` is returned as soon as
+        the command for that node (and, if ``ordered`` is True, the commands
+        of all nodes preceding it in ``cmds``) has finished, so that results
+        can be processed before all commands are done. With ``ordered`` set
+        to False, the results are returned in the order in which the
+        commands finish."""
+
+        return self.executor.iter_cmds([(node, cmd, []) for (node, cmd) in cmds], shell=True, ordered=ordered)
+
+    @doc.api
+    def executeParallelStream(self, cmds):
+        """Same as `executeParallel`_, but returns an iterator over the
+        output of the commands as it arrives, without collecting it. For
+        each piece of a command's stdout/stderr output, it returns a tuple
+        ``(node, chunk)`` in which ``chunk`` is a string. Once the command
+        has finished, it returns a tuple ``(node, status)`` in which
+        ``status`` is the exit status (an integer), or None if the command
+        did not run to completion (then the last chunk is an error
+        message). The tuples of the commands of different nodes are
+        interleaved."""
+
+        return self.executor.stream_cmds([(node, cmd, []) for (node, cmd) in cmds], shell=True)
+
     ### Methods that must be overridden by plugins.
 
     @doc.api("override")
@@ -70,7 +70,7 @@ class PsZeek(ZeekControl.plugin.Plugin):
 
         first_node = True
 
-        for (n, success, output) in self.executeParallel(cmds):
+        for (n, success, output) in self.executeParallelIter(cmds):
             outlines = output.splitlines()
             # Remove stderr output (if any)
             while outlines and not outlines[0].startswith("USER"):
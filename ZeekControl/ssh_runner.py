@@ -1,4 +1,3 @@
-import ast
 import collections
 import json
 import subprocess
@@ -7,81 +6,23 @@ import time
 import os
 import base64
 import zlib
+import inspect
 import logging
-from threading import Thread
+import signal
+from threading import Event, Lock, Thread
 
 from ZeekControl import py3zeek
+from ZeekControl import breaker as breaker_mod
+from ZeekControl import muxer as muxer_mod
 Queue = py3zeek.Queue
 Empty = py3zeek.Empty
 
 
-def get_muxer(shell):
+def get_muxer():
     # The full path of the Python interpreter.  Configured by CMake.
     pythonpath = "@PYTHON_EXECUTABLE@"
 
-    muxer = r"""
-import os,sys,subprocess,signal,select,json
-TIMEOUT=120
-
-def w(s):
-	sys.stdout.write(repr(s) + "\n")
-	sys.stdout.flush()
-
-def exec_cmds(cmds):
-	p=[]
-	for i,cmd in enumerate(cmds):
-		try:
-			proc=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE __SHELL__)
-			p.append((i,proc))
-		except Exception as e:
-			w((i,(1,'',str(e))))
-	return p
-
-w("ready")
-commands=[]
-signal.alarm(TIMEOUT)
-for line in iter(sys.stdin.readline,"done\n"):
-	commands.append(json.loads(line))
-
-procs=exec_cmds(commands)
-cmd_map={}
-fd_map={}
-fds=set()
-for i,proc in procs:
-	o={"idx":i, "proc":proc, "stdout":[], "stderr":[], "waiting":2}
-	fd_map[proc.stdout]=o["stdout"]
-	fd_map[proc.stderr]=o["stderr"]
-	cmd_map[proc.stdout]=o
-	cmd_map[proc.stderr]=o
-	fds.update((proc.stdout,proc.stderr))
-
-while fds:
-	r,_,_=select.select(fds,[],[])
-	for fd in r:
-		output=os.read(fd.fileno(),1024)
-		if output:
-			fd_map[fd].append(output)
-			continue
-
-		cmd=cmd_map[fd]
-		fds.remove(fd)
-		cmd["waiting"]-=1
-		if cmd["waiting"]:
-			continue
-
-		proc=cmd["proc"]
-		status=proc.wait()
-		out=b"".join(cmd["stdout"])
-		err=b"".join(cmd["stderr"])
-		w((cmd["idx"],(status,out,err)))
-
-w("done")
-"""
-
-    if shell:
-        muxer = muxer.replace("__SHELL__", ",shell=True")
-    else:
-        muxer = muxer.replace("__SHELL__", "")
+    muxer = inspect.getsource(muxer_mod)
 
     if py3zeek.using_py3:
         muxer = muxer.encode()
@@ -102,8 +43,84 @@ w("done")
 
 CmdResult = collections.namedtuple("CmdResult", "status stdout stderr")
 
+# The muxer kills each command that runs longer than the command timeout and
+# then reports the timeout itself.  When reading the muxer's results, we wait
+# a few more seconds than that before giving up on the connection.
+READ_GRACE = 5
+
+# Incrementally decodes the frames sent by the muxer.  Data is added with
+# feed(), and complete frames are returned by next_frame() as tuples
+# (type, request ID, command index, payload).
+class FrameParser:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def next_frame(self):
+        hdrlen = muxer_mod.FRAME_HEADER.size
+        if len(self.buf) < hdrlen:
+            return None
+
+        ftype, rid, idx, length = muxer_mod.FRAME_HEADER.unpack(bytes(self.buf[:hdrlen]))
+        if len(self.buf) < hdrlen + length:
+            return None
+
+        payload = bytes(self.buf[hdrlen:hdrlen + length])
+        del self.buf[:hdrlen + length]
+        return ftype, rid, idx, payload
+
+    # Discard everything up to and including the muxer's "ready" line.
+    # Returns True if the line was found.
+    def skip_to_ready(self):
+        pos = self.buf.find(muxer_mod.READY)
+        if pos < 0:
+            return False
+
+        del self.buf[:pos + len(muxer_mod.READY)]
+        return True
+
+# Collects the frames of one request into a list of CmdResult tuples (or
+# None for each skipped command).
+class ResultCollector:
+    def __init__(self, host, ncmds):
+        self.host = host
+        self.outputs = [Exception("Command timeout on host %s" % host)] * ncmds
+        self.stdout = collections.defaultdict(list)
+        self.stderr = collections.defaultdict(list)
+        self.done = False
+
+    def add(self, ftype, idx, payload):
+        if ftype == muxer_mod.FRAME_STDOUT:
+            self.stdout[idx].append(payload)
+        elif ftype == muxer_mod.FRAME_STDERR:
+            self.stderr[idx].append(payload)
+        elif ftype == muxer_mod.FRAME_EXIT:
+            status, = muxer_mod.FRAME_STATUS.unpack(payload)
+            out = b"".join(self.stdout.pop(idx, []))
+            err = b"".join(self.stderr.pop(idx, []))
+
+            if py3zeek.using_py3:
+                out = out.decode(errors="replace")
+                err = err.decode(errors="replace")
+
+            self.outputs[idx] = CmdResult(status, out, err)
+        elif ftype == muxer_mod.FRAME_TIMEOUT:
+            self.stdout.pop(idx, None)
+            self.stderr.pop(idx, None)
+            self.outputs[idx] = Exception("Command timeout on host %s" % self.host)
+        elif ftype == muxer_mod.FRAME_SKIPPED:
+            self.stdout.pop(idx, None)
+            self.stderr.pop(idx, None)
+            self.outputs[idx] = None
+        elif ftype == muxer_mod.FRAME_DONE:
+            self.done = True
+
 class SSHMaster:
-    def __init__(self, host, localaddrs):
+    # The "limits" are a tuple (max, {class: max}) that limits the number of
+    # commands that the muxer runs at the same time (see muxer.run_request).
+    def __init__(self, host, localaddrs, limits=None):
         # The BatchMode=yes disables interactive prompting.  The LogLevel=error
         # prevents seeing login banners but allows error messages from ssh.
         self.base_cmd = [
@@ -116,8 +133,11 @@ class SSHMaster:
         self.need_connect = True
         self.master = None
         self.localaddrs = localaddrs
-        self.run_mux = get_muxer(False)
-        self.run_mux_shell = get_muxer(True)
+        self.run_mux = get_muxer()
+        self.limits = limits
+        self.muxer_running = False
+        self.request_id = 0
+        self.write_lock = Lock()
 
     def connect(self):
         if self.need_connect:
@@ -127,15 +147,47 @@ class SSHMaster:
                 cmd = self.base_cmd + ["sh"]
             self.master = subprocess.Popen(cmd, bufsize=0, stdout=subprocess.PIPE, stdin=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
             self.need_connect = False
+            self.muxer_running = False
+
+    # Start the muxer on the host, unless it is already running.  The muxer
+    # stays running for as long as the connection is open and serves any
+    # number of requests.
+    def start_muxer(self, timeout):
+        self.connect()
+        if self.muxer_running:
+            return
+
+        self.parser = FrameParser()
+        self.master.stdin.write(self.run_mux)
+        self.master.stdin.flush()
+
+        # Wait until we receive the "ready" message from muxer script
+        while not self.parser.skip_to_ready():
+            if not self.read_with_timeout(timeout):
+                self.close()
+                raise Exception("Failed to start command muxer on host %s" % self.host)
 
-    def readline_with_timeout(self, timeout):
+        self.muxer_running = True
+
+    # Read whatever data is available from the muxer into the frame parser.
+    # Returns False on timeout or if the connection was closed.
+    def read_with_timeout(self, timeout):
         readable, _, _ = select.select([self.master.stdout], [], [], timeout)
         if not readable:
-            return None
-        jtxt = self.master.stdout.readline()
-        if py3zeek.using_py3:
-            jtxt = jtxt.decode()
-        return jtxt
+            return False
+        data = os.read(self.master.stdout.fileno(), muxer_mod.READ_SIZE)
+        if not data:
+            return False
+        self.parser.feed(data)
+        return True
+
+    def read_frame_with_timeout(self, timeout):
+        while True:
+            frame = self.parser.next_frame()
+            if frame:
+                return frame
+            if not self.read_with_timeout(timeout):
+                return None
 
     def exec_command(self, cmd, shell=False, timeout=60):
         return self.exec_commands([cmd], shell, timeout)[0]
@@ -144,48 +196,67 @@ class SSHMaster:
         self.send_commands(cmds, timeout, shell)
         return self.collect_results(timeout)
 
-    def send_commands(self, cmds, timeout, shell=False):
-        self.connect()
-        if shell:
-            self.master.stdin.write(self.run_mux_shell)
-        else:
-            self.master.stdin.write(self.run_mux)
-        self.master.stdin.flush()
+    # Same as exec_commands, but returns a generator that yields the frames
+    # of the request as they arrive (see read_frames).
+    def stream_commands(self, cmds, shell=False, timeout=60):
+        self.send_commands(cmds, timeout, shell)
+        return self.read_frames(timeout)
 
-        # Wait until we receive the "ready" message from muxer script
-        self.readline_with_timeout(timeout)
+    def send_commands(self, cmds, timeout, shell=False):
+        self.start_muxer(timeout)
 
-        for cmd in cmds:
-            jcmd = "%s\n" % json.dumps(cmd)
-            if py3zeek.using_py3:
-                jcmd = jcmd.encode()
-            self.master.stdin.write(jcmd)
-        # Note: the "b" string prefix here for Py3 is ignored by Py2.6-2.7
-        self.master.stdin.write(b"done\n")
-        self.master.stdin.flush()
+        self.request_id += 1
+        req = {"id": self.request_id, "shell": shell, "cmds": cmds, "timeout": timeout}
+        if self.limits:
+            req["max"], req["limits"] = self.limits
+        self.write_msg(req)
         self.sent_commands = len(cmds)
 
-    def collect_results(self, timeout):
-        outputs = [Exception("Command timeout on host %s" % self.host)] * self.sent_commands
+    def write_msg(self, msg):
+        msg = "%s\n" % json.dumps(msg)
+        if py3zeek.using_py3:
+            msg = msg.encode()
+        with self.write_lock:
+            self.master.stdin.write(msg)
+            self.master.stdin.flush()
+
+    # Cancel the current request (see muxer.run_request).  This can be called
+    # from any thread.
+    def cancel(self):
+        if not self.muxer_running:
+            return
+        try:
+            self.write_msg({"cancel": self.request_id})
+        except (IOError, OSError, ValueError, AttributeError):
+            # The connection is gone.
+            pass
 
+    # Yields tuples (type, idx, payload) for each frame of the current
+    # request, up to and including the "done" frame.  If no frame is received
+    # within the timeout (plus READ_GRACE), then the connection is closed and
+    # the generator stops without a "done" frame.
+    def read_frames(self, timeout):
         while True:
-            line = self.readline_with_timeout(timeout)
-            if not line:
+            frame = self.read_frame_with_timeout(timeout + READ_GRACE)
+            if not frame:
                 logging.debug("Command timeout on host %s", self.host)
                 self.close()
-                break
-            resp = ast.literal_eval(line)
-            if resp == "done":
-                break
-            idx, result = resp
-            status, out, err = result
+                return
+            ftype, rid, idx, payload = frame
+            if rid != self.request_id:
+                # Left over from an earlier request.
+                continue
+            yield ftype, idx, payload
+            if ftype == muxer_mod.FRAME_DONE:
+                return
 
-            if py3zeek.using_py3:
-                out = out.decode(errors="replace")
-                err = err.decode(errors="replace")
+    def collect_results(self, timeout):
+        results = ResultCollector(self.host, self.sent_commands)
 
-            outputs[idx] = CmdResult(status, out, err)
-        return outputs
+        for ftype, idx, payload in self.read_frames(timeout):
+            results.add(ftype, idx, payload)
+
+        return results.outputs
 
     def close(self):
         if not self.master:
@@ -198,28 +269,36 @@ class SSHMaster:
         self.master.wait()
         self.master = None
         self.need_connect = True
+        self.muxer_running = False
     __del__ = close
 
 
 STOP_RUNNING = object()
 
+# Pseudo frame type used for commands that did not produce a result (the
+# payload is an Exception describing the problem).
+FRAME_ERROR = "error"
+
 class HostHandler(Thread):
-    def __init__(self, host, localaddrs, timeout):
+    def __init__(self, host, localaddrs, timeout, livenessttl=0, limits=None):
         self.host = host
         self.localaddrs = localaddrs
         self.timeout = timeout
+        self.livenessttl = livenessttl
+        self.limits = limits
         self.q = Queue()
         self.alive = False
+        self.last_alive = 0
         self.master = None
         Thread.__init__(self)
 
     def shutdown(self):
-        self.q.put((STOP_RUNNING, None, None))
+        self.q.put((STOP_RUNNING, None, None, False))
 
     def connect(self):
         if self.master:
             self.master.close()
-        self.master = SSHMaster(self.host, self.localaddrs)
+        self.master = SSHMaster(self.host, self.localaddrs, self.limits)
 
     def ping(self):
         # Error message should indicate whether or not ssh is being used.
@@ -251,7 +330,7 @@ class HostHandler(Thread):
             return msg
 
         if ping_recvd:
-            self.alive = True
+            self.mark_alive()
             return ""
 
         # This should probably never happen.
@@ -262,6 +341,29 @@ class HostHandler(Thread):
             self.connect()
         return self.ping()
 
+    def mark_alive(self):
+        self.alive = True
+        self.last_alive = time.time()
+
+    # Return an error message if the host is not reachable, or an empty
+    # string otherwise.  The host is only pinged if it is not known to be
+    # alive, or if the last sign of life is older than the liveness TTL
+    # (the idle-timeout heartbeat refreshes it on otherwise unused
+    # connections).
+    def check_alive(self):
+        if self.alive and time.time() - self.last_alive < self.livenessttl:
+            return ""
+        return self.connect_and_ping()
+
+    # Update the liveness of the host after a request.  If the request timed
+    # out, the connection was closed and the host is no longer considered
+    # alive.
+    def request_done(self):
+        if self.master.need_connect:
+            self.alive = False
+        else:
+            self.mark_alive()
+
     def run(self):
         while True:
             if self.iteration():
@@ -269,7 +371,7 @@ class HostHandler(Thread):
 
     def iteration(self):
         try:
-            item, shell, rq = self.q.get(timeout=30)
+            item, shell, rq, stream = self.q.get(timeout=30)
         except Empty:
             self.connect_and_ping()
             return False
@@ -277,7 +379,11 @@ class HostHandler(Thread):
         if item is STOP_RUNNING:
             return True
 
-        msg = self.connect_and_ping()
+        if stream:
+            self.stream_commands(item, shell, rq)
+            return False
+
+        msg = self.check_alive()
         if not self.alive:
             logging.debug(msg)
             resp = [Exception(msg)] * len(item)
@@ -286,51 +392,239 @@ class HostHandler(Thread):
 
         try:
             resp = self.master.exec_commands(item, shell, self.timeout)
+            self.request_done()
         except Exception as e:
-            self.alive = False
-            msgstr = "" if self.host in self.localaddrs else "ssh "
-            msg = "Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e)
-            logging.debug(msg)
+            msg = self.lost_connection(e)
             resp = [Exception(msg)] * len(item)
-            time.sleep(2)
         rq.put(resp)
 
         return False
 
-    def send_commands(self, commands, shell, rq):
-        self.q.put((commands, shell, rq))
+    def lost_connection(self, e):
+        self.alive = False
+        msgstr = "" if self.host in self.localaddrs else "ssh "
+        msg = "Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e)
+        logging.debug(msg)
+        time.sleep(2)
+        return msg
+
+    # Run the commands and put each frame into the queue "rq" as soon as it
+    # arrives, in the form (host, idx, type, payload).  Commands without an
+    # exit status get a frame of type FRAME_ERROR, and the last frame put
+    # into the queue is always of type FRAME_DONE.
+    def stream_commands(self, item, shell, rq):
+        pending = set(range(len(item)))
+
+        msg = self.check_alive()
+        if self.alive:
+            msg = "Command timeout on host %s" % self.host
+            try:
+                for ftype, idx, payload in self.master.stream_commands(item, shell, self.timeout):
+                    if ftype == muxer_mod.FRAME_DONE:
+                        break
+                    if ftype == muxer_mod.FRAME_TIMEOUT:
+                        # Report this like a command without result.
+                        ftype, payload = FRAME_ERROR, Exception("Command timeout on host %s" % self.host)
+                    if ftype in (muxer_mod.FRAME_EXIT, muxer_mod.FRAME_SKIPPED, FRAME_ERROR):
+                        pending.discard(idx)
+                    rq.put((self.host, idx, ftype, payload))
+                self.request_done()
+            except Exception as e:
+                msg = self.lost_connection(e)
+        else:
+            logging.debug(msg)
+
+        for idx in sorted(pending):
+            rq.put((self.host, idx, FRAME_ERROR, Exception(msg)))
+
+        rq.put((self.host, -1, muxer_mod.FRAME_DONE, None))
+
+    def send_commands(self, commands, shell, rq, stream=False):
+        self.q.put((commands, shell, rq, stream))
+
+    # Cancel the request that is currently running (called from the
+    # controller's thread).
+    def cancel(self):
+        master = self.master
+        if master:
+            master.cancel()
+
+
+# Runs the commands for a local host directly from the zeekctl process,
+# instead of starting a shell and the command muxer.  The requests are run
+# by the muxer's code (see muxer.run_request) in the handler's thread, so
+# that timeouts, streaming output and cancelling work in the same way as on
+# remote hosts.  At most "workers" commands run at the same time, and the
+# "limits" (see SSHMaster) apply as well.  Built-in operations are run in
+# threads instead of child processes.
+class LocalHostHandler(HostHandler):
+    def __init__(self, host, localaddrs, timeout, workers, limits=None):
+        HostHandler.__init__(self, host, localaddrs, timeout, limits=limits)
+        self.workers = workers
+        self.alive = True
+        self.request_id = 0
+
+        # Cancel messages reach run_request through a pipe, like the
+        # muxer's stdin.
+        rfd, self.cancel_fd = os.pipe()
+        self.reader = muxer_mod.LineReader(rfd)
+
+    def iteration(self):
+        item, shell, rq, stream = self.q.get()
+
+        if item is STOP_RUNNING:
+            os.close(self.cancel_fd)
+            os.close(self.reader.fd)
+            return True
+
+        self.request_id += 1
+        # The muxer modifies the commands.
+        cmds = [dict(cmd) if isinstance(cmd, dict) else cmd for cmd in item]
+        req = {"id": self.request_id, "shell": shell, "cmds": cmds, "timeout": self.timeout, "max": self.workers}
+        if self.limits:
+            maxrunning, req["limits"] = self.limits
+            if maxrunning > 0:
+                req["max"] = min(maxrunning, self.workers)
+
+        parser = FrameParser()
+        results = ResultCollector(self.host, len(item))
+
+        def send(data):
+            parser.feed(data)
+            while True:
+                frame = parser.next_frame()
+                if not frame:
+                    break
+                ftype, rid, idx, payload = frame
+                if stream:
+                    self.put_frame(rq, ftype, idx, payload)
+                else:
+                    results.add(ftype, idx, payload)
+
+        muxer_mod.run_request(req, self.reader, send, LocalBuiltinProc)
+
+        if not stream:
+            rq.put(results.outputs)
+
+        return False
+
+    # Put a frame into the queue "rq" (see HostHandler.stream_commands).
+    def put_frame(self, rq, ftype, idx, payload):
+        if ftype == muxer_mod.FRAME_TIMEOUT:
+            ftype, payload = FRAME_ERROR, Exception("Command timeout on host %s" % self.host)
+        elif ftype == muxer_mod.FRAME_DONE:
+            payload = None
+        rq.put((self.host, idx, ftype, payload))
+
+    # Cancel the request that is currently running (called from the
+    # controller's thread).
+    def cancel(self):
+        try:
+            os.write(self.cancel_fd, ("%s\n" % json.dumps({"cancel": self.request_id})).encode())
+        except OSError:
+            # The handler has been shut down.
+            pass
+
+
+# Runs a built-in operation of the muxer in a thread of the zeekctl process.
+# Provides the same interface as muxer.BuiltinProc.
+class LocalBuiltinProc:
+    def __init__(self, name, args):
+        muxer_mod.check_builtin(name)
+
+        rout, self.wout = os.pipe()
+        rerr, self.werr = os.pipe()
+        self.stdout = os.fdopen(rout, "rb")
+        self.stderr = os.fdopen(rerr, "rb")
+        self.killed = Event()
+        self.status = 1
+
+        self.thread = Thread(target=self.run, args=(name, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, name, args):
+        muxer_mod.set_killed_event(self.killed)
+        try:
+            try:
+                muxer_mod.writeall(self.wout, muxer_mod.call_builtin(name, args, self.output).encode())
+                self.status = 0
+            except Exception as e:
+                muxer_mod.writeall(self.werr, str(e).encode())
+        except OSError:
+            # The operation was killed, and nobody reads the output anymore.
+            pass
+        finally:
+            os.close(self.wout)
+            os.close(self.werr)
+
+    # Streaming operations stop once this returns False.
+    def output(self, data):
+        if self.killed.is_set():
+            return False
+        muxer_mod.writeall(self.wout, data.encode())
+        return True
+
+    # Operations that wait (see muxer.pause) stop as soon as they are killed,
+    # and "stop" doesn't send its signal anymore.  The others only read
+    # something and finish on their own; their results are discarded.
+    def kill_group(self):
+        self.killed.set()
+
+    def wait(self):
+        if self.killed.is_set():
+            return -signal.SIGKILL
+        self.thread.join()
+        return self.status
 
 
 class MultiMasterManager:
-    def __init__(self, localaddrs=[]):
+    # If a "breaker" (see breaker.py) is given, then commands for hosts that
+    # are considered down fail immediately.
+    # If "localworkers" is greater than zero, then commands for local hosts
+    # are run directly by a LocalHostHandler.  The "limits" apply to the
+    # commands of each host (see SSHMaster).
+    def __init__(self, localaddrs=[], livenessttl=0, breaker=None, localworkers=0, limits=None):
         self.masters = {}
         self.response_queues = {}
         self.localaddrs = localaddrs
+        self.livenessttl = livenessttl
+        self.breaker = breaker
+        self.localworkers = localworkers
+        self.limits = limits
 
     def setup(self, host, timeout):
         if host not in self.masters:
-            self.masters[host] = HostHandler(host, self.localaddrs, timeout)
-            self.masters[host].start()
+            if host in self.localaddrs and self.localworkers > 0:
+                self.masters[host] = LocalHostHandler(host, self.localaddrs, timeout, self.localworkers, self.limits)
+                self.masters[host].start()
+            else:
+                self.masters[host] = self.create_handler(host, timeout)
+
+    def create_handler(self, host, timeout):
+        handler = HostHandler(host, self.localaddrs, timeout, self.livenessttl, self.limits)
+        handler.start()
+        return handler
 
     def send_commands(self, host, commands, timeout, shell=False):
         self.setup(host, timeout)
         rq = Queue()
-        self.response_queues[host] = rq
+        self.response_queues[host] = (rq, len(commands))
         self.masters[host].send_commands(commands, shell, rq)
 
     def get_result(self, host, hosttimeout):
-        # Add a few seconds to the host timeout in order to let the
-        # command timeout happen first.
-        hosttimeout += 5
+        rq, ncmds = self.response_queues[host]
 
-        rq = self.response_queues[host]
+        # Each command is killed once it exceeds the host timeout, and the
+        # handler gives up on a connection that stays silent for longer than
+        # that, so the handler always returns a result.  Waiting here for the
+        # case that all commands run one after another (plus a few seconds to
+        # let the other timeouts happen first) is only a safety net.
         try:
-            return rq.get(timeout=hosttimeout)
+            return rq.get(timeout=hosttimeout * max(ncmds, 1) + READ_GRACE)
         except Empty:
             self.shutdown(host)
-            # This can happen due to commands that take a while to run, a
-            # loss of connectivity to remote host, or both.
-            return [Exception("Timeout waiting for commands to finish on host %s" % host)] #FIXME: needs to be the right length
+            return [Exception("Timeout waiting for commands to finish on host %s" % host)] * ncmds
 
     def exec_command(self, host, command, timeout=30):
         return self.exec_commands(host, [command], timeout)[0]
@@ -339,18 +633,100 @@ class MultiMasterManager:
         self.send_commands(host, commands, timeout)
         return self.get_result(host, timeout)
 
+    # Returns a list of the hosts (among "hosts") that are considered down,
+    # and thus should not be sent any commands.
+    def down_hosts(self, hosts):
+        if not self.breaker:
+            return set()
+        return set(hosts) - self.breaker.allowed(hosts)
+
+    # Tell the breaker whether any command could be run on the host.
+    def record(self, host, success):
+        if self.breaker:
+            self.breaker.record(host, success)
+
     def exec_multihost_commands(self, cmds, shell=False, timeout=60):
         hosts = collections.defaultdict(list)
         for host, cmd in cmds:
             hosts[host].append(cmd)
 
+        down = self.down_hosts(hosts)
+
         for host, cmds in hosts.items():
-            self.send_commands(host, cmds, timeout, shell)
+            if host not in down:
+                self.send_commands(host, cmds, timeout, shell)
 
         for host in hosts:
-            for res in self.get_result(host, timeout):
+            if host in down:
+                err = Exception("Command not run on host %s: %s" % (host, breaker_mod.HOST_DOWN))
+                results = [err] * len(hosts[host])
+            else:
+                results = self.get_result(host, timeout)
+                self.record(host, not all(isinstance(res, Exception) for res in results))
+
+            for res in results:
                 yield host, res
 
+    # Same as exec_multihost_commands, but yields tuples (idx, type, payload)
+    # for each frame as soon as it is received from any host, where "idx" is
+    # the index of the command in "cmds".  There is exactly one frame of
+    # type FRAME_EXIT or FRAME_ERROR for each command.
+    def stream_multihost_commands(self, cmds, shell=False, timeout=60):
+        hosts = collections.defaultdict(list)
+        for i, (host, cmd) in enumerate(cmds):
+            hosts[host].append((i, cmd))
+
+        down = self.down_hosts(hosts)
+        for host in down:
+            err = Exception("Command not run on host %s: %s" % (host, breaker_mod.HOST_DOWN))
+            for i, cmd in hosts[host]:
+                yield i, FRAME_ERROR, err
+
+        events = Queue()
+        for host, hostcmds in hosts.items():
+            if host not in down:
+                self.setup(host, timeout)
+                self.masters[host].send_commands([cmd for i, cmd in hostcmds], shell, events, True)
+
+        pending = set(hosts) - down
+        finished = set()
+        # Hosts on which at least one command has run.
+        reached = set()
+        while pending:
+            try:
+                host, idx, ftype, payload = events.get(timeout=timeout + READ_GRACE)
+            except Empty:
+                break
+
+            if ftype == muxer_mod.FRAME_DONE:
+                pending.discard(host)
+                self.record(host, host in reached)
+                continue
+
+            i = hosts[host][idx][0]
+            if ftype in (muxer_mod.FRAME_EXIT, muxer_mod.FRAME_SKIPPED, FRAME_ERROR):
+                finished.add(i)
+            if ftype == muxer_mod.FRAME_EXIT:
+                reached.add(host)
+
+            yield i, ftype, payload
+
+        for host in pending:
+            # This can happen due to commands that take a while to run, a
+            # loss of connectivity to remote host, or both.
+            self.shutdown(host)
+            self.record(host, host in reached)
+            err = Exception("Timeout waiting for commands to finish on host %s" % host)
+            for i, cmd in hosts[host]:
+                if i not in finished:
+                    yield i, FRAME_ERROR, err
+
+    # Cancel the running request (if any) on each of the hosts.
+    def cancel(self, hosts):
+        for host in hosts:
+            if host in self.masters:
+                self.masters[host].cancel()
+
     def host_status(self):
         for h, o in self.masters.items():
             if h not in self.localaddrs:
@@ -7,6 +7,20 @@ class SqliteState:
     def __init__(self, path):
         self.path = path
 
+        # While a batch is open (see begin_batch), changes are collected here
+        # and only written when the outermost batch ends.
+        self.batch = 0
+        self.pending = {}
+
+        # Every write stores a new revision number with the row (see setup), so
+        # that changes() only needs to read the rows written since the highest
+        # revision we have seen.  The data version changes when another
+        # connection modifies the database.
+        self.rev = -1
+        self.data_version = None
+        # The keys in the database as of the last call to changes().
+        self.keys = set()
+
         try:
             self.db = sqlite3.connect(self.path)
         except sqlite3.Error as err:
@@ -20,15 +34,45 @@ class SqliteState:
             raise RuntimeEnvironmentError("%s: %s\nCheck if the user running ZeekControl has write access to the database file.\nOtherwise, the database file is possibly corrupt." % (err, path))
 
     def setup(self):
+        # In WAL mode, readers don't block the writer (and vice versa).  This
+        # has no effect for an in-memory database.  Each commit is synced to
+        # disk, so that no PIDs of running nodes are lost.
+        self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=FULL")
+
         # Create table
         self.c.execute('''CREATE TABLE IF NOT EXISTS state (
             key   TEXT  PRIMARY KEY  NOT NULL,
-            value TEXT
+            value TEXT,
+            rev   INTEGER  NOT NULL  DEFAULT 0
         )''')
 
+        # Databases created by older versions don't have revisions.
+        self.c.execute("PRAGMA table_info(state)")
+        if "rev" not in [col[1] for col in self.c.fetchall()]:
+            self.c.execute("ALTER TABLE state ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+
+        self.c.execute("CREATE INDEX IF NOT EXISTS state_rev ON state (rev)")
+
+        # The last revision that was assigned.
+        self.c.execute("CREATE TABLE IF NOT EXISTS revision (rev INTEGER NOT NULL)")
+        self.c.execute("INSERT INTO revision SELECT IFNULL(MAX(rev), 0) FROM state WHERE NOT EXISTS (SELECT * FROM revision)")
+
+        # Each row that is written gets the next revision.  This is done by a
+        # trigger, so that it also works for older versions of zeekctl.
+        self.c.execute('''CREATE TRIGGER IF NOT EXISTS state_rev_insert
+            AFTER INSERT ON state WHEN NEW.rev = 0
+            BEGIN
+                UPDATE revision SET rev = rev + 1;
+                UPDATE state SET rev = (SELECT rev FROM revision) WHERE key = NEW.key;
+            END''')
+
         self.db.commit()
 
     def get(self, key):
+        if key in self.pending:
+            return self._load(self.pending[key])
+
         self.c.execute("SELECT value FROM state WHERE key=?", [key])
         records = self.c.fetchall()
         if records:
@@ -36,14 +80,94 @@ class SqliteState:
         return None
 
     def set(self, key, value):
-        value = json.dumps(value)
+        self.pending[key] = json.dumps(value)
+        if not self.batch:
+            self.flush()
+
+    def delete(self, key):
+        self.pending[key] = None
+        if not self.batch:
+            self.flush()
+
+    # Set the value only if the key doesn't exist yet.
+    def setdefault(self, key, value):
+        if self.get(key) is None:
+            self.set(key, value)
+
+    # Collect all changes until the matching end_batch call, and then write
+    # them in a single transaction.  Batches can be nested.
+    def begin_batch(self):
+        self.batch += 1
+
+    def end_batch(self):
+        self.batch -= 1
+        if not self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
         try:
-            self.c.execute("REPLACE INTO state (key, value) VALUES (?,?)", [key, value])
+            deleted = [k for (k, v) in self.pending.items() if v is None]
+            self.c.executemany("REPLACE INTO state (key, value) VALUES (?,?)", [(k, v) for (k, v) in self.pending.items() if v is not None])
+            self.c.executemany("DELETE FROM state WHERE key=?", [(k,) for k in deleted])
+            self.db.commit()
+            self.keys.update(self.pending)
+            self.keys.difference_update(deleted)
         except sqlite3.Error as err:
+            self.db.rollback()
             raise RuntimeEnvironmentError("%s: %s\nCheck if the user running ZeekControl has write access to the database file." % (err, self.path))
+        finally:
+            self.pending = {}
 
-        self.db.commit()
+    # Returns a tuple (full, items), where "items" is a list of (key, value)
+    # tuples of the state variables that have changed since the last call.
+    # If "full" is True, then "items" contains all state variables instead
+    # (always on the first call, and whenever rows might have been removed or
+    # written without a new revision).  Our own changes are included as well,
+    # unless nobody else has modified the database since the last call.
+    def changes(self):
+        self.c.execute("PRAGMA data_version")
+        data_version = self.c.fetchone()[0]
+        if data_version == self.data_version:
+            return (False, [])
+
+        self.c.execute("SELECT key, value, rev FROM state WHERE rev > ?", [self.rev])
+        rows = self.c.fetchall()
+
+        items = {}
+        for (k, v, rev) in rows:
+            items[k] = v
+            self.rev = max(self.rev, rev)
+
+        full = self.data_version is None or not rows
+        self.data_version = data_version
+
+        if not full:
+            self.keys.update(items)
+            self.c.execute("SELECT COUNT(*) FROM state")
+            full = self.c.fetchone()[0] != len(self.keys)
+
+        if full:
+            self.c.execute("SELECT key, value, rev FROM state")
+            items = {}
+            for (k, v, rev) in self.c.fetchall():
+                items[k] = v
+                self.rev = max(self.rev, rev)
+            self.keys = set(items)
+
+        items.update(self.pending)
+        return (full, [(k, json.loads(v)) for (k, v) in items.items() if v is not None])
 
     def items(self):
         self.c.execute("SELECT key, value FROM state")
-        return [(k, json.loads(v)) for (k, v) in self.c.fetchall()]
+        items = dict(self.c.fetchall())
+        items.update(self.pending)
+        return [(k, json.loads(v)) for (k, v) in items.items() if v is not None]
+
+    # Pending deletions have the value None.
+    def _load(self, value):
+        if value is None:
+            return None
+        return json.loads(value)
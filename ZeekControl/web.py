@@ -29,6 +29,12 @@ def nodes():
     print "\n\n\nReturning", s, "\n\n"
     return {"result": s}
 
+@app.route('/netstats')
+@app.route('/netstats/:nodes')
+def netstats(nodes=None):
+    s = app.daemon.sync_call("netstats", nodes)
+    return {"result": s}
+
 @app.route('/exec/:cmd')
 def start(cmd):
     i = app.daemon.call("execute", cmd)
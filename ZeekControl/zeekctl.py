@@ -37,7 +37,8 @@ def lock_required(func):
     def wrapper(self, *args, **kwargs):
         self.lock()
         try:
-            return func(self, *args, **kwargs)
+            with self.config.state_batch():
+                return func(self, *args, **kwargs)
         finally:
             self.unlock()
     wrapper.lock_required = True
@@ -47,7 +48,74 @@ def lock_required_silent(func):
     def wrapper(self, *args, **kwargs):
         self.lock(showwait=False)
         try:
-            return func(self, *args, **kwargs)
+            with self.config.state_batch():
+                return func(self, *args, **kwargs)
+        finally:
+            self.unlock()
+    wrapper.lock_required = True
+    return wrapper
+
+# Returns the argument "name" of a call to "func" (or None if it's not given).
+def _call_arg(func, name, args, kwargs):
+    if name in kwargs:
+        return kwargs[name]
+
+    # Skip "self".
+    idx = func.__code__.co_varnames.index(name) - 1
+    if idx < len(args):
+        return args[idx]
+    return None
+
+# For commands that operate on individual nodes, so that commands for
+# different nodes can run at the same time (see lock.lock_nodes).  Commands
+# that don't modify anything ("shared") can also run at the same time for the
+# same nodes.
+def _lock_nodes(func, shared):
+    def wrapper(self, *args, **kwargs):
+        nodes = self.node_args(_call_arg(func, "node_list", args, kwargs))
+        self.lock_nodes(nodes, shared=shared)
+        try:
+            with self.config.state_batch():
+                return func(self, *args, **kwargs)
+        finally:
+            self.unlock_nodes(nodes)
+    wrapper.lock_required = True
+    return wrapper
+
+def node_lock_required(func):
+    return _lock_nodes(func, False)
+
+# For "restart", which with "clean" also runs "check" and "install".  These
+# need the global lock exclusively, so that is taken first instead of the
+# node locks (see lock.lock).
+def restart_lock_required(func):
+    nodelocked = node_lock_required(func)
+    locked = lock_required(func)
+
+    def wrapper(self, *args, **kwargs):
+        if _call_arg(func, "clean", args, kwargs):
+            return locked(self, *args, **kwargs)
+        return nodelocked(self, *args, **kwargs)
+    wrapper.lock_required = True
+    return wrapper
+
+# Commands with a shared lock don't change the configuration or the nodes,
+# but they can still write some state when they find out something new:
+# that a node has crashed (see Controller._isrunning), and whether a host
+# can be reached (see breaker.CircuitBreaker).  This is safe while other
+# commands hold the same locks: a node can't be started or stopped while it
+# is locked shared, so any command that checks it finds the same, and
+# writes only the keys that it changed (see state.SqliteState.flush).  At
+# worst, concurrent failures on a host are counted once.
+def lock_shared(func):
+    if "node_list" in func.__code__.co_varnames:
+        return _lock_nodes(func, True)
+
+    def wrapper(self, *args, **kwargs):
+        self.lock(shared=True)
+        try:
+            with self.config.state_batch():
+                return func(self, *args, **kwargs)
         finally:
             self.unlock()
     wrapper.lock_required = True
@@ -62,7 +130,7 @@ def check_config(func):
     return wrapper
 
 class ZeekCtl(object):
-    def __init__(self, basedir=version.ZEEKBASE, cfgfile=version.CFGFILE, zeekscriptdir=version.ZEEKSCRIPTDIR, ui=TermUI(), state=None):
+    def __init__(self, basedir=version.ZEEKBASE, cfgfile=version.CFGFILE, zeekscriptdir=version.ZEEKSCRIPTDIR, ui=TermUI(), state=None, heartbeat=False):
         self.ui = ui
         self.zeekbase = basedir
 
@@ -85,7 +153,7 @@ class ZeekCtl(object):
             h = NullHandler()
             logging.getLogger().addHandler(h)
 
-        self.executor = execute.Executor(self.config)
+        self.executor = execute.Executor(self.config, heartbeat)
         self.plugins = pluginreg.PluginRegistry()
         self.setup()
         self.controller = control.Controller(self.config, self.ui, self.executor, self.plugins)
@@ -187,8 +255,8 @@ class ZeekCtl(object):
 
         return nodes
 
-    def lock(self, showwait=True):
-        lockstatus = lock.lock(self.ui, showwait)
+    def lock(self, showwait=True, shared=False):
+        lockstatus = lock.lock(self.ui, showwait, shared)
         if not lockstatus:
             raise LockError("Unable to get lock")
 
@@ -197,6 +265,16 @@ class ZeekCtl(object):
     def unlock(self):
         lock.unlock(self.ui)
 
+    def lock_nodes(self, nodes, showwait=True, shared=False):
+        lockstatus = lock.lock_nodes(self.ui, nodes, showwait, shared)
+        if not lockstatus:
+            raise LockError("Unable to get lock")
+
+        self.config.read_state()
+
+    def unlock_nodes(self, nodes):
+        lock.unlock_nodes(self.ui, nodes)
+
     def node_names(self):
         return [ n.name for n in self.config.nodes() ]
 
@@ -245,7 +323,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @node_lock_required
     def start(self, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -257,7 +335,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @node_lock_required
     def stop(self, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -269,7 +347,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @restart_lock_required
     def restart(self, clean=False, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -341,7 +419,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def status(self, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -351,7 +429,7 @@ class ZeekCtl(object):
         return results
 
     @expose
-    @lock_required
+    @lock_shared
     def top(self, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -361,14 +439,30 @@ class ZeekCtl(object):
 
         return results
 
+    # Same as top, but calls "callback" with an updated CmdResult whenever
+    # new samples are available (see Controller.top_stream).  This doesn't
+    # need the lock, because it doesn't modify the node state, but it reads
+    # the state again on each call, so that it sees the PIDs of nodes that
+    # were started or stopped by another zeekctl in the meantime.
+    @expose
+    def top_stream(self, callback, node_list=None):
+        self.config.read_state()
+        nodes = self.node_args(node_list)
+
+        nodes = self.plugins.cmdPreWithNodes("top", nodes)
+        finished = self.controller.top_stream(nodes, callback)
+        self.plugins.cmdPostWithNodes("top", nodes)
+
+        return finished
+
     @expose
     @check_config
-    @lock_required
-    def diag(self, node_list=None):
+    @lock_shared
+    def diag(self, node_list=None, callback=None):
         nodes = self.node_args(node_list)
 
         nodes = self.plugins.cmdPreWithNodes("diag", nodes)
-        results = self.controller.diag(nodes)
+        results = self.controller.diag(nodes, callback)
         self.plugins.cmdPostWithNodes("diag", nodes)
 
         return results
@@ -384,7 +478,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def cronenabled(self):
         results = False
         if self.plugins.cmdPre("cron", "?", False):
@@ -423,7 +517,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @node_lock_required
     def cleanup(self, cleantmp=False, node_list=None):
         nodes = self.node_args(node_list)
 
@@ -435,7 +529,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def capstats(self, interval=10, node_list=None):
         nodes = self.node_args(node_list)
         nodes = self.plugins.cmdPreWithNodes("capstats", nodes, interval)
@@ -446,7 +540,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def df(self, node_list=None):
         nodes = self.node_args(node_list, get_hosts=True)
         nodes = self.plugins.cmdPreWithNodes("df", nodes)
@@ -457,7 +551,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def print_id(self, id, node_list=None):
         nodes = self.node_args(node_list)
         nodes = self.plugins.cmdPreWithNodes("print", nodes, id)
@@ -468,7 +562,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def peerstatus(self, node_list=None):
         nodes = self.node_args(node_list)
         nodes = self.plugins.cmdPreWithNodes("peerstatus", nodes)
@@ -479,7 +573,7 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    @lock_required
+    @lock_shared
     def netstats(self, node_list=None):
         if not node_list:
             node_list = None
@@ -495,11 +589,11 @@ class ZeekCtl(object):
 
     @expose
     @check_config
-    def execute(self, cmd):
+    def execute(self, cmd, callback=None):
         nodes = self.node_args(get_hosts=True)
 
         if self.plugins.cmdPre("exec", cmd):
-            results = self.controller.execute_cmd(nodes, cmd)
+            results = self.controller.execute_cmd(nodes, cmd, callback)
         else:
             results = cmdresult.CmdResult(ok=False)
 
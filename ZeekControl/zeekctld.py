@@ -8,6 +8,7 @@ import random
 import traceback
 
 from ZeekControl import config
+from ZeekControl import events
 from ZeekControl import version
 from ZeekControl.zeekctl import ZeekCtl
 from ZeekControl import ser as json
@@ -57,12 +58,20 @@ class ZeekCtrldWorker(Thread, Common):
 
     def run(self):
         #FIXME: deepcopy breaks here if i set ui=self
-        self.zeekctl = ZeekCtl(ui=TermUI())
+        self.zeekctl = ZeekCtl(ui=TermUI(), heartbeat=True)
         self.zeekctl.ui = self
         self.zeekctl.controller.ui = self
         self.zeekctl.executor.ui = self
+
+        # Keep the Broker peerings with the nodes between commands, so that
+        # the nodes can be queried frequently (e.g. with "netstats").
+        session = events.ControlSession(config.Config.controltopic)
+        session.connect([node for node in self.zeekctl.config.nodes() if node.getPID()])
+        self.zeekctl.controller.control_session = session
+
         while True:
             if self.iteration():
+                session.close()
                 return
 
     def noop(self, *args, **kwargs):
@@ -0,0 +1,90 @@
+from ZeekControl import breaker
+
+class FakeConfig:
+    hostfailurethreshold = 2
+    hostdownbackoff = 60
+    localaddrs = ["127.0.0.1"]
+
+    def __init__(self):
+        self.state = {}
+
+    def get_state(self, key, default=None):
+        return self.state.get(key, default)
+
+    def set_state(self, key, val):
+        self.state[key] = val
+
+    def del_state(self, key):
+        self.state.pop(key, None)
+
+def test_breaker_opens_after_threshold():
+    b = breaker.CircuitBreaker(FakeConfig())
+
+    b.record("10.0.0.1", False)
+    assert b.allow("10.0.0.1")
+
+    b.record("10.0.0.1", False)
+    assert b.is_open("10.0.0.1")
+    assert not b.allow("10.0.0.1")
+
+    b.record("10.0.0.1", True)
+    assert not b.is_open("10.0.0.1")
+    assert b.allow("10.0.0.1")
+    assert b.config.state == {}
+
+def test_breaker_ignores_local_hosts():
+    b = breaker.CircuitBreaker(FakeConfig())
+
+    for i in range(5):
+        b.record("127.0.0.1", False)
+
+    assert b.allow("127.0.0.1")
+
+def test_breaker_probe_after_backoff(monkeypatch):
+    cfg = FakeConfig()
+    b = breaker.CircuitBreaker(cfg)
+    b.record("10.0.0.1", False)
+    b.record("10.0.0.1", False)
+
+    cfg.hostdownbackoff = 0
+
+    monkeypatch.setattr(breaker, "probe_hosts", lambda hosts: set())
+    assert not b.allow("10.0.0.1")
+
+    monkeypatch.setattr(breaker, "probe_hosts", lambda hosts: set(hosts))
+    assert b.allow("10.0.0.1")
+    assert b.is_open("10.0.0.1")
+
+def test_breaker_probe_uses_ssh(monkeypatch, tmp_path):
+    # The probe logs in with ssh (and thus uses the port from the ssh
+    # configuration) instead of connecting to port 22.
+    ssh = tmp_path / "ssh"
+    ssh.write_text(u"#!/bin/sh\necho \"$@\" > %s/args\nexit $EXIT\n" % tmp_path)
+    ssh.chmod(0o755)
+    monkeypatch.setenv("PATH", "%s:%s" % (tmp_path, breaker.os.environ["PATH"]))
+
+    monkeypatch.setenv("EXIT", "0")
+    assert breaker.probe("10.0.0.1")
+    assert "10.0.0.1 true" in (tmp_path / "args").read_text()
+
+    monkeypatch.setenv("EXIT", "255")
+    assert not breaker.probe("10.0.0.1")
+
+def test_breaker_probes_in_parallel(monkeypatch, tmp_path):
+    # Hosts that are due for a probe at the same time are probed together.
+    ssh = tmp_path / "ssh"
+    ssh.write_text(u"#!/bin/sh\nsleep 1\ncase \"$7\" in 10.0.0.1) exit 0;; esac\nexit 255\n")
+    ssh.chmod(0o755)
+    monkeypatch.setenv("PATH", "%s:%s" % (tmp_path, breaker.os.environ["PATH"]))
+
+    cfg = FakeConfig()
+    b = breaker.CircuitBreaker(cfg)
+    hosts = ["10.0.0.%d" % i for i in range(1, 5)]
+    for host in hosts:
+        b.record(host, False)
+        b.record(host, False)
+    cfg.hostdownbackoff = 0
+
+    start = breaker.time.time()
+    assert b.allowed(hosts + ["10.0.0.9"]) == set(["10.0.0.1", "10.0.0.9"])
+    assert breaker.time.time() - start < 3
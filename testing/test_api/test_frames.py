@@ -0,0 +1,48 @@
+from ZeekControl import muxer
+from ZeekControl.ssh_runner import FrameParser, ResultCollector, CmdResult
+
+def test_frame_roundtrip():
+    p = FrameParser()
+    p.feed(muxer.frame(muxer.FRAME_STDOUT, 7, 2, b"some\x00output"))
+
+    assert p.next_frame() == (muxer.FRAME_STDOUT, 7, 2, b"some\x00output")
+    assert p.next_frame() is None
+
+def test_frame_partial():
+    data = muxer.frame(muxer.FRAME_STDERR, 1, 0, b"x" * 1000)
+    data += muxer.frame(muxer.FRAME_DONE, 1, -1)
+
+    p = FrameParser()
+    frames = []
+    for i in range(0, len(data), 7):
+        p.feed(data[i:i+7])
+        while True:
+            f = p.next_frame()
+            if not f:
+                break
+            frames.append(f)
+
+    assert frames == [(muxer.FRAME_STDERR, 1, 0, b"x" * 1000),
+                      (muxer.FRAME_DONE, 1, -1, b"")]
+
+def test_frame_skip_to_ready():
+    p = FrameParser()
+    p.feed(b"some login banner\n")
+    assert not p.skip_to_ready()
+
+    p.feed(muxer.READY + muxer.frame(muxer.FRAME_DONE, 3, -1))
+    assert p.skip_to_ready()
+    assert p.next_frame() == (muxer.FRAME_DONE, 3, -1, b"")
+
+def test_result_collector():
+    c = ResultCollector("localhost", 2)
+    c.add(muxer.FRAME_STDOUT, 1, b"out")
+    c.add(muxer.FRAME_STDERR, 1, b"err")
+    c.add(muxer.FRAME_EXIT, 1, muxer.FRAME_STATUS.pack(-9))
+
+    assert not c.done
+    assert isinstance(c.outputs[0], Exception)
+    assert c.outputs[1] == CmdResult(-9, "out", "err")
+
+    c.add(muxer.FRAME_DONE, -1, b"")
+    assert c.done
@@ -0,0 +1,180 @@
+import subprocess
+import sys
+import threading
+import time
+
+from ZeekControl import config
+from ZeekControl import lock
+
+class Config:
+    def __init__(self, lockfile):
+        self.lockfile = lockfile
+
+class UI:
+    def __init__(self):
+        self.msgs = []
+
+    def info(self, msg):
+        self.msgs.append(msg)
+    error = info
+
+# Lock the file in another process, which holds the lock until its stdin is
+# closed.
+def hold_lock(lockfile, mode):
+    code = "import fcntl, sys; f = open(sys.argv[1], 'a+'); fcntl.flock(f, fcntl.%s); print('locked'); sys.stdout.flush(); sys.stdin.read()" % mode
+    proc = subprocess.Popen([sys.executable, "-c", code, lockfile], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert proc.stdout.readline().strip() == b"locked"
+    return proc
+
+def release(proc):
+    proc.stdin.close()
+    proc.wait()
+
+def test_lock_shared(monkeypatch, tmp_path):
+    lockfile = str(tmp_path / "spool" / "lock")
+    monkeypatch.setattr(config, "Config", Config(lockfile), raising=False)
+    ui = UI()
+
+    # Two shared locks can be held at the same time.
+    assert lock.lock(ui, shared=True)
+    holder = hold_lock(lockfile, "LOCK_SH")
+    lock.unlock(ui)
+
+    try:
+        assert lock.lock(ui, shared=True)
+        lock.unlock(ui)
+
+        # But an exclusive lock conflicts with a shared one.
+        lck = lock._Lock(lockfile)
+        assert lck.open(ui)
+        assert lck.acquire(ui, False) == 0
+        lck.close()
+    finally:
+        release(holder)
+
+    assert lock.lock(ui)
+    assert lock.lock(ui, shared=True)
+    with open(lockfile) as f:
+        assert f.read().strip() == str(lock.os.getpid())
+    lock.unlock(ui)
+    lock.unlock(ui)
+    assert lock.globalLock.count == 0
+
+def test_lock_exclusive(monkeypatch, tmp_path):
+    lockfile = str(tmp_path / "lock")
+    monkeypatch.setattr(config, "Config", Config(lockfile), raising=False)
+    ui = UI()
+
+    holder = hold_lock(lockfile, "LOCK_EX")
+
+    lck = lock._Lock(lockfile)
+    try:
+        assert lck.open(ui)
+        assert lck.acquire(ui, True) == 0
+        assert lck.acquire(ui, False) == 0
+    finally:
+        release(holder)
+
+    # The lock is free once the holder has terminated.
+    assert lck.acquire(ui, True) == 1
+    lck.close()
+
+def test_lock_wait(monkeypatch, tmp_path):
+    lockfile = str(tmp_path / "lock")
+    monkeypatch.setattr(config, "Config", Config(lockfile), raising=False)
+    monkeypatch.setattr(lock, "LOCK_TIMEOUT", 0.5)
+    ui = UI()
+
+    holder = hold_lock(lockfile, "LOCK_EX")
+
+    # Gives up after the timeout.
+    start = time.time()
+    assert not lock.lock(ui)
+    assert 0.5 <= time.time() - start < 5
+    assert ui.msgs[0].startswith("waiting for lock")
+
+    # Wakes up as soon as the holder releases the lock.
+    monkeypatch.setattr(lock, "LOCK_TIMEOUT", 10)
+    threading.Timer(0.2, release, [holder]).start()
+    start = time.time()
+    assert lock.lock(ui)
+    assert time.time() - start < 1
+    lock.unlock(ui)
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+
+def test_lock_nodes(monkeypatch, tmp_path):
+    lockfile = str(tmp_path / "lock")
+    monkeypatch.setattr(config, "Config", Config(lockfile), raising=False)
+    monkeypatch.setattr(lock, "LOCK_TIMEOUT", 0.5)
+    ui = UI()
+
+    holder = hold_lock(lockfile + ".worker-1", "LOCK_EX")
+
+    try:
+        # Other nodes can be locked while worker-1 is locked elsewhere.
+        assert lock.lock_nodes(ui, [Node("worker-2"), Node("manager")])
+        lock.unlock_nodes(ui, [Node("worker-2"), Node("manager")])
+
+        # But not worker-1, and then no node is left locked.
+        assert not lock.lock_nodes(ui, [Node("worker-2"), Node("worker-1")])
+        assert lock.globalLock.count == 0
+        assert lock.nodeLocks["worker-2"].count == 0
+
+        # A cluster-wide operation conflicts with the node locks.
+        assert lock.lock_nodes(ui, [Node("worker-2")])
+        lck = lock._Lock(lockfile)
+        assert lck.open(ui)
+        assert lck.acquire(ui, False) == 0
+        lck.close()
+        lock.unlock_nodes(ui, [Node("worker-2")])
+    finally:
+        release(holder)
+
+    assert lock.lock_nodes(ui, [Node("worker-1")])
+    lock.unlock_nodes(ui, [Node("worker-1")])
+
+def test_lock_upgrade(monkeypatch, tmp_path):
+    lockfile = str(tmp_path / "lock")
+    monkeypatch.setattr(config, "Config", Config(lockfile), raising=False)
+    monkeypatch.setattr(lock, "LOCK_TIMEOUT", 0.5)
+    ui = UI()
+
+    def other_can_lock_exclusive():
+        lck = lock._Lock(lockfile)
+        assert lck.open(ui)
+        try:
+            return lck.acquire(ui, False) == 1
+        finally:
+            lck.close()
+
+    # No upgrade while nodes are locked (another process could be waiting
+    # for them while holding a shared global lock).
+    assert lock.lock_nodes(ui, [Node("worker-1")])
+    assert not lock.lock(ui)
+    assert lock.globalLock.shared and lock.globalLock.count == 1
+    lock.unlock_nodes(ui, [Node("worker-1")])
+
+    # Taking the exclusive lock first works ("restart --clean").
+    assert lock.lock(ui)
+    assert lock.lock_nodes(ui, [Node("worker-1")])
+    assert lock.lock(ui)
+    lock.unlock(ui)
+    lock.unlock_nodes(ui, [Node("worker-1")])
+    lock.unlock(ui)
+    assert lock.globalLock.count == 0
+
+    # A failed upgrade keeps the shared lock.
+    holder = hold_lock(lockfile, "LOCK_SH")
+    try:
+        assert lock.lock(ui, shared=True)
+        assert not lock.lock(ui)
+        assert lock.globalLock.shared and lock.globalLock.count == 1
+    finally:
+        release(holder)
+
+    assert not other_can_lock_exclusive()
+    lock.unlock(ui)
+    assert other_can_lock_exclusive()
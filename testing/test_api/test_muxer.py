@@ -0,0 +1,262 @@
+import io
+
+from ZeekControl import muxer
+from ZeekControl.ssh_runner import FrameParser, ResultCollector
+
+def run(monkeypatch, req, reader=None):
+    out = io.BytesIO()
+    monkeypatch.setattr(muxer, "_out", out)
+    muxer.run_request(req, reader)
+
+    p = FrameParser()
+    p.feed(out.getvalue())
+    results = ResultCollector("localhost", len(req["cmds"]))
+    while True:
+        f = p.next_frame()
+        if not f:
+            break
+        ftype, rid, idx, payload = f
+        assert rid == req["id"]
+        results.add(ftype, idx, payload)
+
+    assert results.done
+    return results.outputs
+
+def test_muxer_plain(monkeypatch):
+    res = run(monkeypatch, {"id": 1, "cmds": [["echo", "a"], ["sh", "-c", "echo b >&2; exit 3"]]})
+
+    assert (res[0].status, res[0].stdout) == (0, "a\n")
+    assert (res[1].status, res[1].stderr) == (3, "b\n")
+
+def test_muxer_dependencies(monkeypatch):
+    cmds = [
+        ["false"],
+        {"cmd": ["echo", "skipped"], "after": 0, "needok": True},
+        {"cmd": ["echo", "also skipped"], "after": 1},
+        {"cmd": ["echo $((1+1))"], "shell": True, "after": 0},
+    ]
+    res = run(monkeypatch, {"id": 2, "cmds": cmds, "max": 1})
+
+    assert res[0].status == 1
+    assert res[1] is None
+    assert res[2] is None
+    assert (res[3].status, res[3].stdout) == (0, "2\n")
+
+def test_muxer_timeout(monkeypatch):
+    cmds = [["sleep", "10"], ["echo", "done"]]
+    res = run(monkeypatch, {"id": 3, "cmds": cmds, "timeout": 0.5})
+
+    assert isinstance(res[0], Exception)
+    assert (res[1].status, res[1].stdout) == (0, "done\n")
+
+def test_muxer_wait_status(monkeypatch, tmp_path):
+    import json, subprocess, sys
+
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    alive = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)", "zeek"])
+
+    try:
+        for name, status in (("reached", "RUNNING [net_run]\n"), ("failed", "garbage\n"), ("dead", ""), ("timeout", "")):
+            tmp_path.joinpath(name).mkdir()
+            tmp_path.joinpath(name, ".status").write_text(status)
+
+        nodes = [
+            [str(tmp_path / "reached"), dead.pid, "RUNNING"],
+            [str(tmp_path / "failed"), alive.pid, "RUNNING"],
+            [str(tmp_path / "dead"), dead.pid, "RUNNING"],
+            [str(tmp_path / "timeout"), alive.pid, "RUNNING"],
+        ]
+        cmds = [{"builtin": "wait-status", "args": [nodes, 0.3]}, {"builtin": "no-such-op"}]
+        res = run(monkeypatch, {"id": 4, "cmds": cmds})
+    finally:
+        alive.kill()
+        alive.wait()
+
+    assert res[0].status == 0
+    assert json.loads(res[0].stdout) == ["reached", "failed", "dead", "timeout"]
+    assert res[1].status == 1
+
+def test_muxer_probe_nodes(monkeypatch, tmp_path):
+    import json, subprocess, sys
+
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)", "zeek"])
+    tmp_path.joinpath(".status").write_text("RUNNING [net_run]\n")
+    tmp_path.joinpath(".startup").write_text("1500000000.0\n")
+
+    try:
+        nodes = [[str(tmp_path), proc.pid], [str(tmp_path / "missing"), None]]
+        res = run(monkeypatch, {"id": 5, "cmds": [{"builtin": "probe-nodes", "args": [nodes]}]})
+    finally:
+        proc.kill()
+        proc.wait()
+
+    running, stopped = json.loads(res[0].stdout)
+    assert running["alive"] and running["zeek"]
+    assert running["status"] == "RUNNING [net_run]"
+    assert running["startup"] == "1500000000.0"
+    assert running["rss"] > 0
+    assert not stopped["alive"] and not stopped["zeek"]
+    assert (stopped["status"], stopped["startup"]) == ("", "")
+
+def test_muxer_native_helpers(monkeypatch, tmp_path):
+    import json, os, signal, subprocess, sys
+
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)", "zeek"])
+
+    try:
+        cmds = [
+            {"builtin": "df", "args": [[str(tmp_path), str(tmp_path / "missing")]]},
+            {"builtin": "top", "args": [[proc.pid], 0.1]},
+            {"builtin": "stop", "args": [proc.pid, signal.SIGTERM], "after": 1},
+        ]
+        res = run(monkeypatch, {"id": 6, "cmds": cmds})
+        assert proc.wait() == -signal.SIGTERM
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    du, missing = json.loads(res[0].stdout)
+    st = os.statvfs(str(tmp_path))
+    assert du["total"] == st.f_blocks * st.f_frsize
+    assert du["fs"]
+    assert "error" in missing
+
+    procinfo, = json.loads(res[1].stdout)
+    assert procinfo["pid"] == proc.pid
+    assert procinfo["rss"] > 0
+    assert procinfo["cpu"] >= 0
+    assert [t["tid"] for t in procinfo["threads"]] == [proc.pid]
+
+    assert res[2].status == 0
+
+def test_muxer_top_stream_cancel(monkeypatch):
+    import os, subprocess, sys, threading, time
+
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)", "zeek"])
+    rfd, wfd = os.pipe()
+
+    def cancel():
+        time.sleep(1)
+        os.write(wfd, b'{"cancel": 7}\n')
+
+    try:
+        threading.Thread(target=cancel).start()
+        cmds = [
+            {"builtin": "top-stream", "args": [[proc.pid], 0.1, 30]},
+            {"cmd": ["echo", "skipped"], "after": 0},
+        ]
+        start = time.time()
+        res = run(monkeypatch, {"id": 7, "cmds": cmds}, muxer.LineReader(rfd))
+        assert time.time() - start < 5
+    finally:
+        proc.kill()
+        proc.wait()
+        os.close(rfd)
+        os.close(wfd)
+
+    # The sampler was killed, but the samples sent before are still there.
+    assert isinstance(res[0], Exception)
+    assert res[1] is None
+
+def test_muxer_top_stream(monkeypatch):
+    import json, subprocess, sys, threading
+
+    proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.5)", "zeek"])
+    # Reap the process as soon as it terminates.
+    reaper = threading.Thread(target=proc.wait)
+    reaper.start()
+
+    try:
+        # The per-command timeout overrides the one of the request.
+        cmds = [{"builtin": "top-stream", "args": [[proc.pid], 0.1, 30], "timeout": 10}]
+        res = run(monkeypatch, {"id": 8, "cmds": cmds, "timeout": 0.2})
+    finally:
+        reaper.join()
+
+    # The sampler stops once the process has terminated.
+    samples = [json.loads(line) for line in res[0].stdout.splitlines()]
+    assert res[0].status == 0
+    assert len(samples) > 1
+    assert samples[0][0]["pid"] == proc.pid
+    assert samples[-1] == [None]
+
+def test_muxer_capstats_collector(tmp_path):
+    import os, stat, time
+
+    script = tmp_path / "capstats"
+    script.write_text(u'#!/bin/sh\nwhile true; do echo "$(date +%s) pkts=10 kpps=0.5" >&2; sleep 0.1; done\n')
+    script.chmod(stat.S_IRWXU)
+    args = [str(script), "eth0", str(tmp_path), 600, 60]
+
+    # The first call starts the collector.
+    assert muxer.capstats(*args)["samples"] == 0
+    pidfile = str(tmp_path / "capstats-eth0.pid")
+    pid = muxer.capstats_collector(pidfile)
+
+    try:
+        # The collector runs in its own session, and it's not our child.
+        assert os.getsid(pid) == pid
+        assert int(open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()[1]) != os.getpid()
+
+        for i in range(50):
+            res = muxer.capstats(*args)
+            if res["samples"] > 1:
+                break
+            time.sleep(0.1)
+
+        assert muxer.capstats_collector(pidfile) == pid
+        assert res["avg"] == {"pkts": 10.0, "kpps": 0.5}
+        assert res["max"]["pkts"] == res["min"]["pkts"] == 10.0
+
+        # The collector terminates when its PID file is removed.
+        os.unlink(pidfile)
+        for i in range(50):
+            if not os.path.exists("/proc/%d" % pid):
+                break
+            time.sleep(0.1)
+        else:
+            assert False, "collector still running"
+    finally:
+        if os.path.exists("/proc/%d" % pid):
+            os.kill(pid, 9)
+
+def test_muxer_capstats_stale_pidfile(tmp_path):
+    import os, stat, subprocess
+
+    script = tmp_path / "capstats"
+    script.write_text(u'#!/bin/sh\nsleep 5\n')
+    script.chmod(stat.S_IRWXU)
+    base = str(tmp_path / "capstats-eth0")
+    pidfile = base + ".pid"
+
+    # A PID file of a running process, or one that is just being written,
+    # is left alone.
+    for content in (str(os.getpid()), ""):
+        with open(pidfile, "w") as f:
+            f.write(content)
+        muxer.start_capstats_collector(str(script), "eth0", base, 600)
+        assert muxer.first_line(pidfile) == content
+
+    # The PID file of a collector that has terminated is replaced.
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    with open(pidfile, "w") as f:
+        f.write(str(proc.pid))
+    muxer.start_capstats_collector(str(script), "eth0", base, 600)
+    pid = muxer.capstats_collector(pidfile)
+    assert pid and pid != proc.pid
+    os.kill(pid, 9)
+
+def test_muxer_nic_stats():
+    import os, pytest
+
+    if not os.path.isdir("/sys/class/net/lo/statistics"):
+        pytest.skip("no kernel interface counters")
+
+    lo, missing = muxer.nic_stats(["lo", "nonexistent0"], 0.1, False)
+    assert lo["pkts"] >= 0
+    assert lo["kpps"] >= 0
+    assert set(["kbytes", "mbps", "drops", "missed", "errors"]) <= set(lo)
+    assert "error" in missing
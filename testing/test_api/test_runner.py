@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+
+import pytest
+
+from ZeekControl import muxer
+from ZeekControl import ssh_runner
+from ZeekControl.ssh_runner import FRAME_ERROR
+
+def managers():
+    yield "threads", ssh_runner.MultiMasterManager
+    if sys.version_info[0] >= 3:
+        from ZeekControl import async_runner
+        yield "asyncio", async_runner.AsyncMasterManager
+    # Runs the commands for the local host in zeekctl's process.
+    yield "local", lambda localaddrs: ssh_runner.MultiMasterManager(localaddrs, localworkers=4)
+
+# The muxer is run with the Python interpreter configured by CMake, so use
+# the one running the tests instead.
+@pytest.fixture(params=[cls for name, cls in managers()], ids=[name for name, cls in managers()])
+def manager(request, monkeypatch):
+    run_mux = ssh_runner.get_muxer()
+    if isinstance(run_mux, bytes):
+        run_mux = run_mux.replace(b"@PYTHON_EXECUTABLE@", sys.executable.encode())
+    else:
+        run_mux = run_mux.replace("@PYTHON_EXECUTABLE@", sys.executable)
+    monkeypatch.setattr(ssh_runner, "get_muxer", lambda: run_mux)
+
+    mgr = request.param(["localhost"])
+    yield mgr
+    mgr.shutdown_all()
+
+def test_runner_exec(manager):
+    cmds = [("localhost", ["echo", "hello"]), ("localhost", {"cmd": "echo err >&2; exit 3", "shell": True})]
+    results = list(manager.exec_multihost_commands(cmds, timeout=10))
+    assert [host for host, res in results] == ["localhost", "localhost"]
+    assert results[0][1].status == 0 and results[0][1].stdout == "hello\n"
+    assert results[1][1].status == 3 and results[1][1].stderr == "err\n"
+
+def test_runner_stream(manager):
+    cmds = [("localhost", "echo a; sleep 0.5; echo b"), ("localhost", "echo c")]
+
+    start = time.time()
+    frames = []
+    for idx, ftype, payload in manager.stream_multihost_commands(cmds, shell=True, timeout=10):
+        frames.append((idx, ftype, payload, time.time() - start))
+
+    # The output arrives as it is produced.
+    out = [(idx, payload) for (idx, ftype, payload, t) in frames if ftype == muxer.FRAME_STDOUT]
+    assert out == [(0, b"a\n"), (1, b"c\n"), (0, b"b\n")] or out == [(1, b"c\n"), (0, b"a\n"), (0, b"b\n")]
+    assert [t for (idx, ftype, payload, t) in frames if payload == b"c\n"][0] < 0.4
+
+    exits = sorted(idx for (idx, ftype, payload, t) in frames if ftype == muxer.FRAME_EXIT)
+    assert exits == [0, 1]
+
+def test_runner_timeout(manager):
+    res = manager.exec_commands("localhost", [{"cmd": "sleep 10", "shell": True, "timeout": 1}, ["echo", "ok"]], timeout=5)
+    assert isinstance(res[0], Exception) and "timeout" in str(res[0])
+    assert res[1].stdout == "ok\n"
+
+def test_runner_limits(manager):
+    # The handlers for a host are created on first use.
+    manager.limits = (3, {"sleep": 1})
+    cmds = [("localhost", "sleep 0.5") for i in range(3)] + [("localhost", "echo %d" % i) for i in range(3)]
+
+    start = time.time()
+    exits = {}
+    for idx, ftype, payload in manager.stream_multihost_commands(cmds, shell=True, timeout=10):
+        if ftype == muxer.FRAME_EXIT:
+            exits[idx] = time.time() - start
+
+    # The sleeps run one after another, while the echos run next to them.
+    assert sorted(exits) == list(range(6))
+    assert max(exits[i] for i in range(3)) >= 1.5
+    assert max(exits[i] for i in range(3, 6)) < 1.0
+
+def test_runner_cancel(manager):
+    cmds = [("localhost", {"builtin": "top-stream", "args": [[os.getpid()], 0.1, 10]}), ("localhost", "sleep 10")]
+
+    start = time.time()
+    events = []
+    for idx, ftype, payload in manager.stream_multihost_commands(cmds, shell=True, timeout=20):
+        events.append((idx, ftype))
+        if ftype == muxer.FRAME_STDOUT and idx == 0:
+            manager.cancel(["localhost"])
+
+    assert time.time() - start < 5
+    assert (0, muxer.FRAME_STDOUT) in events
+    assert set(idx for (idx, ftype) in events if ftype not in (muxer.FRAME_STDOUT, muxer.FRAME_STDERR)) == set([0, 1])
+
+def test_runner_lost_connection(manager):
+    if not manager.localworkers == 0:
+        pytest.skip("no connection to the local host")
+
+    assert manager.exec_command("localhost", ["echo", "ok"], timeout=5).stdout == "ok\n"
+
+    # Kill the connection (the shell and the muxer, whose process group is
+    # different from that of the command) while a command is running.
+    cmds = [("localhost", "kill -9 -$(ps -o pgid= -p $PPID | tr -d ' '); sleep 5")]
+    start = time.time()
+    events = list(manager.stream_multihost_commands(cmds, shell=True, timeout=10))
+    assert time.time() - start < 5
+    assert [ftype for (idx, ftype, payload) in events] == [FRAME_ERROR]
+
+    # The next request reconnects.
+    assert manager.exec_command("localhost", ["echo", "again"], timeout=5).stdout == "again\n"
+
+class ExecConfig:
+    localaddrs = ["localhost"]
+    hostlivenessttl = 0
+    localworkers = 4
+    maxhostcommands = 0
+    executorbackend = "threads"
+    commandtimeout = 2
+    hostfailurethreshold = 0
+
+    def get_command_limits(self):
+        return {}
+
+class Node:
+    def __init__(self, name):
+        self.name = name
+        self.host = self.addr = "localhost"
+
+def test_executor_stream_cmds():
+    from ZeekControl import execute
+
+    executor = execute.Executor(ExecConfig())
+    n1, n2, n3 = Node("n1"), Node("n2"), Node("n3")
+    cmds = [(n1, "echo a; sleep 0.5; echo b; exit 3", []), (n2, "echo c", []), (n3, "sleep 10", [])]
+
+    try:
+        events = list(executor.stream_cmds(cmds, shell=True))
+    finally:
+        executor.finish()
+
+    # The output of each command arrives in pieces, followed by its status.
+    assert [data for (node, data) in events if node is n1] == ["a\n", "b\n", 3]
+    assert [data for (node, data) in events if node is n2] == ["c\n", 0]
+    assert events.index((n2, 0)) < events.index((n1, "b\n"))
+
+    # A command that times out ends with an error message and None.
+    assert "timeout" in events[-2][1] and events[-1] == (n3, None)
+
+def test_local_builtin_kill():
+    # A built-in operation that waits stops as soon as it's killed (on a
+    # timeout or when the request is cancelled).
+    proc = ssh_runner.LocalBuiltinProc("top", [[os.getpid()], 10])
+    time.sleep(0.3)
+    assert proc.thread.is_alive()
+
+    start = time.time()
+    proc.kill_group()
+    proc.thread.join(5)
+    assert not proc.thread.is_alive() and time.time() - start < 1
+    assert proc.wait() < 0
+    proc.stdout.close()
+    proc.stderr.close()
@@ -1,4 +1,6 @@
 from __future__ import print_function
+import sqlite3
+
 from ZeekControl.state import SqliteState
 
 def test_state_basic():
@@ -42,3 +44,152 @@ def test_state_items():
 
     assert d["a"] == 1
     assert d["b"] == "two"
+
+def test_state_batch(tmp_path):
+    path = str(tmp_path / "state.db")
+    s = SqliteState(path)
+    other = SqliteState(path)
+
+    s.begin_batch()
+    s.set("a", 1)
+    s.begin_batch()
+    s.set("b", "two")
+    s.end_batch()
+
+    # Visible in this store, but not written yet.
+    assert s.get("a") == 1
+    assert dict(s.items()) == {"a": 1, "b": "two"}
+    assert other.get("a") == None
+
+    s.end_batch()
+    assert dict(other.items()) == {"a": 1, "b": "two"}
+
+    s.c.execute("PRAGMA journal_mode")
+    assert s.c.fetchone()[0] == "wal"
+
+def test_state_changes(tmp_path):
+    path = str(tmp_path / "state.db")
+    s = SqliteState(path)
+    other = SqliteState(path)
+
+    s.set("a", 1)
+    s.set("b", 2)
+    full, items = other.changes()
+    assert full and dict(items) == {"a": 1, "b": 2}
+    assert other.changes() == (False, [])
+
+    s.set("b", 3)
+    s.set("c", 4)
+    full, items = other.changes()
+    assert not full and dict(items) == {"b": 3, "c": 4}
+
+    # Our own changes are not reported if nobody else wrote anything.
+    other.set("d", 5)
+    assert other.changes() == (False, [])
+
+def test_state_changes_old_writer(tmp_path):
+    path = str(tmp_path / "state.db")
+    s = SqliteState(path)
+    s.set("a", 1)
+    assert s.changes()[0]
+
+    # A version of zeekctl that doesn't know about revisions.
+    old = sqlite3.connect(path)
+    old.execute("REPLACE INTO state (key, value) VALUES ('a', '2')")
+    old.execute("REPLACE INTO state (key, value) VALUES ('b', '3')")
+    old.commit()
+
+    full, items = s.changes()
+    assert dict(items) == {"a": 2, "b": 3}
+
+    # A row that is removed, or written without a new revision, forces a
+    # full reload.
+    old.execute("DROP TRIGGER state_rev_insert")
+    old.execute("REPLACE INTO state (key, value) VALUES ('a', '4')")
+    old.commit()
+    full, items = s.changes()
+    assert full and dict(items) == {"a": 4, "b": 3}
+
+    s.set("c", 5)
+    old.execute("DELETE FROM state WHERE key = 'b'")
+    old.execute("REPLACE INTO state (key, value, rev) VALUES ('d', '6', 100)")
+    old.commit()
+    full, items = s.changes()
+    assert full and dict(items) == {"a": 4, "c": 5, "d": 6}
+
+def test_state_delete(tmp_path):
+    path = str(tmp_path / "state.db")
+    s = SqliteState(path)
+    other = SqliteState(path)
+
+    s.set("a", 1)
+    s.set("b", 2)
+    assert other.changes()[0]
+
+    s.begin_batch()
+    s.delete("a")
+    assert s.get("a") == None
+    assert dict(s.items()) == {"b": 2}
+    s.end_batch()
+
+    full, items = other.changes()
+    assert full and dict(items) == {"b": 2}
+
+# Commands holding shared locks (such as two "status" commands, or "status"
+# and "stop" for different nodes) can write at the same time.  Each one only
+# writes the keys that it changed.
+def test_state_concurrent_batches(tmp_path):
+    path = str(tmp_path / "state.db")
+    init = SqliteState(path)
+    init.set("worker-1-pid", 100)
+    init.set("worker-2-pid", 200)
+
+    a = SqliteState(path)
+    b = SqliteState(path)
+    a.changes()
+    b.changes()
+
+    a.begin_batch()
+    b.begin_batch()
+    a.set("worker-1-pid", None)
+    a.set("worker-1-crashed", True)
+    b.set("worker-1-pid", None)
+    b.set("worker-1-crashed", True)
+    b.set("worker-2-expect-running", False)
+    b.end_batch()
+    a.set("hostbreaker-h1", {"failures": 1, "opened": 0})
+    a.end_batch()
+
+    assert dict(init.items()) == {"worker-1-pid": None, "worker-1-crashed": True, "worker-2-pid": 200,
+                                  "worker-2-expect-running": False, "hostbreaker-h1": {"failures": 1, "opened": 0}}
+
+# The PIDs of the nodes are written right away, also during a command, so
+# that they are not lost if zeekctl is killed.
+def test_state_node_pid_not_batched(tmp_path):
+    from ZeekControl import config
+    from ZeekControl import node
+
+    path = str(tmp_path / "state.db")
+    cfg = config.Configuration.__new__(config.Configuration)
+    cfg.state = {}
+    cfg.state_store = SqliteState(path)
+    other = SqliteState(path)
+
+    n = node.Node(cfg, "worker-1")
+    n.host = "host1"
+    with cfg.state_batch():
+        n.setPID(1234)
+        n.setExpectRunning(True)
+        assert other.get("worker-1-pid") == 1234
+        assert other.get("worker-1-expect-running") == True
+
+        n.clearPID()
+        n.setCrashed()
+        assert other.get("worker-1-pid") is None
+        assert other.get("worker-1-crashed") == True
+
+        # Other state is written at the end of the command.
+        n.setPort(47761)
+        assert other.get("worker-1-port") is None
+
+    assert other.get("worker-1-port") == 47761